@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+端到端基准: 假 opencode 重放录下的事件流，假 Telegram API 在独立进程里 (可注入延迟和 429)，
+webhook_driver 在独立进程里并发 POST update；bot 本身在本进程的事件循环上运行 (asyncio 模式)。
+
+输出 jobs/sec、webhook 应答 p50/p99、每个任务的消息数和 Bot API 请求数、每个任务的 CPU
+(bot 进程与 opencode 子进程分开计)，以及任务耗时和首个事件的分位数。
+改动 telegram_opencode_bot.py 前后各跑一次，用 --json 的输出对比。
+
+运行: python3 bench/benchmark.py [--jobs 200] [--speed 10] [--tg-latency 0.05] [--flood-rate 0.01] [--json]
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import telegram_opencode_bot as bot
+
+DEFAULT_TEXTS = "修一下空请求体导致的 500,看看配置里的端口是多少,给 handlers 补上测试,检查一下最近的改动"
+
+
+def cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def install_fake_opencode(args):
+    bin_dir = tempfile.mkdtemp(prefix="fake-opencode-")
+    os.symlink(os.path.join(BENCH_DIR, "fake_opencode.py"), os.path.join(bin_dir, "opencode"))
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    os.environ['FAKE_OPENCODE_REPLAY'] = args.replay
+    os.environ['FAKE_OPENCODE_SPEED'] = str(args.speed)
+    os.environ['FAKE_OPENCODE_BOOT'] = str(args.boot)
+
+
+async def start_fake_telegram(args):
+    """在独立进程里启动假 Telegram API (不占本进程的 CPU 计时)，返回 (进程, 端口)"""
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(BENCH_DIR, "fake_telegram.py"), "--port", "0",
+        "--latency", str(args.tg_latency), "--flood-rate", str(args.flood_rate),
+        stdout=asyncio.subprocess.PIPE)
+    line = (await process.stdout.readline()).decode()
+    return process, int(line.rsplit(':', 1)[1])
+
+
+def setup_bot(args, tg_port, work_dir):
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    bot.install_child_watcher(bot.BOT_LOOP)
+    bot.LOG_WRITER = bot.LogWriter(os.path.join(work_dir, "bot.log"), bot.LOG_MAX_BYTES,
+                                   bot.LOG_ROTATE_SECONDS, bot.LOG_BACKUPS, stdout=False)
+    bot.TELEGRAM_CLIENT = bot.TelegramClient(f"http://127.0.0.1:{tg_port}")
+    if not args.real_limits:
+        bot.CHAT_SEND_RATE = bot.CHAT_SEND_BURST = bot.GLOBAL_SEND_RATE = bot.GROUP_SEND_RATE = 10 ** 6
+    bot.OUTBOX = bot.OutboundScheduler()
+    bot.MEMORY_STORE = bot.MemoryStore(0, "", 100, 3600)
+    bot.SCHEDULER = bot.JobScheduler()
+    bot.MAX_WORKERS = args.workers
+    bot.METRICS = bot.Metrics()
+    bot.TRACES = bot.TraceStore(os.path.join(work_dir, "trace.jsonl"), args.jobs, 1000)
+    bot.UPDATE_DEDUP = bot.UpdateDeduplicator(bot.UPDATE_DEDUP_SIZE, bot.UPDATE_DEDUP_TTL, None)
+    bot.WARM_POOL = bot.WarmPool(args.warm, 25000 + os.getpid() % 10000)
+
+
+async def wait_warm_pool(timeout=30):
+    deadline = time.monotonic() + timeout
+    while any(w.state != "idle" for w in bot.WARM_POOL.workers):
+        if time.monotonic() > deadline:
+            raise SystemExit(f"常驻进程未就绪: {[w.state for w in bot.WARM_POOL.workers]}")
+        await asyncio.sleep(0.05)
+
+
+def counter_sum(name):
+    return sum(value for (key, _), value in bot.METRICS.counters.items() if key == name)
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] if ordered else 0.0
+
+
+async def run(args):
+    install_fake_opencode(args)
+    work_dir = tempfile.mkdtemp(prefix="bench-")
+    telegram, tg_port = await start_fake_telegram(args)
+    setup_bot(args, tg_port, work_dir)
+    server = await asyncio.start_server(bot.handle_http, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    if args.warm:
+        bot.WARM_POOL.start()
+        await wait_warm_pool()
+
+    first_job = bot.Job._next_id
+    bot_cpu = cpu_seconds(resource.RUSAGE_SELF)
+    child_cpu = cpu_seconds(resource.RUSAGE_CHILDREN)
+    start = time.monotonic()
+
+    # 每个 update 一个聊天，每个聊天一个任务
+    driver = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(BENCH_DIR, "webhook_driver.py"),
+        "--url", f"http://127.0.0.1:{port}/webhook", "--requests", str(args.jobs),
+        "--concurrency", str(args.concurrency), "--chats", str(args.jobs), "--texts", args.texts,
+        stdout=asyncio.subprocess.PIPE)
+    webhook = json.loads((await driver.stdout.read()).decode())
+    await driver.wait()
+
+    deadline = time.monotonic() + args.timeout
+    while counter_sum("opencode_bot_jobs_total") < args.jobs or bot.OUTBOX.pending():
+        if time.monotonic() > deadline:
+            raise SystemExit(f"{args.timeout} 秒内只完成了 {counter_sum('opencode_bot_jobs_total'):.0f}/{args.jobs} 个任务")
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - start
+    bot_cpu = cpu_seconds(resource.RUSAGE_SELF) - bot_cpu
+    # 已回收的子进程: 所有 opencode 和 webhook_driver (假 Telegram 还在运行，不计入)
+    opencode_cpu = cpu_seconds(resource.RUSAGE_CHILDREN) - child_cpu - webhook["cpu_seconds"]
+
+    durations = []
+    first_events = []
+    for job_id in range(first_job, first_job + args.jobs):
+        trace = bot.TRACES.get(job_id)
+        for line in trace.lines if trace is not None else ():
+            event = json.loads(line)
+            if event["event"] == "end":
+                durations.append(event["seconds"])
+            elif event["event"] == "first_event":
+                first_events.append(event["seconds"])
+
+    jobs = args.jobs
+    result = {
+        "jobs": jobs,
+        "ok": bot.METRICS.counters.get(("opencode_bot_jobs_total", (("outcome", "ok"),)), 0),
+        "seconds": round(elapsed, 3),
+        "jobs_per_sec": round(jobs / elapsed, 2),
+        "webhook_p50_ms": webhook["p50_ms"],
+        "webhook_p99_ms": webhook["p99_ms"],
+        "webhook_errors": webhook["errors"],
+        "messages_per_job": round(counter_sum("opencode_bot_messages_sent_total") / jobs, 2),
+        "api_requests_per_job": round(counter_sum("opencode_bot_telegram_requests_total") / jobs, 2),
+        "rate_limited": counter_sum("opencode_bot_telegram_rate_limited_total"),
+        "bot_cpu_ms_per_job": round(bot_cpu / jobs * 1000, 2),
+        "opencode_cpu_ms_per_job": round(opencode_cpu / jobs * 1000, 2),
+        "job_p50_s": round(percentile(durations, 0.50), 3),
+        "job_p99_s": round(percentile(durations, 0.99), 3),
+        "first_event_p50_s": round(percentile(first_events, 0.50), 3),
+    }
+
+    bot.WARM_POOL.kill_all()
+    server.close()
+    telegram.terminate()
+    await telegram.wait()
+    bot.TELEGRAM_CLIENT.close()
+    bot.TRACES.close()
+    bot.LOG_WRITER.close()
+    await asyncio.sleep(0.05)
+    return result
+
+
+def print_report(r):
+    print(f"{r['jobs']} 个任务 ({r['ok']} 个成功)，{r['seconds']}s: {r['jobs_per_sec']} jobs/sec")
+    print(f"webhook 应答: p50 {r['webhook_p50_ms']} ms，p99 {r['webhook_p99_ms']} ms，非 200: {r['webhook_errors']}")
+    print(f"每个任务: {r['messages_per_job']} 条消息/编辑，{r['api_requests_per_job']} 次 Bot API 请求 (429: {r['rate_limited']})")
+    print(f"每个任务 CPU: bot {r['bot_cpu_ms_per_job']} ms，opencode (假) {r['opencode_cpu_ms_per_job']} ms")
+    print(f"任务耗时: p50 {r['job_p50_s']}s，p99 {r['job_p99_s']}s；首个事件 p50 {r['first_event_p50_s']}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=200, help="任务数 (每个任务一个聊天)")
+    parser.add_argument("--concurrency", type=int, default=50, help="webhook 并发连接数")
+    parser.add_argument("--workers", type=int, default=64, help="MAX_WORKERS")
+    parser.add_argument("--warm", type=int, default=0, help="常驻 opencode 进程数")
+    parser.add_argument("--replay", default=os.path.join(BENCH_DIR, "streams"), help="录下的事件流文件或目录")
+    parser.add_argument("--speed", type=float, default=10.0, help="重放速度倍数，0 表示不等待")
+    parser.add_argument("--boot", type=float, default=0.2, help="假 opencode 冷启动耗时 (秒)")
+    parser.add_argument("--tg-latency", type=float, default=0.05, help="假 Telegram 每个请求的延迟 (秒)")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="假 Telegram 随机返回 429 的比例")
+    parser.add_argument("--real-limits", action="store_true", help="保留 bot 的发送限速 (默认不限速，只测 bot 本身)")
+    parser.add_argument("--texts", default=DEFAULT_TEXTS, help="逗号分隔的任务文本，轮流使用")
+    parser.add_argument("--timeout", type=float, default=600, help="等待全部任务完成的秒数")
+    parser.add_argument("--json", action="store_true", help="只输出一行 JSON")
+    args = parser.parse_args()
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print_report(report)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Markdown 渲染: 正确性 (代码块先于行内代码)、HTML / MarkdownV2 输出、实体解析失败时改发纯文本，
+以及在大段 agent 输出上与原来 8 次 re.sub 的 clean_text 的吞吐对比
+
+运行: python3 bench/check_clean_text.py [输出 KB]
+"""
+
+import os
+import re
+import sys
+import time
+import asyncio
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import telegram_opencode_bot as bot
+from fake_telegram import FakeTelegram
+
+
+def old_clean_text(text):
+    """原来的实现"""
+    if not text:
+        return text
+    import re
+    text = re.sub(r'\*\*([^*]+)\*\*', r'\1', text)
+    text = re.sub(r'__([^_]+)__', r'\1', text)
+    text = re.sub(r'`([^`]+)`', r'\1', text)
+    text = re.sub(r'```[\s\S]*?```', '', text)
+    text = re.sub(r'\[([^\]]+)\]\([^)]+\)', r'\1', text)
+    text = re.sub(r'^#{1,6}\s+', '', text, flags=re.MULTILINE)
+    text = re.sub(r'^[\-\*]\s+', '', text, flags=re.MULTILINE)
+    text = re.sub(r'^\d+\.\s+', '', text, flags=re.MULTILINE)
+    return text
+
+
+SECTION = """## 第 {i} 步: 修改配置
+
+我检查了 **config.py** 和 `settings.yaml`，发现 *timeout* 设置为 `30`，my_var_name 没有改动。
+参考 [文档](https://example.com/docs_(v2)) 之后做了如下修改:
+
+- 把 `timeout` 改为 **60**
+- 删除 ~~旧的重试逻辑~~
+1. 运行测试
+2. 提交
+
+```python
+def retry(fn, times=3):
+    for i in range(times):  # `i` 从 0 开始
+        if fn(**kwargs):
+            return True
+    return False
+```
+
+"""
+
+
+def check_rendering():
+    text = "前文\n```bash\necho `date` **not bold**\n```\n后文 `x`"
+    assert bot.clean_text(text) == "前文\necho `date` **not bold**\n后文 x", bot.clean_text(text)
+    # 原来的实现先处理行内代码，代码块被拆坏
+    assert "```" not in bot.clean_text(text) and "``" in old_clean_text(text)
+
+    assert bot.clean_text("# 标题 **粗**\n- a\n  * b\n1. c") == "标题 粗\n• a\n  • b\n1. c"
+    assert bot.clean_text("snake_case_name 和 2*3*4") == "snake_case_name 和 2*3*4"
+    assert bot.clean_text("[链接](http://a.com/x_(y))") == "链接"
+
+    html = bot.render_markdown("**a<b>** `x & y` [l](http://u?a=1&b=2)\n```py\n1 < 2\n```", "html")
+    assert html == '<b>a&lt;b&gt;</b> <code>x &amp; y</code> <a href="http://u?a=1&amp;b=2">l</a>\n' \
+                   '<pre><code class="language-py">1 &lt; 2</code></pre>', html
+
+    md = bot.render_markdown("**1.5** 版本 (测试) `a\\b` _i_", "markdownv2")
+    assert md == "*1\\.5* 版本 \\(测试\\) `a\\\\b` _i_", md
+    print("渲染结果正确: 代码块先于行内代码，HTML / MarkdownV2 转义正确")
+
+
+async def check_fallback():
+    fake = FakeTelegram()
+    fake.reject_entities = True
+    port = await fake.start()
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    bot.TELEGRAM_CLIENT = bot.TelegramClient(f"http://127.0.0.1:{port}")
+    bot.MESSAGE_FORMAT = "html"
+    assert await bot.send_message(1, "**完成** `ok`")
+    sent = [p for _, m, p in fake.requests if m == 'sendMessage']
+    assert sent == [{"chat_id": 1, "text": "完成 ok"}], sent
+    bot.MESSAGE_FORMAT = "plain"
+    bot.TELEGRAM_CLIENT.close()
+    print("实体解析失败 (400) 时改发纯文本")
+
+
+PROSE = """第 {i} 轮: 已经读取了仓库里的配置文件，确认数据库连接参数正确，接下来执行查询并把结果写入笔记。
+查询返回 5 条记录，字段包括 id、name、address 和 updated_at，其中两条记录的地址为空，已在笔记里标注。
+**结论**: 表结构和预期一致，`locations` 表没有重复数据，可以继续下一步。
+
+"""
+
+EVENT = "正在修改 `config.py`: 把 **timeout** 从 30 改为 60，并删除旧的重试逻辑。"
+
+
+def measure(fn, texts, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            fn(text)
+    return (time.perf_counter() - start) / rounds
+
+
+def bench(size_kb):
+    def build(section):
+        text = ""
+        i = 0
+        while len(text.encode('utf-8')) < size_kb * 1024:
+            text += section.format(i=i)
+            i += 1
+        return text
+
+    corpora = [
+        (f"密集 Markdown {size_kb} KB", [build(SECTION)], 20),
+        (f"agent 长输出 {size_kb} KB", [build(PROSE)], 20),
+        ("流式事件 10000 条", [EVENT] * 10000, 5),
+    ]
+    functions = [
+        ("原来的 clean_text", old_clean_text),
+        ("render_markdown plain", bot.clean_text),
+        ("render_markdown html", lambda t: bot.render_markdown(t, "html")),
+    ]
+    for corpus, texts, rounds in corpora:
+        size = sum(len(t.encode('utf-8')) for t in texts) / 1024 / 1024
+        line = []
+        for name, fn in functions:
+            elapsed = measure(fn, texts, rounds)
+            line.append(f"{name} {size / elapsed:.1f} MB/s")
+        print(f"{corpus}: " + "，".join(line))
+
+async def main(size_kb):
+    check_rendering()
+    await check_fallback()
+    bench(size_kb)
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 512))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+检查重复任务合并: 同一聊天重复发送的相同任务 (空白、大小写、全角半角不同也算) 合并到运行中
+或排队中的任务，只执行一次；记忆变化后、超过 COALESCE_WINDOW 后或其他聊天的相同任务照常执行
+
+运行: python3 bench/check_coalesce.py
+"""
+
+import os
+import sys
+import asyncio
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+import telegram_opencode_bot as bot
+
+update_id = 0
+
+
+def send(chat_id, text):
+    global update_id
+    update_id += 1
+    bot.handle_update({"update_id": update_id, "message": {"chat": {"id": chat_id}, "text": text}})
+
+
+async def idle():
+    while bot.SCHEDULER.running or bot.SCHEDULER.queues:
+        await asyncio.sleep(0.01)
+
+
+async def main():
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    bot.MAX_WORKERS = 4
+    bot.MEMORY_STORE = bot.MemoryStore(3, "", 100, 3600)
+    bot.SCHEDULER = bot.JobScheduler()
+
+    runs = []
+    replies = []
+    release = asyncio.Event()
+
+    async def fake_run(prompt, chat_id, original_prompt=None, **kwargs):
+        runs.append((chat_id, original_prompt))
+        await release.wait()
+        bot.save_to_memory(chat_id, original_prompt, "完成")
+
+    bot.run_opencode = fake_run
+    bot.post_message = lambda chat_id, text: replies.append((chat_id, text))
+
+    # 运行中的任务: 连点两次、多了空格、全角字符，都只执行一次
+    send(1, "查询 locations 表的前 5 条")
+    await asyncio.sleep(0.01)
+    send(1, "查询 locations 表的前 5 条")
+    send(1, "  查询   Locations 表的前 ５ 条 ")
+    # 排队中的任务也合并
+    send(1, "统计行数")
+    send(1, "统计行数")
+    # 其他聊天的相同任务照常执行
+    send(2, "查询 locations 表的前 5 条")
+    await asyncio.sleep(0.01)
+    release.set()
+    await idle()
+    assert runs == [(1, "查询 locations 表的前 5 条"), (2, "查询 locations 表的前 5 条"), (1, "统计行数")], runs
+    merged = [text for chat_id, text in replies if text.startswith("🔁")]
+    assert len(merged) == 3 and bot.SCHEDULER.coalesced == 3, replies
+    print(f"6 次发送执行 {len(runs)} 次，合并 {bot.SCHEDULER.coalesced} 次")
+
+    # 任务结束、记忆更新后再发同样的内容是新的任务
+    runs.clear()
+    send(1, "统计行数")
+    await idle()
+    assert runs == [(1, "统计行数")], runs
+
+    # 超过合并窗口的重复发送不再合并
+    runs.clear()
+    release.clear()
+    bot.COALESCE_WINDOW = 0.05
+    send(3, "长任务")
+    await asyncio.sleep(0.1)
+    send(3, "长任务")
+    assert len(bot.SCHEDULER.queues.get(3, ())) == 1
+    release.set()
+    await idle()
+    assert runs == [(3, "长任务"), (3, "长任务")], runs
+    print("记忆变化和超出窗口后不合并: OK")
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
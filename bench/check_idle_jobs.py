@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+检查大量并发任务空闲时的 CPU 和线程占用 (本地假 opencode + 假 Telegram，无需外网)
+
+每个假 opencode 先输出一个事件，然后静默 IDLE 秒再结束。
+在所有任务都处于静默期时统计本进程的 CPU 时间和线程数。
+
+运行: python3 bench/check_idle_jobs.py [任务数] [静默秒数]
+"""
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import resource
+import threading
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import telegram_opencode_bot as bot
+from fake_telegram import FakeTelegram
+
+FAKE_OPENCODE = """#!/bin/sh
+echo '{"type": "step_start", "part": {}}'
+sleep %d
+echo '{"type": "text", "part": {"type": "text", "text": "done"}}'
+"""
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def main(jobs, idle):
+    telegram = FakeTelegram()
+    port = await telegram.start()
+
+    bin_dir = tempfile.mkdtemp(prefix="fake-opencode-")
+    fake = os.path.join(bin_dir, "opencode")
+    with open(fake, 'w') as f:
+        f.write(FAKE_OPENCODE % idle)
+    os.chmod(fake, 0o755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.TELEGRAM_CLIENT = bot.TelegramClient(f"http://127.0.0.1:{port}")
+    # 这里只关心空闲开销: 放开全局发送限速让预热尽快完成，并关掉 "正在输入" 心跳
+    bot.OUTBOX.global_bucket = bot.TokenBucket(10 ** 6, 10 ** 6)
+    bot.TYPING_INTERVAL = 3600
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    bot.install_child_watcher(bot.BOT_LOOP)
+
+    started = time.monotonic()
+    tasks = [bot.spawn(bot.run_opencode(f"job {i}", i)) for i in range(jobs)]
+
+    # 每个任务会先发 "正在执行" 和进度消息 "开始新步骤"，等它们都发完
+    while telegram.count('sendMessage') < jobs * 2:
+        if time.monotonic() - started > idle - 3:
+            raise SystemExit(f"预热超时: 只收到 {telegram.count('sendMessage')} 条消息，请调大静默秒数")
+        await asyncio.sleep(0.1)
+    warmup = time.monotonic() - started
+
+    window = max(1.0, min(5.0, idle - warmup - 1))
+    cpu_before = cpu_seconds()
+    await asyncio.sleep(window)
+    idle_cpu = cpu_seconds() - cpu_before
+    threads = threading.active_count()
+
+    print(f"任务数: {jobs}，预热 {warmup:.1f}s")
+    print(f"静默 {window:.1f}s 内 CPU: {idle_cpu * 1000:.0f} ms ({idle_cpu / window * 100:.1f}%)")
+    print(f"线程数: {threads}")
+
+    await asyncio.gather(*tasks)
+    bot.TELEGRAM_CLIENT.close()
+    print(f"全部完成，总耗时 {time.monotonic() - started:.1f}s")
+
+    assert idle_cpu / window < 0.05, "空闲任务不应占用 CPU"
+    assert threads < 10, "不应为每个任务创建线程"
+    print("OK")
+
+
+if __name__ == "__main__":
+    jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    idle = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    asyncio.run(main(jobs, idle))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+检查任务时间上限、无输出看门狗和 /cancel: 卡住的任务被结束并释放名额，进程组全部清理
+
+运行: python3 bench/check_job_limits.py
+"""
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import telegram_opencode_bot as bot
+from fake_telegram import FakeTelegram
+from check_process_groups import alive
+
+# hang: 输出一个事件后不再输出；trickle: 每 0.2 秒输出一个事件，永不结束。
+# 两种都带一个后台孙进程，每次启动把 "opencode pid 孙进程 pid" 追加到 PID_DIR/<任务名>
+FAKE_OPENCODE = r"""#!/usr/bin/env python3
+import json, os, subprocess, sys, time
+prompt = sys.argv[-1]
+name = prompt.split()[0]
+child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(1000)"],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+with open(os.path.join(os.environ["PID_DIR"], name), "a") as f:
+    f.write(f"{os.getpid()} {child.pid}\n")
+def emit(text):
+    sys.stdout.write(json.dumps({"type": "text", "part": {"type": "text", "text": text}}) + "\n")
+    sys.stdout.flush()
+emit("开始")
+if "trickle" in prompt:
+    while True:
+        time.sleep(0.2)
+        emit(".")
+time.sleep(1000)
+"""
+
+
+def starts(pid_dir, name):
+    try:
+        with open(os.path.join(pid_dir, name)) as f:
+            return [[int(p) for p in line.split()] for line in f]
+    except FileNotFoundError:
+        return []
+
+
+def all_dead(runs):
+    return not any(alive(pid) for run in runs for pid in run)
+
+
+def sent(fake):
+    return [p['text'] for _, m, p in fake.requests if m == 'sendMessage']
+
+
+async def main():
+    tmp = tempfile.mkdtemp(prefix="job-limits-")
+    bin_dir = os.path.join(tmp, "bin")
+    pid_dir = os.environ["PID_DIR"] = os.path.join(tmp, "pids")
+    os.mkdir(bin_dir)
+    os.mkdir(pid_dir)
+    with open(os.path.join(bin_dir, "opencode"), 'w') as f:
+        f.write(FAKE_OPENCODE)
+    os.chmod(os.path.join(bin_dir, "opencode"), 0o755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+    fake = FakeTelegram()
+    port = await fake.start()
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    bot.TELEGRAM_CLIENT = bot.TelegramClient(f"http://127.0.0.1:{port}")
+    bot.CHAT_SEND_RATE = bot.CHAT_SEND_BURST = bot.GLOBAL_SEND_RATE = 10 ** 6
+    bot.OUTBOX = bot.OutboundScheduler()
+    bot.TYPING_INTERVAL = 3600
+    bot.MEMORY_STORE = bot.MemoryStore(0, "", 100, 3600)
+    bot.SCHEDULER = bot.JobScheduler()
+    bot.PROCESS_STOP_TIMEOUT = 0.5
+
+    async def retry_sleep(delay):
+        # 重试前的 2 秒等待缩短，加快检查
+        await original_sleep(min(delay, 0.05))
+    original_sleep = asyncio.sleep
+
+    # 看门狗: 没有输出超过 JOB_IDLE_TIMEOUT 就结束进程组并重试，重试用完后报告超时
+    bot.JOB_IDLE_TIMEOUT = 0.5
+    bot.JOB_TIMEOUT = 60
+    asyncio.sleep = retry_sleep
+    start = time.monotonic()
+    await bot.run_opencode("hang", 1, max_retries=1)
+    elapsed = time.monotonic() - start
+    asyncio.sleep = original_sleep
+    runs = starts(pid_dir, "hang")
+    assert len(runs) == 2, runs
+    assert all_dead(runs)
+    assert any(t.startswith("❌ 执行超时 (0.5 秒没有任何输出)") for t in sent(fake)), sent(fake)
+    print(f"无输出看门狗: 2 次尝试都被结束，用时 {elapsed:.1f}s")
+
+    # 总时间上限: 一直有输出也会在到期时结束，且不再重试
+    bot.JOB_IDLE_TIMEOUT = 60
+    bot.JOB_TIMEOUT = 1
+    start = time.monotonic()
+    await bot.run_opencode("trickle", 2, max_retries=2)
+    elapsed = time.monotonic() - start
+    runs = starts(pid_dir, "trickle")
+    assert len(runs) == 1 and all_dead(runs), runs
+    assert 1 <= elapsed < 3, elapsed
+    print(f"总时间上限: {elapsed:.1f}s 后结束，没有重试")
+
+    # /cancel: 取消运行中的任务，结束进程组，队列中的下一个任务接着执行
+    bot.JOB_TIMEOUT = 60
+    update_id = 0
+
+    def send(text):
+        nonlocal update_id
+        update_id += 1
+        bot.handle_update({"update_id": update_id, "message": {"chat": {"id": 3}, "text": text}})
+
+    send("hang cancel me")
+    send("trickle next")
+    while not starts(pid_dir, "hang") or len(starts(pid_dir, "hang")) < 3:
+        await asyncio.sleep(0.01)
+    start = time.monotonic()
+    send("/cancel")
+    while not starts(pid_dir, "trickle") or len(starts(pid_dir, "trickle")) < 2:
+        await asyncio.sleep(0.01)
+    elapsed = time.monotonic() - start
+    assert all_dead(starts(pid_dir, "hang"))
+    assert bot.SCHEDULER.running[3].text == "trickle next"
+    await asyncio.sleep(0.2)
+    assert any(t.startswith("🛑 已取消: hang cancel me") for t in sent(fake)), sent(fake)
+    print(f"/cancel: {elapsed * 1000:.0f} ms 内结束进程组，开始执行排队的任务")
+
+    bot.SCHEDULER.cancel(3)
+    while bot.SCHEDULER.running:
+        await asyncio.sleep(0.01)
+    assert all_dead(starts(pid_dir, "trickle"))
+    send("/cancel")
+    await asyncio.sleep(0.1)
+    assert sent(fake)[-1] == "当前没有运行中的任务"
+
+    bot.TELEGRAM_CLIENT.close()
+    await asyncio.sleep(0.05)
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+对比 live progress (原地编辑) 与逐条发送两种模式下，一个任务产生的 Bot API 调用数
+
+运行: python3 bench/check_live_progress.py
+"""
+
+import os
+import sys
+import asyncio
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import telegram_opencode_bot as bot
+from fake_telegram import FakeTelegram
+
+# 40 次工具调用 (开始 + 完成)，穿插文本输出，总长超过一条消息的上限
+FAKE_OPENCODE = """#!/bin/sh
+echo '{"type": "step_start", "part": {}}'
+for i in $(seq 1 40); do
+  echo '{"type": "tool_use", "part": {"tool": "bash", "state": {"status": "running"}}}'
+  echo '{"type": "tool_use", "part": {"tool": "bash", "state": {"status": "completed", "output": "'$(printf 'x%.0s' $(seq 1 120))'"}}}'
+  echo '{"type": "text", "part": {"type": "text", "text": "step '$i' done. "}}'
+  sleep 0.02
+done
+"""
+
+
+async def run_job(fake, live):
+    bot.LIVE_PROGRESS = live
+    fake.requests.clear()
+    await bot.run_opencode("busy job", 1, max_retries=0)
+    calls = [m for _, m, _ in fake.requests if m != 'sendChatAction']
+    return calls
+
+
+async def main():
+    fake = FakeTelegram()
+    port = await fake.start()
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    bot.TELEGRAM_CLIENT = bot.TelegramClient(f"http://127.0.0.1:{port}")
+    # 只比较调用次数，放开限速
+    bot.CHAT_SEND_RATE = bot.CHAT_SEND_BURST = bot.GLOBAL_SEND_RATE = 10 ** 6
+    bot.OUTBOX = bot.OutboundScheduler()
+    bot.LIVE_PROGRESS_INTERVAL = 0.5
+
+    bin_dir = tempfile.mkdtemp(prefix="fake-opencode-")
+    with open(os.path.join(bin_dir, "opencode"), 'w') as f:
+        f.write(FAKE_OPENCODE)
+    os.chmod(os.path.join(bin_dir, "opencode"), 0o755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+    legacy = await run_job(fake, live=False)
+    live = await run_job(fake, live=True)
+    sends = live.count('sendMessage')
+    edits = live.count('editMessageText')
+    print(f"逐条发送: {len(legacy)} 次 API 调用")
+    print(f"live progress: {len(live)} 次 API 调用 ({sends} 次 sendMessage，{edits} 次 editMessageText)")
+
+    texts = [p['text'] for _, m, p in fake.requests if m in ('sendMessage', 'editMessageText')]
+    assert all(len(t) <= bot.MAX_MESSAGE_LENGTH for t in texts)
+    assert sends >= 3, "内容超过上限时应另起新消息"
+    assert len(live) * 10 <= len(legacy), "API 调用应减少一个数量级"
+
+    bot.TELEGRAM_CLIENT.close()
+    await asyncio.sleep(0.05)
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+日志: 调用方耗时 (旧的每行 open/close 对比队列 + 后台线程)、批量写入、按大小/时间轮转、级别过滤
+
+运行: python3 bench/check_logging.py [行数]
+"""
+
+import os
+import sys
+import time
+import tempfile
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+import telegram_opencode_bot as bot
+
+LINE = "发送数据: " + "x" * 200
+
+
+def old_log(path, msg):
+    """原来的实现: 每行打开、追加、关闭一次文件"""
+    timestamp = datetime.now().strftime("%H:%M:%S")
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(f"{timestamp} {msg}\n")
+
+
+def count_lines(paths):
+    total = 0
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                total += sum(1 for _ in f)
+    return total
+
+
+def main(lines):
+    tmp = tempfile.mkdtemp(prefix="log-")
+
+    path = os.path.join(tmp, "old.log")
+    start = time.perf_counter()
+    for _ in range(lines):
+        old_log(path, LINE)
+    old_us = (time.perf_counter() - start) / lines * 1e6
+
+    path = os.path.join(tmp, "new.log")
+    bot.LOG_WRITER = bot.LogWriter(path, 10 ** 9, 3600, 3, stdout=False)
+    start = time.perf_counter()
+    for _ in range(lines):
+        bot.log(LINE)
+    new_us = (time.perf_counter() - start) / lines * 1e6
+    bot.LOG_WRITER.close()
+    assert count_lines([path]) == lines
+    print(f"{lines} 行: 每行 open/close {old_us:.1f} us/行，队列 {new_us:.1f} us/行 (调用方耗时)")
+
+    # 级别过滤: info 级别下 debug 日志直接返回
+    bot.LOG_WRITER = bot.LogWriter(os.path.join(tmp, "level.log"), 10 ** 9, 3600, 3, stdout=False)
+    bot.LOG_LEVEL = bot.INFO
+    start = time.perf_counter()
+    for _ in range(lines):
+        bot.log(LINE, bot.DEBUG)
+    debug_us = (time.perf_counter() - start) / lines * 1e6
+    bot.log("info line")
+    bot.LOG_WRITER.close()
+    assert count_lines([os.path.join(tmp, "level.log")]) == 1
+    print(f"被过滤的 debug 日志 {debug_us:.2f} us/行")
+
+    # 按大小轮转: 每个文件不超过上限，只保留 3 个旧文件
+    path = os.path.join(tmp, "size.log")
+    bot.LOG_WRITER = bot.LogWriter(path, 64 * 1024, 3600, 3, stdout=False)
+    for i in range(5000):
+        bot.log(f"{i} {LINE}")
+        if i % 500 == 0:
+            time.sleep(0.01)  # 让写线程分几批写
+    bot.LOG_WRITER.close()
+    files = sorted(f for f in os.listdir(tmp) if f.startswith("size.log"))
+    assert files == ["size.log", "size.log.1", "size.log.2", "size.log.3"], files
+    print(f"按大小轮转: {', '.join(files)}")
+
+    # 按时间轮转
+    path = os.path.join(tmp, "time.log")
+    bot.LOG_WRITER = bot.LogWriter(path, 10 ** 9, 0.05, 3, stdout=False)
+    bot.log("first")
+    time.sleep(0.1)
+    bot.log("second")
+    time.sleep(0.1)
+    bot.LOG_WRITER.close()
+    assert count_lines([path]) == 1 and count_lines([path + ".1"]) == 1
+    print("按时间轮转: time.log, time.log.1")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
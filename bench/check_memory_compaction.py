@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+记忆压缩: 对话越来越长、结果越来越大时，带记忆的 prompt 始终在 token 预算以内，
+压缩结果缓存后重复构建 prompt 不再重新计算
+
+运行: python3 bench/check_memory_compaction.py [轮数]
+"""
+
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+import telegram_opencode_bot as bot
+
+
+def old_prompt(memory, user_text):
+    """原来的 build_prompt_with_memory: 每轮完整拼接"""
+    memory_context = "\n\n".join([f"上一轮任务: {m['task']}\n上一轮结果: {m['result']}" for m in memory])
+    return f"{memory_context}\n\n当前任务: {user_text}，配置文件在 /Users/jiancao/env.txt"
+
+
+def main(rounds):
+    bot.log = lambda msg, level=bot.INFO: None
+
+    # 估算器: 中文按字、英文按 4 个字符
+    assert bot.estimate_tokens("查询数据库") == 5
+    assert bot.estimate_tokens("a" * 400) == 100
+    assert bot.shorten("x" * 50 + "结论", 30).endswith("结论")
+
+    # 小记忆原样保留
+    bot.MEMORY_STORE = bot.MemoryStore(rounds, "", 100, 3600)
+    bot.MEMORY_STORE.save(1, "查表", "5 条记录")
+    assert bot.build_prompt_with_memory("继续", 1).startswith("上一轮任务: 查表\n上一轮结果: 5 条记录\n\n当前任务: 继续")
+
+    # 每轮结果 30 KB (日志、表格)，最后一行是结论
+    for i in range(rounds):
+        result = f"第 {i} 轮输出\n" + "| id | name | value |\n" * 1500 + f"第 {i} 轮结论"
+        bot.MEMORY_STORE.save(2, f"任务 {i}: 分析 locations 表", result)
+    memory = bot.MEMORY_STORE.rounds(2)
+
+    old = old_prompt(memory, "继续")
+    start = time.perf_counter()
+    new = bot.build_prompt_with_memory("继续", 2)
+    first = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(100):
+        assert bot.build_prompt_with_memory("继续", 2) == new
+    cached = (time.perf_counter() - start) / 100
+
+    print(f"{rounds} 轮记忆: 原来 {len(old) / 1024:.0f} KB / 约 {bot.estimate_tokens(old)} token，"
+          f"压缩后 {len(new) / 1024:.1f} KB / 约 {bot.estimate_tokens(new)} token (预算 {bot.MEMORY_TOKEN_BUDGET})")
+    print(f"构建 prompt: 首次 {first * 1000:.2f} ms，缓存后 {cached * 1000:.3f} ms")
+    assert bot.estimate_tokens(new) <= bot.MEMORY_TOKEN_BUDGET + bot.estimate_tokens("\n\n当前任务: 继续，配置文件在 /Users/jiancao/env.txt") + rounds
+    # 最近一轮的结论一定在
+    assert f"第 {rounds - 1} 轮结论" in new
+    assert cached < first
+
+    # 对话再长，prompt 大小不变
+    for i in range(rounds, rounds * 3):
+        bot.MEMORY_STORE.save(2, f"任务 {i}", "输出\n" * 20000 + f"第 {i} 轮结论")
+        assert bot.estimate_tokens(bot.build_prompt_with_memory("继续", 2)) < bot.MEMORY_TOKEN_BUDGET + 100
+    print("OK")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+对话记忆: 每个聊天的环形缓冲、重启后保留、空闲聊天移出内存，以及大量聊天时的内存和读写耗时
+
+运行: python3 bench/check_memory_store.py [聊天数]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+import telegram_opencode_bot as bot
+
+ROUNDS = 5
+RESULT = "查询结果 " * 200  # 约 2 KB 一轮
+
+
+def old_save(memory, chat_id, task, result):
+    """原来的 save_to_memory: 全局 dict，每次写入重建切片"""
+    if chat_id not in memory:
+        memory[chat_id] = []
+    memory[chat_id].append({"task": task, "result": result})
+    if len(memory[chat_id]) > ROUNDS:
+        memory[chat_id] = memory[chat_id][-ROUNDS:]
+
+
+def fill(save, chats):
+    start = time.perf_counter()
+    for i in range(ROUNDS + 2):
+        for chat_id in range(chats):
+            save(chat_id, f"任务 {i}", f"{RESULT}{i}")
+    return (time.perf_counter() - start) / (chats * (ROUNDS + 2))
+
+
+def main(chats):
+    bot.log = lambda msg, level=bot.INFO: None
+    db_path = os.path.join(tempfile.mkdtemp(prefix="memory-"), "memory.db")
+
+    # 环形缓冲: 写 7 轮只留最后 5 轮，表中每个聊天最多 5 行
+    store = bot.MemoryStore(ROUNDS, db_path, 100, 3600)
+    for i in range(7):
+        store.save(42, f"任务 {i}", f"结果 {i}")
+    assert [m["task"] for m in store.rounds(42)] == [f"任务 {i}" for i in range(2, 7)]
+    rows = store.db.execute("SELECT COUNT(*) FROM memory WHERE chat_id = 42").fetchone()[0]
+    assert rows == ROUNDS, rows
+
+    # 重启: 新的 MemoryStore 从同一个文件读出同样的记忆，继续写入时覆盖最旧的一轮
+    store.close()
+    store = bot.MemoryStore(ROUNDS, db_path, 100, 3600)
+    assert [m["task"] for m in store.rounds(42)] == [f"任务 {i}" for i in range(2, 7)]
+    store.save(42, "任务 7", "结果 7")
+    assert [m["task"] for m in store.rounds(42)] == [f"任务 {i}" for i in range(3, 8)]
+    print("环形缓冲和重启后保留: OK")
+
+    # 清除后数据库里也没有了
+    store.clear(42)
+    store.close()
+    store = bot.MemoryStore(ROUNDS, db_path, 100, 3600)
+    assert store.rounds(42) == []
+
+    # 空闲的聊天移出内存缓存，再次读取从数据库加载
+    store.idle = 0.05
+    store.save(1, "a", "b")
+    time.sleep(0.1)
+    store.rounds(2)
+    assert 1 not in store.cache and store.rounds(1)[0]["task"] == "a"
+    store.close()
+    print("空闲聊天移出内存: OK")
+
+    # 大量聊天: 原来的 dict 常驻全部记忆，新的只缓存最近的聊天
+    tracemalloc.start()
+    memory = {}
+    old_per_save = fill(lambda c, t, r: old_save(memory, c, t, r), chats)
+    old_bytes = tracemalloc.get_traced_memory()[0]
+    del memory
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    store = bot.MemoryStore(ROUNDS, db_path, bot.MEMORY_CACHE_CHATS, 3600)
+    new_per_save = fill(store.save, chats)
+    new_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"{chats} 个聊天 × {ROUNDS} 轮: 原来的 dict {old_bytes / 1024 / 1024:.0f} MB，"
+          f"MemoryStore {new_bytes / 1024 / 1024:.1f} MB (缓存 {len(store.cache)} 个聊天)")
+    print(f"每次写入: 原来 {old_per_save * 1e6:.1f} us，MemoryStore {new_per_save * 1e6:.1f} us")
+    assert new_bytes < old_bytes / 4
+
+    # 不在缓存里的聊天按主键读取
+    start = time.perf_counter()
+    for chat_id in range(0, chats, 7):
+        store.cache.pop(chat_id, None)
+        assert len(store.rounds(chat_id)) == ROUNDS
+    reads = len(range(0, chats, 7))
+    print(f"缓存未命中的读取: 每次 {(time.perf_counter() - start) / reads * 1e6:.0f} us")
+    rows = store.db.execute("SELECT COUNT(*) FROM memory").fetchone()[0]
+    assert rows == chats * ROUNDS, rows
+    store.close()
+    print("OK")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+检查 /metrics: 通过 webhook 提交任务 (fake opencode + 假 Telegram，注入一次 429)，
+然后从 asyncio HTTP 服务读取指标，核对任务、Telegram 请求、消息数和队列等数值；
+并测量记一次指标的开销
+
+运行: python3 bench/check_metrics.py [任务数]
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import telegram_opencode_bot as bot
+from fake_telegram import FakeTelegram
+
+SAMPLE_RE = re.compile(r'^([a-z_]+)(\{[^}]*\})? (\S+)$')
+
+
+async def http(port, method, path, body=b""):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: bot\r\nContent-Length: {len(body)}\r\n"
+                 f"Connection: close\r\n\r\n".encode() + body)
+    data = await reader.read()
+    writer.close()
+    head, _, payload = data.partition(b"\r\n\r\n")
+    return int(head.split()[1]), head.decode('latin-1'), payload.decode('utf-8')
+
+
+def parse(text):
+    """{(名字, 标签文本): 值}，同时检查每个样本都有 TYPE 声明"""
+    samples = {}
+    declared = set()
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            declared.add(line.split()[2])
+            continue
+        if line.startswith("#") or not line:
+            continue
+        match = SAMPLE_RE.match(line)
+        assert match, line
+        name, labels, value = match.groups()
+        assert re.sub(r'_(bucket|sum|count)$', '', name) in declared or name in declared, line
+        samples[(name, labels or "")] = float(value)
+    return samples
+
+
+async def main(jobs):
+    bin_dir = tempfile.mkdtemp(prefix="fake-opencode-")
+    os.symlink(os.path.join(BENCH_DIR, "fake_opencode.py"), os.path.join(bin_dir, "opencode"))
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    os.environ['FAKE_OPENCODE_BOOT'] = "0.05"
+
+    fake = FakeTelegram(latency=0.01)
+    tg_port = await fake.start()
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    bot.TELEGRAM_CLIENT = bot.TelegramClient(f"http://127.0.0.1:{tg_port}")
+    bot.CHAT_SEND_RATE = bot.CHAT_SEND_BURST = bot.GLOBAL_SEND_RATE = 10 ** 6
+    bot.OUTBOX = bot.OutboundScheduler()
+    bot.TYPING_INTERVAL = 3600
+    bot.MEMORY_STORE = bot.MemoryStore(0, "", 100, 3600)
+    bot.SCHEDULER = bot.JobScheduler()
+    bot.MAX_WORKERS = jobs
+    bot.METRICS = bot.Metrics()
+    server = await asyncio.start_server(bot.handle_http, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    fake.flood_next[1] = 0.05  # 第一个聊天的第一个请求返回 429
+    for i in range(jobs):
+        update = {"update_id": 5000 + i, "message": {"chat": {"id": 1 + i}, "text": f"任务 {i}"}}
+        status, _, _ = await http(port, "POST", "/webhook", json.dumps(update).encode())
+        assert status == 200
+    await http(port, "POST", "/webhook", json.dumps(update).encode())  # 重发的 update
+    await http(port, "GET", "/nope")
+
+    # 运行中可以看到任务数
+    status, head, text = await http(port, "GET", "/metrics")
+    assert status == 200 and "text/plain; version=0.0.4" in head
+    running = parse(text)[("opencode_bot_jobs_running", "")]
+    while bot.SCHEDULER.running or bot.OUTBOX.pending():
+        await asyncio.sleep(0.02)
+
+    _, _, text = await http(port, "GET", "/metrics")
+    samples = parse(text)
+
+    def value(name, labels=""):
+        return samples.get((name, labels), 0)
+
+    sends = fake.count("sendMessage") + fake.count("editMessageText")
+    ok = value("opencode_bot_jobs_total", '{outcome="ok"}')
+    requests = sum(v for (name, _), v in samples.items() if name == "opencode_bot_telegram_requests_total")
+    print(f"运行中 {running:.0f} 个任务；结束后: 任务 {ok:.0f}，Bot API 请求 {requests:.0f}，"
+          f"429 {value('opencode_bot_telegram_rate_limited_total'):.0f}，消息 {sends}")
+    assert running > 0
+    assert value("opencode_bot_updates_total") == jobs + 1
+    assert value("opencode_bot_updates_duplicate_total") == 1
+    assert value("opencode_bot_jobs_total", '{outcome="ok"}') == jobs
+    assert value("opencode_bot_job_duration_seconds_count", '{outcome="ok"}') == jobs
+    assert value("opencode_bot_job_first_event_seconds_count") == jobs
+    assert value("opencode_bot_job_first_event_seconds_bucket", '{le="+Inf"}') == jobs
+    assert value("opencode_bot_job_messages_count") == jobs
+    # 全部任务同时运行 (没有排队回复)，发出的每条消息都归到某个任务
+    assert value("opencode_bot_job_messages_sum") == value("opencode_bot_messages_sent_total", '{method="sendMessage"}') \
+        + value("opencode_bot_messages_sent_total", '{method="editMessageText"}') == sends
+    assert value("opencode_bot_telegram_rate_limited_total") == 1
+    assert value("opencode_bot_telegram_requests_total", '{method="sendMessage",code="429"}') == 1
+    assert value("opencode_bot_telegram_request_seconds_count", '{method="sendMessage"}') == fake.count("sendMessage") + 1  # 假 Telegram 不记录返回 429 的请求
+    assert value("opencode_bot_stream_bytes_total") > 0
+    assert value("opencode_bot_http_requests_total", '{path="/webhook",code="200"}') == jobs + 1
+    assert value("opencode_bot_http_requests_total", '{path="other",code="404"}') == 1
+    assert value("opencode_bot_jobs_running") == 0 and value("opencode_bot_jobs_queued") == 0
+    p50 = value("opencode_bot_job_first_event_seconds_sum") / jobs
+    print(f"平均首个事件 {p50 * 1000:.0f} ms，每个任务平均 {value('opencode_bot_job_messages_sum') / jobs:.1f} 条消息")
+
+    # 记一次指标的开销
+    metrics = bot.Metrics()
+    labels = (("method", "sendMessage"), ("code", 200))
+    n = 200000
+    start = time.perf_counter()
+    for _ in range(n):
+        metrics.inc("opencode_bot_telegram_requests_total", 1, labels)
+        metrics.observe("opencode_bot_telegram_request_seconds", 0.03, (("method", "sendMessage"),))
+    per = (time.perf_counter() - start) / n
+    print(f"一次计数加一次直方图: {per * 1e6:.2f} us")
+
+    server.close()
+    bot.TELEGRAM_CLIENT.close()
+    await asyncio.sleep(0.05)
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20))
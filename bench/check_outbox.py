@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+检查发送调度器: 聊天之间并行、单聊天限速、严格遵守 429 的 retry_after
+
+运行: python3 bench/check_outbox.py
+"""
+
+import os
+import sys
+import time
+import asyncio
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import telegram_opencode_bot as bot
+from fake_telegram import FakeTelegram
+
+
+def sent_times(fake, chat_id):
+    return [t for t, m, p in fake.requests if m == 'sendMessage' and p.get('chat_id') == chat_id]
+
+
+async def main():
+    fake = FakeTelegram()
+    port = await fake.start()
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    bot.TELEGRAM_CLIENT = bot.TelegramClient(f"http://127.0.0.1:{port}")
+
+    # 聊天 1 第一条消息被 429 (retry_after=2)，聊天 2 不受影响
+    fake.flood_next[1] = 2
+    start = time.monotonic()
+    await asyncio.gather(
+        bot.send_message(1, "flooded"),
+        *(bot.send_message(2, f"msg {i}") for i in range(5)),
+    )
+    chat1 = sent_times(fake, 1)
+    chat2 = sent_times(fake, 2)
+    assert len(chat1) == 1 and len(chat2) == 5
+    delay1 = chat1[0] - start
+    assert 2.0 <= delay1 < 2.5, delay1
+    print(f"429 retry_after=2: 聊天 1 在 {delay1:.2f}s 后重发成功")
+
+    # 聊天 2: 前 CHAT_SEND_BURST 条立即发送，之后约每秒一条
+    first = chat2[bot.CHAT_SEND_BURST - 1] - start
+    gaps = [b - a for a, b in zip(chat2[bot.CHAT_SEND_BURST - 1:], chat2[bot.CHAT_SEND_BURST:])]
+    assert first < 0.5, first
+    assert all(0.9 <= g <= 1.2 for g in gaps), gaps
+    assert chat2[0] - start < 0.5, "聊天 2 不应等待聊天 1 的 429"
+    print(f"聊天 2: 突发 {bot.CHAT_SEND_BURST} 条用时 {first:.2f}s，之后间隔 {', '.join(f'{g:.2f}' for g in gaps)}s")
+
+    # 全局令牌桶: 100 个聊天各发一条，整体不超过 GLOBAL_SEND_RATE/s
+    fake.requests.clear()
+    start = time.monotonic()
+    await asyncio.gather(*(bot.send_message(1000 + i, "hi") for i in range(100)))
+    elapsed = time.monotonic() - start
+    expected = (100 - bot.GLOBAL_SEND_RATE) / bot.GLOBAL_SEND_RATE
+    assert elapsed >= expected * 0.95, elapsed
+    print(f"100 个聊天各 1 条: {elapsed:.2f}s (全局 {bot.GLOBAL_SEND_RATE}/s)")
+
+    bot.TELEGRAM_CLIENT.close()
+    await asyncio.sleep(0.05)
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+检查 getUpdates 长轮询: 批量取 update、offset 持久化、重启后不重复处理
+
+运行: python3 bench/check_polling.py
+"""
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import telegram_opencode_bot as bot
+from fake_telegram import FakeTelegram
+
+
+def message(chat_id, text):
+    return {"message": {"chat": {"id": chat_id}, "text": text}}
+
+
+async def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("等待超时")
+        await asyncio.sleep(0.01)
+
+
+async def main():
+    fake = FakeTelegram()
+    port = await fake.start()
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    bot.TELEGRAM_CLIENT = bot.TelegramClient(f"http://127.0.0.1:{port}")
+    bot.CHAT_SEND_RATE = bot.CHAT_SEND_BURST = bot.GLOBAL_SEND_RATE = 10 ** 6
+    bot.OUTBOX = bot.OutboundScheduler()
+    bot.POLL_TIMEOUT = 1
+    bot.POLL_OFFSET_FILE = os.path.join(tempfile.mkdtemp(prefix="poll-"), "offset")
+
+    submitted = []
+    bot.SCHEDULER.submit = lambda chat_id, text: submitted.append(text) or 0
+
+    # 积压 250 个 update (一半命令一半任务)，应该 3 次 getUpdates 取完
+    for i in range(250):
+        fake.push_update(message(1 + i % 10, "/help" if i % 2 else f"task {i}"))
+    poller = bot.spawn(bot.poll_updates())
+    await wait_for(lambda: len(submitted) == 125)
+    batches = fake.count('getUpdates')
+    assert batches <= 4, batches
+    await wait_for(lambda: bot.load_poll_offset() == 251)
+    print(f"250 个积压 update: {batches} 次 getUpdates，offset 已保存为 {bot.load_poll_offset()}")
+
+    # 新 update 通过长轮询立即送达
+    start = time.monotonic()
+    fake.push_update(message(1, "live task"))
+    await wait_for(lambda: submitted[-1] == "live task")
+    print(f"长轮询中的新 update {(time.monotonic() - start) * 1000:.0f} ms 后开始处理")
+
+    # 模拟重启: 清空去重缓存，只靠保存的 offset，已处理的 update 不会重复
+    poller.cancel()
+    await asyncio.sleep(0.05)
+    bot.UPDATE_DEDUP = bot.UpdateDeduplicator(100, 60)
+    fake.push_update(message(2, "after restart"))
+    poller = bot.spawn(bot.poll_updates())
+    await wait_for(lambda: submitted[-1] == "after restart")
+    await asyncio.sleep(0.2)
+    assert len(submitted) == 127 and len(set(submitted)) == 127, len(submitted)
+    assert fake.count('deleteWebhook') == 2
+    print("重启后从保存的 offset 继续，没有重复处理")
+
+    poller.cancel()
+    bot.TELEGRAM_CLIENT.close()
+    await asyncio.sleep(0.05)
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
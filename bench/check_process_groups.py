@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+检查任务的进程组清理: 一个任务结束时只清理它自己的进程 (包括后台孙进程)，
+不影响其他聊天正在运行的任务；忽略 SIGTERM 的进程超时后被 SIGKILL；全程不启动 shell
+
+运行: python3 bench/check_process_groups.py
+"""
+
+import os
+import sys
+import time
+import signal
+import asyncio
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import telegram_opencode_bot as bot
+from fake_telegram import FakeTelegram
+
+# 启动一个后台孙进程 (类似 opencode 拉起的 MCP 服务)，pid 写到 PID_DIR/<任务名>；
+# prompt 含 slow 时运行 1.5 秒，含 stubborn 时孙进程忽略 SIGTERM
+FAKE_OPENCODE = r"""#!/usr/bin/env python3
+import json, os, subprocess, sys, time
+prompt = sys.argv[-1]
+name = prompt.split()[0]
+code = "import signal, time\n"
+if "stubborn" in prompt:
+    code += "signal.signal(signal.SIGTERM, signal.SIG_IGN)\n"
+code += "time.sleep(1000)\n"
+child = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+with open(os.path.join(os.environ["PID_DIR"], name), "w") as f:
+    f.write(f"{os.getpid()} {child.pid}")
+time.sleep(1.5 if "slow" in prompt else 0.1)
+sys.stdout.write(json.dumps({"type": "text", "part": {"type": "text", "text": "done " + name}}) + "\n")
+"""
+
+
+def alive(pid):
+    """进程存在且不是僵尸"""
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            return f.read().rpartition(b')')[2].split()[0] != b'Z'
+    except OSError:
+        try:
+            os.kill(pid, 0)
+            return True
+        except ProcessLookupError:
+            return False
+
+
+def pids(pid_dir, name):
+    with open(os.path.join(pid_dir, name)) as f:
+        return [int(p) for p in f.read().split()]
+
+
+async def wait_file(path):
+    while not os.path.exists(path):
+        await asyncio.sleep(0.01)
+
+
+async def old_kill_leftover_processes():
+    """原来的清理: 每次通过 shell 执行全局 pkill"""
+    proc = await asyncio.create_subprocess_shell(
+        "pkill -f 'opencode-bench-never-matches.*run --format'",
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    await proc.wait()
+
+
+async def main():
+    tmp = tempfile.mkdtemp(prefix="process-groups-")
+    bin_dir = os.path.join(tmp, "bin")
+    pid_dir = os.environ["PID_DIR"] = os.path.join(tmp, "pids")
+    os.mkdir(bin_dir)
+    os.mkdir(pid_dir)
+    with open(os.path.join(bin_dir, "opencode"), 'w') as f:
+        f.write(FAKE_OPENCODE)
+    os.chmod(os.path.join(bin_dir, "opencode"), 0o755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+    fake = FakeTelegram()
+    port = await fake.start()
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    bot.TELEGRAM_CLIENT = bot.TelegramClient(f"http://127.0.0.1:{port}")
+    bot.CHAT_SEND_RATE = bot.CHAT_SEND_BURST = bot.GLOBAL_SEND_RATE = 10 ** 6
+    bot.OUTBOX = bot.OutboundScheduler()
+    bot.TYPING_INTERVAL = 3600
+    bot.MEMORY_STORE = bot.MemoryStore(0, "", 100, 3600)
+    bot.PROCESS_STOP_TIMEOUT = 0.5
+
+    def no_shell(*args, **kwargs):
+        raise AssertionError("不应启动 shell")
+    create_shell = asyncio.create_subprocess_shell
+    asyncio.create_subprocess_shell = no_shell
+
+    # 两个聊天同时运行: 快的任务结束时，慢的任务和它的孙进程都还在
+    slow = asyncio.ensure_future(bot.run_opencode("b slow", 2, max_retries=0))
+    await wait_file(os.path.join(pid_dir, "b"))
+    await bot.run_opencode("a", 1, max_retries=0)
+    a_opencode, a_child = pids(pid_dir, "a")
+    b_opencode, b_child = pids(pid_dir, "b")
+    assert not alive(a_child), "任务结束后它的孙进程应被清理"
+    assert alive(b_opencode) and alive(b_child), "不应影响其他聊天正在运行的任务"
+    print("任务 a 结束: a 的孙进程已清理，任务 b 仍在运行")
+    await slow
+    assert not alive(b_child)
+    print("任务 b 结束: b 的孙进程已清理")
+
+    # 孙进程忽略 SIGTERM: 等 PROCESS_STOP_TIMEOUT 后 SIGKILL
+    start = time.monotonic()
+    await bot.run_opencode("c stubborn", 3, max_retries=0)
+    elapsed = time.monotonic() - start
+    _, c_child = pids(pid_dir, "c")
+    assert not alive(c_child)
+    assert elapsed >= bot.PROCESS_STOP_TIMEOUT
+    print(f"忽略 SIGTERM 的孙进程在 {elapsed:.2f}s 后被 SIGKILL")
+    asyncio.create_subprocess_shell = create_shell
+
+    # 清理开销: 原来每次 fork 一个 shell 执行 pkill，现在只给自己的进程组发信号
+    rounds = 50
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await old_kill_leftover_processes()
+    old = (time.perf_counter() - start) / rounds
+    new_total = 0.0
+    for _ in range(rounds):
+        process = await asyncio.create_subprocess_exec("true", start_new_session=True)
+        await process.wait()
+        t = time.perf_counter()
+        await bot.stop_process(process)
+        new_total += time.perf_counter() - t
+    print(f"每次清理: 原来 shell + pkill {old * 1000:.1f} ms，进程组信号 {new_total / rounds * 1e6:.0f} us")
+
+    bot.TELEGRAM_CLIENT.close()
+    await asyncio.sleep(0.05)
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+检查最终结果在读取输出时累积: 完成消息带最后一步的回答和工具统计，记忆里保存同样的内容，
+大量工具输出不会在内存里再留一份
+
+运行: python3 bench/check_run_result.py
+"""
+
+import os
+import sys
+import asyncio
+import tempfile
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import telegram_opencode_bot as bot
+from fake_telegram import FakeTelegram
+
+# 两个步骤: 第一步 200 次工具调用，每次 256 KB 输出 (共 50 MB)；第二步给出回答，
+# 同一个 text part 先发一半再发完整内容
+FAKE_OPENCODE = r"""#!/usr/bin/env python3
+import json, sys
+def emit(event):
+    sys.stdout.write(json.dumps(event) + "\n")
+emit({"type": "step_start", "part": {}})
+emit({"type": "text", "part": {"id": "p1", "type": "text", "text": "先看看配置。"}})
+big = "x" * (256 * 1024)
+for i in range(200):
+    tool = "bash" if i % 4 else "read"
+    emit({"type": "tool_use", "part": {"tool": tool, "state": {"status": "running"}}})
+    emit({"type": "tool_use", "part": {"tool": tool, "state": {"status": "completed", "output": big}}})
+emit({"type": "step_finish", "part": {"reason": "tool-calls"}})
+emit({"type": "step_start", "part": {}})
+emit({"type": "text", "part": {"id": "p2", "type": "text", "text": "查询完成，共"}})
+emit({"type": "text", "part": {"id": "p2", "type": "text", "text": "查询完成，共 5 条记录。"}})
+emit({"type": "step_finish", "part": {"reason": "stop"}})
+print("not json trailer")
+"""
+
+
+async def main():
+    fake = FakeTelegram()
+    port = await fake.start()
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    bot.TELEGRAM_CLIENT = bot.TelegramClient(f"http://127.0.0.1:{port}")
+    bot.CHAT_SEND_RATE = bot.CHAT_SEND_BURST = bot.GLOBAL_SEND_RATE = 10 ** 6
+    bot.OUTBOX = bot.OutboundScheduler()
+    bot.TYPING_INTERVAL = 3600
+    bot.MEMORY_STORE = bot.MemoryStore(3, "", 100, 3600)
+
+    bin_dir = tempfile.mkdtemp(prefix="fake-opencode-")
+    with open(os.path.join(bin_dir, "opencode"), 'w') as f:
+        f.write(FAKE_OPENCODE)
+    os.chmod(os.path.join(bin_dir, "opencode"), 0o755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+    tracemalloc.start()
+    await bot.run_opencode("查询 locations 表", 1, max_retries=0)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    texts = [p['text'] for _, m, p in fake.requests if m == 'sendMessage']
+    final = texts[-1]
+    print(f"完成消息: {final!r}")
+    assert final.startswith("✅ 执行完成 (2 个步骤，200 次工具调用 (bash×150, read×50))"), final
+    assert final.endswith("查询完成，共 5 条记录。"), final
+    assert bot.MEMORY_STORE.rounds(1)[-1]["result"] == "查询完成，共 5 条记录。"
+    print(f"50 MB 工具输出，Python 分配峰值 {peak / 1024 / 1024:.1f} MB")
+    assert peak < 8 * 1024 * 1024
+
+    bot.TELEGRAM_CLIENT.close()
+    await asyncio.sleep(0.05)
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+检查任务调度: 全局并发上限、同一聊天依次执行、排队位置与队列上限
+
+运行: python3 bench/check_scheduler.py
+"""
+
+import os
+import sys
+import asyncio
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+import telegram_opencode_bot as bot
+
+
+async def main():
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    bot.MAX_WORKERS = 2
+    bot.CHAT_QUEUE_LIMIT = 3
+
+    running = set()
+    peak = {"global": 0}
+    order = []
+
+    async def fake_run(prompt, chat_id, original_prompt=None, **kwargs):
+        assert chat_id not in running, "同一聊天不应并发执行"
+        running.add(chat_id)
+        peak["global"] = max(peak["global"], len(running))
+        order.append((chat_id, original_prompt))
+        await asyncio.sleep(0.05)
+        running.discard(chat_id)
+
+    bot.run_opencode = fake_run
+    scheduler = bot.JobScheduler()
+
+    assert scheduler.submit(1, "a1") == 0  # 立即开始
+    assert scheduler.submit(2, "b1") == 0  # 立即开始
+    assert scheduler.submit(3, "c1") == 1  # 等一个空位
+    assert scheduler.submit(1, "a2") == 1  # 等 a1
+    assert scheduler.submit(1, "a3") == 2
+    assert scheduler.submit(1, "a4") == 3
+    assert scheduler.submit(1, "a5") is None  # 聊天 1 已排队 3 个
+    print(scheduler.status_text(1))
+
+    while scheduler.running or scheduler.queues:
+        await asyncio.sleep(0.01)
+
+    assert peak["global"] == 2, peak
+    assert [t for c, t in order if c == 1] == ["a1", "a2", "a3", "a4"]
+    assert len(order) == 6
+    print(f"执行顺序: {', '.join(t for _, t in order)}，最高并发 {peak['global']}")
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
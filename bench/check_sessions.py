@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+opencode 会话续用: 后续任务用 --session 续用同一会话，不再重复发送记忆文本；
+检查过期、分叉、/newsession 和重启后继续使用
+
+使用 bench/fake_opencode.py 作为 opencode，从它记录的参数判断每个任务怎样执行。
+
+运行: python3 bench/check_sessions.py [轮数]
+"""
+
+import os
+import sys
+import json
+import asyncio
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import telegram_opencode_bot as bot
+from fake_telegram import FakeTelegram
+
+CHAT = 7
+
+
+def read_runs(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+async def turn(path, text):
+    """提交一个任务并等它执行完，返回 fake opencode 记录的这次调用"""
+    before = len(read_runs(path)) if os.path.exists(path) else 0
+    assert bot.SCHEDULER.submit(CHAT, text) == 0
+    while bot.SCHEDULER.running:
+        await asyncio.sleep(0.01)
+    runs = read_runs(path)
+    assert len(runs) == before + 1
+    return runs[-1]
+
+
+def command(text):
+    bot.handle_update({"update_id": None, "message": {"chat": {"id": CHAT}, "text": text}})
+
+
+async def prompt_bytes(path, turns):
+    total = 0
+    for i in range(turns):
+        total += len((await turn(path, f"第 {i} 步: 继续分析 locations 表"))["prompt"].encode())
+    return total / turns
+
+
+async def main(turns):
+    tmp = tempfile.mkdtemp(prefix="sessions-")
+    bin_dir = os.path.join(tmp, "bin")
+    os.mkdir(bin_dir)
+    os.symlink(os.path.join(BENCH_DIR, "fake_opencode.py"), os.path.join(bin_dir, "opencode"))
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    os.environ['FAKE_OPENCODE_BOOT'] = "0"
+    log_path = os.environ['FAKE_OPENCODE_LOG'] = os.path.join(tmp, "runs.jsonl")
+
+    fake = FakeTelegram()
+    port = await fake.start()
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    bot.TELEGRAM_CLIENT = bot.TelegramClient(f"http://127.0.0.1:{port}")
+    bot.CHAT_SEND_RATE = bot.CHAT_SEND_BURST = bot.GLOBAL_SEND_RATE = 10 ** 6
+    bot.OUTBOX = bot.OutboundScheduler()
+    bot.TYPING_INTERVAL = 3600
+    bot.SCHEDULER = bot.JobScheduler()
+    db_path = os.path.join(tmp, "memory.db")
+    bot.MEMORY_STORE = bot.MemoryStore(5, db_path, 100, 3600)
+
+    first = await turn(log_path, "查询 locations 表")
+    assert "session" not in first["options"]
+    session_a = first["session"]
+
+    # 第二轮续用会话，prompt 里不再带上一轮的内容
+    second = await turn(log_path, "只看前 5 条")
+    assert second["options"]["session"] == session_a and "fork" not in second["options"]
+    assert "上一轮任务" not in second["prompt"]
+    print(f"续用会话: {session_a}")
+
+    # /fork: 下一个任务分叉出新会话，之后续用新会话
+    command("/fork")
+    forked = await turn(log_path, "换一种写法")
+    assert forked["options"]["session"] == session_a and forked["options"]["fork"] is True
+    session_b = forked["session"]
+    assert session_b != session_a
+    after_fork = await turn(log_path, "继续")
+    assert after_fork["options"]["session"] == session_b and "fork" not in after_fork["options"]
+    print(f"分叉: {session_a} -> {session_b}")
+
+    # 重启后从数据库读出会话
+    bot.MEMORY_STORE.close()
+    bot.MEMORY_STORE = bot.MemoryStore(5, db_path, 100, 3600)
+    restarted = await turn(log_path, "重启后继续")
+    assert restarted["options"]["session"] == session_b
+    print("重启后续用同一会话: OK")
+
+    # /newsession: 新会话，上下文退回记忆文本
+    command("/newsession")
+    fresh = await turn(log_path, "重新开始")
+    assert "session" not in fresh["options"] and "上一轮任务: 重启后继续" in fresh["prompt"]
+
+    # 空闲超过 OPENCODE_SESSION_TTL 的会话不再续用
+    bot.OPENCODE_SESSION_TTL = 0.05
+    await asyncio.sleep(0.1)
+    expired = await turn(log_path, "过了很久")
+    assert "session" not in expired["options"]
+    print("/newsession 和过期: OK")
+
+    # 每轮发送的 prompt 大小: 不续用会话时记忆文本越积越多
+    bot.OPENCODE_SESSION_TTL = 0
+    bot.MEMORY_STORE.clear(CHAT)
+    stateless = await prompt_bytes(log_path, turns)
+    bot.OPENCODE_SESSION_TTL = 3600
+    bot.MEMORY_STORE.clear(CHAT)
+    with_session = await prompt_bytes(log_path, turns)
+    print(f"{turns} 轮平均 prompt: 每轮发送记忆 {stateless:.0f} 字节，续用会话 {with_session:.0f} 字节")
+    assert with_session < stateless / 2
+
+    bot.MEMORY_STORE.close()
+    bot.TELEGRAM_CLIENT.close()
+    await asyncio.sleep(0.05)
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+检查快照清理: 按存放时间和总大小删除，运行中任务正在用的快照不删，删除在线程池里执行；
+对比原来每个目录一个 rm -rf 子进程的耗时
+
+运行: python3 bench/check_snapshot_gc.py [目录数]
+"""
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+import telegram_opencode_bot as bot
+
+MB = 1024 * 1024
+
+
+def make_snapshot(root, name, size, age):
+    """一个快照仓库: 几层目录和若干文件，整体修改时间设为 age 秒之前"""
+    path = os.path.join(root, name)
+    objects = os.path.join(path, "objects", "ab")
+    os.makedirs(objects)
+    with open(os.path.join(objects, "blob"), 'wb') as f:
+        f.write(b"x" * size)
+    with open(os.path.join(path, "HEAD"), 'w') as f:
+        f.write("ref: refs/heads/main\n")
+    stamp = time.time() - age
+    for dirpath, _, files in os.walk(path):
+        for name in files:
+            os.utime(os.path.join(dirpath, name), (stamp, stamp))
+        os.utime(dirpath, (stamp, stamp))
+    return path
+
+
+async def old_cleanup(snapshot_dir):
+    """原来 run_opencode 结尾的清理: 每个子目录一个 rm -rf 子进程，依次等待"""
+    for item in os.listdir(snapshot_dir):
+        item_path = os.path.join(snapshot_dir, item)
+        if os.path.isdir(item_path):
+            rm = await asyncio.create_subprocess_exec(
+                "rm", "-rf", item_path,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            await rm.wait()
+
+
+async def main(count):
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    root = tempfile.mkdtemp(prefix="snapshot-")
+    hour = 3600
+
+    # 预算 11 MB、最多 24 小时: old 过期；共 19 MB 超出预算，从最旧的 a、b 开始删；
+    # live 是运行中任务开始之后改动的，虽然最大也不删
+    gc = bot.SnapshotGC(root, 11 * MB, 24 * hour, 3600)
+    make_snapshot(root, "old", 1 * MB, 48 * hour)
+    make_snapshot(root, "a", 4 * MB, 3 * hour)
+    make_snapshot(root, "b", 4 * MB, 2 * hour)
+    make_snapshot(root, "c", 4 * MB, 1 * hour)
+    token = gc.job_started()
+    make_snapshot(root, "live", 6 * MB, 0)
+
+    deleted, freed = await gc.collect()
+    remaining = sorted(os.listdir(root))
+    print(f"删除 {deleted} 个，释放 {freed / MB:.0f} MB，剩余 {remaining}")
+    assert remaining == ["c", "live"], remaining
+
+    # 任务结束后 live 不再受保护；预算降到 7 MB，按时间顺序先删更旧的 c
+    gc.job_finished(token)
+    gc.max_bytes = 7 * MB
+    await gc.collect()
+    remaining = sorted(os.listdir(root))
+    assert remaining == ["live"], remaining
+    print(f"任务结束后: 剩余 {remaining}")
+
+    # 预算内且未过期的快照不删
+    gc.max_bytes = 11 * MB
+    make_snapshot(root, "fresh", 1 * MB, 0)
+    assert await gc.collect() == (0, 0)
+
+    # 清理期间事件循环不被阻塞
+    for i in range(count):
+        make_snapshot(root, f"n{i}", 64 * 1024, 48 * hour)
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.001)
+            ticks += 1
+
+    tick_task = asyncio.ensure_future(ticker())
+    start = time.perf_counter()
+    deleted, _ = await gc.collect()
+    new = time.perf_counter() - start
+    tick_task.cancel()
+    assert deleted == count
+    print(f"{count} 个过期快照: 线程池清理 {new * 1000:.0f} ms，期间事件循环运行 {ticks} 次")
+    assert ticks > 0
+
+    old_root = tempfile.mkdtemp(prefix="snapshot-old-")
+    for i in range(count):
+        make_snapshot(old_root, f"n{i}", 64 * 1024, 48 * hour)
+    start = time.perf_counter()
+    await old_cleanup(old_root)
+    old = time.perf_counter() - start
+    print(f"原来每个目录一个 rm -rf: {old * 1000:.0f} ms (任务完成前同步等待)")
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200))
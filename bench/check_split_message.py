@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+消息分割: UTF-16 长度上限、断点优先级 (段落 > 换行 > 句末)、不拆字素簇，
+以及大文本上与原来的 split_message 的耗时对比
+
+运行: python3 bench/check_split_message.py [MB]
+"""
+
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+import telegram_opencode_bot as bot
+
+LIMIT = bot.MAX_MESSAGE_LENGTH
+
+
+def old_split_message(text):
+    """原来的实现"""
+    if len(text) <= LIMIT:
+        return [text]
+    messages = []
+    while len(text) > LIMIT:
+        split_pos = text[:LIMIT].rfind('\n')
+        if split_pos == -1:
+            split_pos = LIMIT
+        messages.append(text[:split_pos])
+        text = text[split_pos:]
+    if text:
+        messages.append(text)
+    return messages
+
+
+def check(text, name):
+    chunks = list(bot.split_message(text))
+    assert "".join(chunks) == text or "".join(chunks) == text.strip(), f"{name}: 内容丢失"
+    for chunk in chunks:
+        assert bot.utf16_len(chunk) <= LIMIT, f"{name}: {bot.utf16_len(chunk)} 码元超限"
+    for i in range(1, len(chunks)):
+        cut = sum(len(c) for c in chunks[:i])
+        assert bot.is_grapheme_boundary(text, cut), f"{name}: 在字素簇中间切开 ({text[cut - 2:cut + 2]!r})"
+    return chunks
+
+
+def check_rules():
+    # 段落优先于换行和句子
+    text = ("第一段句子。" * 420) + "\n\n" + ("第二段。\n" * 300)
+    chunks = check(text, "段落")
+    assert chunks[0].endswith("\n\n"), repr(chunks[0][-10:])
+
+    # 没有段落时在换行处切
+    text = "一行内容，没有空行。\n" * 800
+    chunks = check(text, "换行")
+    assert all(c.endswith("\n") for c in chunks[:-1])
+
+    # 只有句子时在句末切
+    text = "This is a sentence. " * 500
+    chunks = check(text, "句子")
+    assert all(c.endswith(". ") for c in chunks[:-1])
+    text = "这是一句话。" * 1500
+    chunks = check(text, "中文句子")
+    assert all(c.endswith("。") for c in chunks[:-1])
+
+    # emoji 在 UTF-16 中占 2 个码元: 原来的实现按码点计数，会超出 4096
+    text = "😀" * 3000
+    assert bot.utf16_len(old_split_message(text)[0]) > 4096
+    check(text, "emoji")
+
+    # 带肤色、ZWJ 的 emoji 序列和国旗、组合字符都不会被拆开
+    for unit, name in (("👩🏽‍💻", "ZWJ 序列"), ("🇨🇳", "国旗"), ("é", "组合字符"), ("❤️", "变体选择符")):
+        for offset in range(5):
+            check("x" * offset + unit * 2000, name)
+    print("断点优先级、UTF-16 上限、字素簇检查通过")
+
+
+def bench(mb):
+    line = "第 {i} 行: 执行了一些命令，输出如下 😀 some ascii text here.\n"
+    text = "".join(line.format(i=i) for i in range(mb * 1024 * 1024 // len(line.encode('utf-8'))))
+    for name, fn in (("原来的 split_message", old_split_message),
+                     ("新 split_message", lambda t: list(bot.split_message(t)))):
+        start = time.perf_counter()
+        chunks = fn(text)
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {len(text.encode('utf-8')) / 1024 / 1024:.0f} MB 文本 {elapsed * 1000:.0f} ms，{len(chunks)} 条")
+
+
+if __name__ == "__main__":
+    check_rules()
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 8)
+    print("OK")
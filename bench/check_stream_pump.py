@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+检查 opencode 输出读取: stderr 大量输出不会卡住子进程，超长行被丢弃，事件按行即时处理
+
+运行: python3 bench/check_stream_pump.py
+"""
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import telegram_opencode_bot as bot
+from fake_telegram import FakeTelegram
+
+# 先往 stderr 写 4 MB (远超管道缓冲)，再输出一个超长行和正常事件
+FAKE_OPENCODE = """#!/bin/sh
+yes 'stderr noise line' | head -c 4000000 >&2
+echo '{"type": "step_start", "part": {}}'
+head -c 300000 /dev/zero | tr '\\0' 'x'; echo
+printf '{"type": "text", "part": {"type": "text", "text": "done"}}'
+"""
+
+
+def check_splitter():
+    splitter = bot.LineSplitter(max_line=10)
+    assert splitter.feed(b'{"a"') == []
+    assert splitter.feed(b': 1}\n{"b": 2}\n{"c"') == [b'{"a": 1}', b'{"b": 2}']
+    assert splitter.feed(b'0123456789abcdef') == []  # 超长，开始丢弃
+    assert splitter.feed(b'ghij\nok\n') == [b'ok']
+    assert splitter.feed(b'tail') == []
+    assert splitter.finish() == [b'tail']
+    print("LineSplitter: 跨块拼行、超长行丢弃、结尾无换行 OK")
+
+
+async def main():
+    check_splitter()
+
+    fake = FakeTelegram()
+    port = await fake.start()
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    bot.TELEGRAM_CLIENT = bot.TelegramClient(f"http://127.0.0.1:{port}")
+    bot.STREAM_LIMIT = 100000
+
+    bin_dir = tempfile.mkdtemp(prefix="fake-opencode-")
+    with open(os.path.join(bin_dir, "opencode"), 'w') as f:
+        f.write(FAKE_OPENCODE)
+    os.chmod(os.path.join(bin_dir, "opencode"), 0o755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+    start = time.monotonic()
+    await asyncio.wait_for(bot.run_opencode("noisy", 1, max_retries=0), 30)
+    texts = [p.get('text', '') for _, m, p in fake.requests if m in ('sendMessage', 'editMessageText')]
+    assert any('开始新步骤' in t for t in texts), texts
+    assert any('done' in t for t in texts), texts
+    print(f"stderr 写入 4 MB 的任务在 {time.monotonic() - start:.1f}s 内正常结束，事件全部送达")
+
+    bot.TELEGRAM_CLIENT.close()
+    await asyncio.sleep(0.05)
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+检查 TelegramClient 连接池的行为 (本地 keep-alive 服务，无需外网)
+
+运行: python3 bench/check_telegram_pool.py
+"""
+
+import os
+import sys
+import json
+import socket
+import struct
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import telegram_opencode_bot as bot
+
+
+class FakeServer:
+    """极简 keep-alive 服务: 统计连接数与请求数，可以按需截断响应"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.connections = 0
+        self.requests = 0
+        self.truncate_next = False
+        self.reset_next_reuse = False
+        self.server = None
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        served = 0
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                length = 0
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b''):
+                        break
+                    if header.lower().startswith(b'content-length:'):
+                        length = int(header.split(b':')[1])
+                await reader.readexactly(length)
+                if served and self.reset_next_reuse:
+                    # 模拟 NAT/LB 回收空闲连接: 不处理请求，直接 RST
+                    self.reset_next_reuse = False
+                    sock = writer.get_extra_info('socket')
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                    break
+                served += 1
+                self.requests += 1
+                await asyncio.sleep(self.delay)
+                body = json.dumps({"ok": True, "result": {"message_id": self.requests}}).encode()
+                head = f"HTTP/1.1 200 OK\r\nContent-Length: {len(body)}\r\n\r\n".encode()
+                if self.truncate_next:
+                    # 响应体只发一半就断开
+                    self.truncate_next = False
+                    writer.write(head + body[:len(body) // 2])
+                    await writer.drain()
+                    break
+                writer.write(head + body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # 关闭事件循环时取消的连接也算正常结束
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+
+async def main():
+    server = FakeServer(delay=0.05)
+    port = await server.start()
+    client = bot.TelegramClient(f"http://127.0.0.1:{port}")
+    key = client._key()
+
+    # 顺序调用只用一条连接
+    for _ in range(5):
+        await client.request("sendMessage", {"chat_id": 1, "text": "hi"})
+    assert server.connections == 1, server.connections
+    print(f"顺序 5 次调用: {server.connections} 条连接")
+
+    # 并发调用各自开连接，空闲连接最多保留 TELEGRAM_MAX_IDLE 条
+    await asyncio.gather(*(client.request("sendMessage", {"chat_id": i, "text": "hi"}) for i in range(20)))
+    idle = len(client.idle.get(key, []))
+    assert server.connections == 20, server.connections
+    assert idle <= bot.TELEGRAM_MAX_IDLE, idle
+    print(f"并发 20 次调用: 共 {server.connections} 条连接，空闲保留 {idle} 条")
+
+    # 响应被截断时不能重发 (否则用户会收到重复消息)
+    requests_before = server.requests
+    server.truncate_next = True
+    try:
+        await client.request("sendMessage", {"chat_id": 1, "text": "once"})
+        raise AssertionError("截断的响应应当抛出异常")
+    except asyncio.IncompleteReadError:
+        pass
+    assert server.requests == requests_before + 1, server.requests - requests_before
+    print("截断响应: 没有重发")
+
+    # 空闲连接被服务端关闭后，新请求自动换连接
+    for _, writer, _ in client.idle.get(key, []):
+        writer.transport.abort()
+    server.server.close()
+    server2 = FakeServer()
+    server2.server = await asyncio.start_server(server2.handle, '127.0.0.1', port)
+    await client.request("sendMessage", {"chat_id": 1, "text": "after close"})
+    assert server2.requests == 1, server2.requests
+    print("空闲连接失效: 自动换新连接")
+
+    # 空闲连接被重置 (RST) 同样换新连接
+    await client.request("sendMessage", {"chat_id": 1, "text": "warm"})
+    server2.reset_next_reuse = True
+    before = server2.requests
+    await client.request("sendMessage", {"chat_id": 1, "text": "after reset"})
+    assert server2.requests == before + 1, server2.requests - before
+    print("空闲连接被重置: 自动换新连接")
+
+    # 等待连接名额的时间也受 timeout 约束
+    slow = FakeServer(delay=1.0)
+    slow_port = await slow.start()
+    slow_client = bot.TelegramClient(f"http://127.0.0.1:{slow_port}")
+    saved = bot.TELEGRAM_MAX_CONNECTIONS
+    bot.TELEGRAM_MAX_CONNECTIONS = 1
+    try:
+        hold = asyncio.ensure_future(slow_client.request("sendMessage", {"chat_id": 1, "text": "slow"}))
+        await asyncio.sleep(0.05)
+        try:
+            await slow_client.request("sendChatAction", {"chat_id": 1, "action": "typing"}, timeout=0.2)
+            raise AssertionError("排队等待应当超时")
+        except asyncio.TimeoutError:
+            pass
+        await hold
+    finally:
+        bot.TELEGRAM_MAX_CONNECTIONS = saved
+    slow_client.close()
+    print("连接名额排队: timeout 生效")
+
+    client.close()
+    await asyncio.sleep(0.05)
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+检查任务时间线: 通过 webhook 提交任务 (fake opencode + 假 Telegram，注入一次 429)，
+从 /jobs/<id>/trace 读取时间线，核对进程启动、首个事件、步骤、工具调用配对和每次发送；
+再看 /jobs/tools 的工具耗时分位数和 TRACE_FILE 里写下的 JSON lines
+
+运行: python3 bench/check_trace.py [任务数]
+"""
+
+import os
+import sys
+import json
+import asyncio
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import telegram_opencode_bot as bot
+from fake_telegram import FakeTelegram
+from check_metrics import http
+
+TOOL_SECONDS = 0.2
+
+
+async def main(jobs):
+    bin_dir = tempfile.mkdtemp(prefix="fake-opencode-")
+    os.symlink(os.path.join(BENCH_DIR, "fake_opencode.py"), os.path.join(bin_dir, "opencode"))
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    os.environ['FAKE_OPENCODE_BOOT'] = "0.05"
+    os.environ['FAKE_OPENCODE_TOOL'] = str(TOOL_SECONDS)
+    trace_file = os.path.join(tempfile.mkdtemp(prefix="trace-"), "trace.jsonl")
+
+    fake = FakeTelegram(latency=0.01)
+    tg_port = await fake.start()
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    bot.TELEGRAM_CLIENT = bot.TelegramClient(f"http://127.0.0.1:{tg_port}")
+    bot.CHAT_SEND_RATE = bot.CHAT_SEND_BURST = bot.GLOBAL_SEND_RATE = 10 ** 6
+    bot.OUTBOX = bot.OutboundScheduler()
+    bot.TYPING_INTERVAL = 3600
+    bot.MEMORY_STORE = bot.MemoryStore(0, "", 100, 3600)
+    bot.SCHEDULER = bot.JobScheduler()
+    bot.MAX_WORKERS = jobs
+    bot.TRACES = bot.TraceStore(trace_file, 100, 1000)
+    server = await asyncio.start_server(bot.handle_http, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    fake.flood_next[1] = 0.05  # 第一个聊天的第一个请求返回 429
+    first_id = bot.Job._next_id
+    for i in range(jobs):
+        update = {"update_id": 7000 + i, "message": {"chat": {"id": 1 + i}, "text": f"任务 {i}"}}
+        status, _, _ = await http(port, "POST", "/webhook", json.dumps(update).encode())
+        assert status == 200
+
+    # 运行中的任务可以看到已有的部分
+    await asyncio.sleep(0.02)
+    status, head, text = await http(port, "GET", f"/jobs/{first_id}/trace")
+    assert status == 200 and "application/x-ndjson" in head, head
+    assert json.loads(text.splitlines()[0])["event"] == "start"
+    while bot.SCHEDULER.running or bot.OUTBOX.pending():
+        await asyncio.sleep(0.02)
+
+    sends = 0
+    for job_id in range(first_id, first_id + jobs):
+        status, _, text = await http(port, "GET", f"/jobs/{job_id}/trace")
+        assert status == 200
+        events = [json.loads(line) for line in text.splitlines()]
+        names = [e["event"] for e in events]
+        assert names[0] == "start" and names[-1] == "end" and events[-1]["outcome"] == "ok", names
+        assert names.index("spawn") < names.index("first_event") < names.index("step_start") \
+            < names.index("tool_start") < names.index("tool_end") < names.index("exit"), names
+        assert all(e["job"] == job_id for e in events)
+        assert [e["t"] for e in events] == sorted(e["t"] for e in events)
+        tool = next(e for e in events if e["event"] == "tool_end")
+        assert tool["tool"] == "read" and tool["call"] == "call_1"
+        assert TOOL_SECONDS <= tool["seconds"] < TOOL_SECONDS + 0.2, tool
+        job_sends = [e for e in events if e["event"] == "send"]
+        assert all(e["seconds"] >= 0 and e["wait"] >= 0 for e in job_sends)
+        sends += len(job_sends)
+        if job_id == first_id:
+            timeline = events
+    codes = [e["code"] for e in timeline if e["event"] == "send"]
+    assert codes[0] == 429 and codes.count(429) == 1, codes
+
+    # 任务期间的每次 Bot API 请求都记在时间线里 (假 Telegram 不记录返回 429 的请求)
+    assert sends == fake.count() + 1, (sends, fake.count())
+    print(f"{jobs} 个任务，时间线里共 {sends} 次发送；第一个任务:")
+    for e in timeline:
+        detail = {k: v for k, v in e.items() if k not in ("job", "t", "event")}
+        print(f"  {e['t']:7.3f}s {e['event']:<11} {detail if detail else ''}")
+
+    status, _, text = await http(port, "GET", "/jobs/tools")
+    stats = json.loads(text)
+    print(f"工具耗时: {stats}")
+    assert stats["read"]["calls"] == jobs
+    assert TOOL_SECONDS <= stats["read"]["p50"] <= stats["read"]["p99"] < TOOL_SECONDS + 0.2
+
+    status, _, _ = await http(port, "GET", f"/jobs/{first_id + jobs + 100}/trace")
+    assert status == 404
+    status, _, _ = await http(port, "GET", "/jobs/abc/trace")
+    assert status == 404
+
+    # 文件里的 JSON lines 与接口返回的一致
+    bot.TRACES.close()
+    with open(trace_file, encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == sum(len(bot.TRACES.get(j).lines) for j in range(first_id, first_id + jobs))
+    print(f"{trace_file}: {len(lines)} 行")
+
+    server.close()
+    bot.TELEGRAM_CLIENT.close()
+    await asyncio.sleep(0.05)
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+检查 "正在输入" 心跳: 同一聊天的多个任务共用一个心跳，按 TYPING_INTERVAL 发送，任务结束即停止
+
+运行: python3 bench/check_typing.py
+"""
+
+import os
+import sys
+import asyncio
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import telegram_opencode_bot as bot
+from fake_telegram import FakeTelegram
+
+# 快速输出 200 个事件后静默 3 秒
+FAKE_OPENCODE = """#!/bin/sh
+for i in $(seq 1 200); do
+  echo '{"type": "text", "part": {"type": "text", "text": "x"}}'
+done
+sleep 3
+"""
+
+
+async def main():
+    fake = FakeTelegram()
+    port = await fake.start()
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    bot.TELEGRAM_CLIENT = bot.TelegramClient(f"http://127.0.0.1:{port}")
+    bot.TYPING_INTERVAL = 1
+
+    bin_dir = tempfile.mkdtemp(prefix="fake-opencode-")
+    with open(os.path.join(bin_dir, "opencode"), 'w') as f:
+        f.write(FAKE_OPENCODE)
+    os.chmod(os.path.join(bin_dir, "opencode"), 0o755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+    # 同一聊天两个任务并发
+    await asyncio.gather(
+        bot.run_opencode("a", 1, max_retries=0),
+        bot.run_opencode("b", 1, max_retries=0),
+    )
+    typing = fake.count('sendChatAction')
+    print(f"2 个任务、400 个事件、约 3 秒: {typing} 次 sendChatAction")
+    assert 2 <= typing <= 6, typing
+
+    await asyncio.sleep(2.5)
+    assert fake.count('sendChatAction') == typing, "任务结束后心跳应停止"
+    assert not bot.TYPING.tasks
+    print("任务结束后心跳停止")
+
+    bot.TELEGRAM_CLIENT.close()
+    await asyncio.sleep(0.05)
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
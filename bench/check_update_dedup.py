@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+检查 update_id 去重: 重发的 update 不会再启动任务，内存有界、过期淘汰，SQLite 模式重启后依然去重
+
+运行: python3 bench/check_update_dedup.py
+"""
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+import telegram_opencode_bot as bot
+
+
+def message(update_id, chat_id, text):
+    return {"update_id": update_id, "message": {"chat": {"id": chat_id}, "text": text}}
+
+
+async def main():
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.BOT_LOOP = asyncio.get_running_loop()
+
+    # 同一个任务消息送达三次，只启动一个任务
+    submitted = []
+    bot.SCHEDULER.submit = lambda chat_id, text: submitted.append((chat_id, text)) or 0
+    bot.UPDATE_DEDUP = bot.UpdateDeduplicator(100, 60)
+    for _ in range(3):
+        bot.handle_update(message(7, 1, "写一个脚本"))
+    bot.handle_update(message(8, 1, "另一个任务"))
+    assert submitted == [(1, "写一个脚本"), (1, "另一个任务")], submitted
+    assert bot.UPDATE_DEDUP.duplicates == 2
+    print(f"重复送达 3 次只启动 1 个任务，重复计数 {bot.UPDATE_DEDUP.duplicates}")
+
+    # 容量有界: 最久没出现的 update_id 先被淘汰
+    dedup = bot.UpdateDeduplicator(3, 60)
+    for update_id in (1, 2, 3):
+        dedup.seen(update_id)
+    assert dedup.seen(1)  # 刷新 1
+    dedup.seen(4)  # 淘汰 2
+    assert len(dedup.recent) == 3
+    assert not dedup.seen(2)
+    print("容量上限: 按最近收到的顺序淘汰")
+
+    # 过期淘汰
+    dedup = bot.UpdateDeduplicator(100, 0.05)
+    dedup.seen(1)
+    time.sleep(0.1)
+    assert not dedup.seen(1)
+    print("过期的 update_id 不再拦截")
+
+    # SQLite 模式: 新实例 (模拟重启) 依然识别之前的 update_id
+    db_path = os.path.join(tempfile.mkdtemp(prefix="dedup-"), "updates.db")
+    first = bot.UpdateDeduplicator(100, 60, db_path)
+    for update_id in range(1000, 1100):
+        assert not first.seen(update_id)
+    first.db.close()
+    restarted = bot.UpdateDeduplicator(100, 60, db_path)
+    assert restarted.seen(1050)
+    assert not restarted.seen(2000)
+    print("SQLite 模式: 重启后依然去重")
+
+    start = time.perf_counter()
+    for update_id in range(100000, 110000):
+        restarted.seen(update_id)
+    per_update = (time.perf_counter() - start) / 10000 * 1e6
+    print(f"SQLite 模式每个 update {per_update:.0f} us")
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+常驻 opencode 进程池: 对比冷启动与 --attach 的首个事件延迟，检查用满重启与健康检查
+
+使用 bench/fake_opencode.py 作为 opencode (启动耗时由 FAKE_OPENCODE_BOOT 模拟)。
+
+运行: python3 bench/check_warm_pool.py [任务数]
+"""
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import telegram_opencode_bot as bot
+from fake_telegram import FakeTelegram
+
+
+def install_fake_opencode():
+    bin_dir = tempfile.mkdtemp(prefix="fake-opencode-")
+    os.symlink(os.path.join(BENCH_DIR, "fake_opencode.py"), os.path.join(bin_dir, "opencode"))
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+
+async def first_event_latencies(jobs):
+    """依次执行任务，返回每个任务从开始到第一个 opencode 事件的秒数"""
+    latencies = []
+    first = {}
+    handle = bot.handle_stream_event
+
+    async def timed_handle(chat_id, event, content_buffer, state):
+        first.setdefault(chat_id, time.monotonic())
+        return await handle(chat_id, event, content_buffer, state)
+
+    bot.handle_stream_event = timed_handle
+    try:
+        for i in range(jobs):
+            chat_id = 1000 + i
+            start = time.monotonic()
+            await bot.run_opencode(f"job {i}", chat_id, max_retries=0)
+            latencies.append(first[chat_id] - start)
+    finally:
+        bot.handle_stream_event = handle
+    return latencies
+
+
+async def wait_state(pool, state, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(w.state == state for w in pool.workers):
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"常驻进程未进入 {state}: {[w.state for w in pool.workers]}")
+
+
+def summary(latencies):
+    ordered = sorted(latencies)
+    return f"p50 {ordered[len(ordered) // 2] * 1000:.0f} ms，最大 {ordered[-1] * 1000:.0f} ms"
+
+
+async def main(jobs):
+    install_fake_opencode()
+    fake = FakeTelegram()
+    port = await fake.start()
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    bot.TELEGRAM_CLIENT = bot.TelegramClient(f"http://127.0.0.1:{port}")
+    bot.CHAT_SEND_RATE = bot.CHAT_SEND_BURST = bot.GLOBAL_SEND_RATE = 10 ** 6
+    bot.OUTBOX = bot.OutboundScheduler()
+    bot.TYPING_INTERVAL = 3600
+    bot.OPENCODE_HEALTH_INTERVAL = 0.2
+
+    cold = await first_event_latencies(jobs)
+    print(f"冷启动: {summary(cold)}")
+
+    pool = bot.WarmPool(2, 24000 + os.getpid() % 10000)
+    bot.WARM_POOL = pool
+    pool.start()
+    await wait_state(pool, "idle")
+    pids = {w.port: w.process.pid for w in pool.workers}
+
+    warm = await first_event_latencies(jobs)
+    print(f"常驻进程: {summary(warm)}")
+    assert max(warm) < min(cold), "--attach 应明显快于冷启动"
+
+    # 依次执行的任务都落在第一个进程上，用满次数后应换新进程
+    first_worker = pool.workers[0]
+    bot.OPENCODE_WORKER_MAX_USES = first_worker.uses + 1
+    await first_event_latencies(1)
+    await wait_state(pool, "idle")
+    assert first_worker.process.pid != pids[first_worker.port], "用满次数后应重启"
+    print(f"用满 {bot.OPENCODE_WORKER_MAX_USES} 次后重启: pid {pids[first_worker.port]} -> {first_worker.process.pid}")
+
+    # 常驻进程被外部杀掉，健康检查应把它拉起来
+    victim = pool.workers[1]
+    old_pid = victim.process.pid
+    victim.process.kill()
+    await victim.process.wait()
+    await asyncio.sleep(0.3)
+    await wait_state(pool, "idle")
+    assert victim.process.pid != old_pid
+    print(f"健康检查失败后重启: pid {old_pid} -> {victim.process.pid}")
+
+    pool.health_task.cancel()
+    pool.kill_all()
+    bot.TELEGRAM_CLIENT.close()
+    await asyncio.sleep(0.05)
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 8))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+webhook 应答延迟: Telegram 很慢 (每个请求 0.3 秒) 时，webhook 依然立即返回 200
+
+压测客户端 (bench/webhook_driver.py) 运行在独立进程中，并发发送命令和任务消息；
+同时统计服务端 webhook 处理函数自身的耗时。
+
+运行: python3 bench/check_webhook_latency.py [请求数] [并发连接数]
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+import telegram_opencode_bot as bot
+from fake_telegram import FakeTelegram
+
+TELEGRAM_LATENCY = 0.3
+
+
+async def main(requests, concurrency):
+    fake = FakeTelegram(latency=TELEGRAM_LATENCY)
+    port = await fake.start()
+    bot.log = lambda msg, level=bot.INFO: None
+    bot.BOT_LOOP = asyncio.get_running_loop()
+    bot.TELEGRAM_CLIENT = bot.TelegramClient(f"http://127.0.0.1:{port}")
+    bot.TELEGRAM_MAX_CONNECTIONS = 1000
+    bot.CHAT_SEND_RATE = bot.CHAT_SEND_BURST = bot.GLOBAL_SEND_RATE = 10 ** 6
+    bot.OUTBOX = bot.OutboundScheduler()
+
+    async def fake_run(prompt, chat_id, original_prompt=None, **kwargs):
+        await asyncio.sleep(0.01)
+
+    bot.run_opencode = fake_run
+
+    # 服务端处理函数耗时 (解析 + 入队)
+    handler_times = []
+    webhook = bot.HTTP_ROUTES[("POST", "/webhook")]
+
+    async def timed_webhook(body):
+        start = time.perf_counter()
+        result = await webhook(body)
+        handler_times.append(time.perf_counter() - start)
+        return result
+
+    bot.HTTP_ROUTES[("POST", "/webhook")] = timed_webhook
+    server = await asyncio.start_server(bot.handle_http, '127.0.0.1', 0)
+    server_port = server.sockets[0].getsockname()[1]
+
+    driver = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(BENCH_DIR, "webhook_driver.py"),
+        "--url", f"http://127.0.0.1:{server_port}/webhook",
+        "--requests", str(requests), "--concurrency", str(concurrency),
+        "--texts", "/help,/status,/start,/nope,do something",
+        stdout=asyncio.subprocess.PIPE
+    )
+    stdout, _ = await driver.communicate()
+    result = json.loads(stdout)
+    ordered = sorted(handler_times)
+    handler_p99 = ordered[int(len(ordered) * 0.99)] * 1000
+    print(f"{result['requests']} 个请求，{concurrency} 个并发连接，Telegram 每次请求 {TELEGRAM_LATENCY * 1000:.0f} ms")
+    print(f"webhook 往返: p50 {result['p50_ms']} ms，p99 {result['p99_ms']} ms，最大 {result['max_ms']} ms，{result['rps']} 请求/秒")
+    print(f"webhook 处理函数: p99 {handler_p99:.3f} ms")
+
+    assert result['errors'] == 0
+    assert handler_p99 < 1, "处理函数只应解析和入队"
+    assert result['p99_ms'] < TELEGRAM_LATENCY * 1000, "应答不应等待 Telegram"
+
+    # 回复都已入队，最终都会发出 (4/5 的 update 是命令，每个回复一条)
+    deadline = time.monotonic() + 30
+    while bot.OUTBOX.pending() and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    assert fake.count('sendMessage') >= requests * 4 // 5, fake.count('sendMessage')
+    print(f"回复已全部发出: {fake.count('sendMessage')} 条 sendMessage")
+
+    server.close()
+    bot.TELEGRAM_CLIENT.close()
+    await asyncio.sleep(0.05)
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000,
+                     int(sys.argv[2]) if len(sys.argv) > 2 else 50))
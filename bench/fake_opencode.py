@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+假 opencode 命令，供 bench/ 下的脚本放进 PATH 使用 (以 opencode 为名建符号链接)
+
+支持的子命令:
+- opencode serve --hostname H --port P
+    模拟启动耗时后提供 HTTP 服务，任何 GET 都返回 200 (用作健康检查)
+- opencode run [--attach URL] [--session ID [--fork]] [--model M] [--format json] -- PROMPT
+    冷启动时模拟完整启动耗时；--attach 时先检查常驻进程可用，只付很小的连接耗时。
+    然后按 --format json 的格式逐行输出事件，每个事件带 sessionID (续用 --session 的 ID，
+    没有或 --fork 时生成新的)。设置 FAKE_OPENCODE_REPLAY 时重放录下的事件流，否则输出一组固定事件
+
+录制事件流: opencode run --format json -- "任务" > bench/streams/xxx.jsonl
+重放时按事件里的 timestamp (毫秒) 还原事件间隔，再除以 FAKE_OPENCODE_SPEED
+
+环境变量:
+- FAKE_OPENCODE_BOOT    冷启动 / serve 启动耗时，秒 (默认 1.0)
+- FAKE_OPENCODE_ATTACH  --attach 时的启动耗时，秒 (默认 0.05)
+- FAKE_OPENCODE_DELAY   两个事件之间的间隔，秒 (默认 0.01)
+- FAKE_OPENCODE_TOOL    工具调用 (running 到 completed) 额外耗时，秒 (默认 0)
+- FAKE_OPENCODE_LOG     非空时每次 run 把参数以一行 JSON 追加到该文件
+- FAKE_OPENCODE_REPLAY  录下的事件流文件 (JSON lines)，或放着多个 .jsonl 的目录 (按 prompt 固定选一个)
+- FAKE_OPENCODE_SPEED   重放速度倍数 (默认 1.0 按原速；0 表示不等待，尽快输出)
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import zlib
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BOOT = float(os.environ.get("FAKE_OPENCODE_BOOT", "1.0"))
+ATTACH = float(os.environ.get("FAKE_OPENCODE_ATTACH", "0.05"))
+DELAY = float(os.environ.get("FAKE_OPENCODE_DELAY", "0.01"))
+TOOL = float(os.environ.get("FAKE_OPENCODE_TOOL", "0"))
+REPLAY = os.environ.get("FAKE_OPENCODE_REPLAY", "")
+SPEED = float(os.environ.get("FAKE_OPENCODE_SPEED", "1.0"))
+LOG = os.environ.get("FAKE_OPENCODE_LOG", "")
+
+
+FLAGS = {"fork"}  # 不带值的选项
+
+
+def parse_args(args):
+    options = {}
+    rest = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == "--":
+            rest.extend(args[i + 1:])
+            break
+        if arg.startswith("--") and arg[2:] in FLAGS:
+            options[arg[2:]] = True
+            i += 1
+            continue
+        if arg.startswith("--"):
+            options[arg[2:]] = args[i + 1] if i + 1 < len(args) else ""
+            i += 2
+            continue
+        rest.append(arg)
+        i += 1
+    return options, rest
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps({"pid": os.getpid()}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(options):
+    time.sleep(BOOT)
+    server = ThreadingHTTPServer((options.get("hostname", "127.0.0.1"), int(options.get("port", 4096))), HealthHandler)
+    server.serve_forever()
+
+
+def emit(event, session_id):
+    event["sessionID"] = session_id
+    sys.stdout.write(json.dumps(event, ensure_ascii=False) + "\n")
+    sys.stdout.flush()
+
+
+def default_events(prompt):
+    """固定的一组事件，每个之后等待 FAKE_OPENCODE_DELAY 秒"""
+    for event in fixed_events(prompt):
+        yield event
+        time.sleep(DELAY)
+
+
+def fixed_events(prompt):
+    yield {"type": "step_start", "part": {"type": "step-start"}}
+    yield {"type": "tool_use", "part": {"tool": "read", "callID": "call_1", "state": {"status": "running"}}}
+    time.sleep(TOOL)
+    yield {"type": "tool_use", "part": {"tool": "read", "callID": "call_1", "state": {"status": "completed", "output": "ok"}}}
+    yield {"type": "text", "part": {"type": "text", "text": f"收到任务: {prompt[:200]}"}}
+    yield {"type": "step_finish", "part": {"type": "step-finish", "reason": "stop"}}
+
+
+def replay_file(prompt):
+    if not os.path.isdir(REPLAY):
+        return REPLAY
+    names = sorted(name for name in os.listdir(REPLAY) if name.endswith(".jsonl"))
+    if not names:
+        raise SystemExit(f"{REPLAY} 里没有 .jsonl 文件")
+    return os.path.join(REPLAY, names[zlib.crc32(prompt.encode("utf-8")) % len(names)])
+
+
+def replay_events(prompt):
+    """按录制时的间隔 (除以 SPEED) 重放事件流；非 JSON 行原样跳过"""
+    previous = None
+    with open(replay_file(prompt), encoding="utf-8") as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            stamp = event.get("timestamp")
+            if SPEED > 0 and isinstance(stamp, (int, float)):
+                if previous is not None and stamp > previous:
+                    time.sleep((stamp - previous) / 1000 / SPEED)
+                previous = stamp
+            yield event
+
+
+def run(options, rest):
+    if "attach" in options:
+        time.sleep(ATTACH)
+        try:
+            urllib.request.urlopen(options["attach"], timeout=2).read()
+        except OSError as e:
+            sys.stderr.write(f"无法连接 {options['attach']}: {e}\n")
+            return 1
+    else:
+        time.sleep(BOOT)
+    prompt = " ".join(rest)
+    session_id = options.get("session")
+    if not session_id or options.get("fork"):
+        session_id = f"ses_{uuid.uuid4().hex[:12]}"
+    if LOG:
+        with open(LOG, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"options": options, "prompt": prompt, "session": session_id}, ensure_ascii=False) + "\n")
+    events = replay_events(prompt) if REPLAY else default_events(prompt)
+    for event in events:
+        emit(event, session_id)
+    return 0
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.stderr.write("usage: opencode serve|run ...\n")
+        return 2
+    command = sys.argv[1]
+    options, rest = parse_args(sys.argv[2:])
+    if command == "serve":
+        serve(options)
+        return 0
+    if command == "run":
+        return run(options, rest)
+    sys.stderr.write(f"unknown command: {command}\n")
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+本地假 Telegram Bot API 服务 (asyncio，支持 keep-alive)
+
+- 记录每个请求 (时间、方法、参数)
+- 可注入延迟 (latency) 和 429 (flood_rate 随机 / flood_next 指定聊天)
+- sendMessage 返回自增 message_id，editMessageText 返回被编辑的消息
+- getUpdates 支持 offset 确认和长轮询，用 push_update() 放入待取的 update
+
+独立运行: python3 bench/fake_telegram.py --port 9901 --latency 0.05 --flood-rate 0.01
+然后启动 bot 时设置 TELEGRAM_API=http://127.0.0.1:9901
+"""
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+
+class FakeTelegram:
+
+    def __init__(self, latency=0.0, flood_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.flood_next = {}  # chat_id -> retry_after，该聊天的下一个请求返回 429
+        self.reject_entities = False  # True 时带 parse_mode 的请求都返回 400 (实体解析失败)
+        self.requests = []  # [(monotonic, method, payload), ...]
+        self.floods = 0
+        self.connections = 0
+        self.next_message_id = 1
+        self.updates = []  # 待 getUpdates 取走的 update
+        self.next_update_id = 1
+        self.update_event = None
+        self.server = None
+
+    def count(self, method=None):
+        return sum(1 for _, m, _ in self.requests if method is None or m == method)
+
+    def push_update(self, update):
+        """放入一个 update (没有 update_id 时自动编号)，唤醒正在长轮询的 getUpdates"""
+        if 'update_id' not in update:
+            update = dict(update, update_id=self.next_update_id)
+        self.next_update_id = max(self.next_update_id, update['update_id'] + 1)
+        self.updates.append(update)
+        if self.update_event is not None:
+            self.update_event.set()
+        return update['update_id']
+
+    async def get_updates(self, payload):
+        """getUpdates: 丢弃 offset 之前已确认的 update，没有新 update 时最多等待 timeout 秒"""
+        offset = payload.get('offset')
+        if offset:
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+        if not self.updates and payload.get('timeout'):
+            self.update_event = asyncio.Event()
+            try:
+                await asyncio.wait_for(self.update_event.wait(), payload['timeout'])
+            except asyncio.TimeoutError:
+                pass
+        self.requests.append((time.monotonic(), 'getUpdates', payload))
+        return 200, {"ok": True, "result": self.updates[:payload.get('limit', 100)]}
+
+    def respond(self, method, payload):
+        """返回 (状态码, 响应 dict)"""
+        chat_id = payload.get('chat_id')
+        retry_after = self.flood_next.pop(chat_id, None)
+        if retry_after is None and self.flood_rate and random.random() < self.flood_rate:
+            retry_after = self.retry_after
+        if retry_after is not None:
+            self.floods += 1
+            return 429, {
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {retry_after}",
+                "parameters": {"retry_after": retry_after},
+            }
+        if self.reject_entities and 'parse_mode' in payload:
+            return 400, {"ok": False, "error_code": 400,
+                         "description": "Bad Request: can't parse entities: unsupported start tag"}
+        self.requests.append((time.monotonic(), method, payload))
+        if method == 'sendMessage':
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            return 200, {"ok": True, "result": {
+                "message_id": message_id, "chat": {"id": chat_id}, "text": payload.get('text', ''),
+            }}
+        if method == 'editMessageText':
+            return 200, {"ok": True, "result": {
+                "message_id": payload.get('message_id'), "chat": {"id": chat_id}, "text": payload.get('text', ''),
+            }}
+        return 200, {"ok": True, "result": True}
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method = line.split()[1].decode('latin-1').rsplit('/', 1)[-1].split('?')[0]
+                length = 0
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b''):
+                        break
+                    if header.lower().startswith(b'content-length:'):
+                        length = int(header.split(b':')[1])
+                body = await reader.readexactly(length) if length else b''
+                payload = json.loads(body) if body else {}
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                if method == 'getUpdates':
+                    status, response = await self.get_updates(payload)
+                else:
+                    status, response = self.respond(method, payload)
+                data = json.dumps(response).encode('utf-8')
+                writer.write((
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n"
+                ).encode('latin-1') + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+
+async def serve(args):
+    fake = FakeTelegram(latency=args.latency, flood_rate=args.flood_rate, retry_after=args.retry_after)
+    port = await fake.start(args.host, args.port)
+    print(f"fake Telegram API: http://{args.host}:{port}", flush=True)
+    await fake.server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9901)
+    parser.add_argument('--latency', type=float, default=0.0, help="每个请求的延迟 (秒)")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="随机返回 429 的比例")
+    parser.add_argument('--retry-after', type=int, default=1, help="429 中的 retry_after (秒)")
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+webhook 压测客户端: 多个 keep-alive 连接并发 POST Telegram update，统计应答延迟
+
+延迟从写出请求到读完响应为止，按请求计。结果 (含本进程的 CPU 时间) 以一行 JSON 输出到 stdout。
+
+运行: python3 bench/webhook_driver.py --url http://127.0.0.1:8080/webhook --requests 5000 --concurrency 50
+"""
+
+import json
+import time
+import asyncio
+import argparse
+import urllib.parse
+
+DEFAULT_TEXTS = ["/help", "/status", "/start", "/nope"]
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def build_update(update_id, chat_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text,
+        },
+    }
+
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("连接已关闭")
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        if key.strip().lower() == 'content-length':
+            length = int(value)
+    if length:
+        await reader.readexactly(length)
+    return int(status_line.split()[1])
+
+
+async def connection(url, ids, args, latencies, errors):
+    reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+    try:
+        for update_id in ids:
+            chat_id = 1 + update_id % args.chats
+            text = args.texts[update_id % len(args.texts)]
+            body = json.dumps(build_update(update_id, chat_id, text)).encode()
+            head = (f"POST {url.path} HTTP/1.1\r\nHost: {url.netloc}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n")
+            start = time.perf_counter()
+            writer.write(head.encode() + body)
+            status = await read_response(reader)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def main(args):
+    url = urllib.parse.urlsplit(args.url)
+    latencies = []
+    errors = []
+    ids = list(range(args.first_id, args.first_id + args.requests))
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        connection(url, ids[i::args.concurrency], args, latencies, errors)
+        for i in range(args.concurrency)
+    ))
+    elapsed = time.perf_counter() - start
+    ordered = sorted(latencies)
+    print(json.dumps({
+        "requests": len(latencies),
+        "errors": len(errors),
+        "seconds": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+        "cpu_seconds": round(time.process_time(), 3),
+    }))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="webhook 并发压测")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--chats", type=int, default=100, help="update 分布在多少个聊天")
+    parser.add_argument("--first-id", type=int, default=1, help="第一个 update_id")
+    parser.add_argument("--texts", type=lambda s: s.split(','), default=DEFAULT_TEXTS,
+                        help="逗号分隔的消息文本，依次轮流使用")
+    asyncio.run(main(parser.parse_args()))
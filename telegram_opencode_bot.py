@@ -6,26 +6,79 @@ Telegram Bot with OpenCode Integration
 1. 设置环境变量或修改下面的配置
 2. 运行: python3 telegram_opencode_bot.py
 3. 在 Telegram 中发送消息给机器人
+
+运行模式 (环境变量 BOT_SERVER_MODE):
+- asyncio (默认): 单个事件循环，webhook、Telegram 发送、opencode 子进程流都是协程
+- flask: 旧的 Flask threaded 服务，任务依然交给后台事件循环执行
+- polling: 没有公网入口时使用，长轮询 getUpdates 取 update (同时保留 asyncio HTTP 服务)
 """
 
 import os
 import sys
+import re
 import json
+import unicodedata
 import time
 import signal
-import subprocess
-import urllib.request
-import urllib.error
+import asyncio
+import ssl
+import urllib.parse
+import shlex
+import shutil
+import atexit
+import hashlib
+import sqlite3
+import queue
+import bisect
+from collections import deque, OrderedDict
 from flask import Flask, request, Response, jsonify
-from threading import Thread
+from threading import Thread, Lock
 from datetime import datetime
 
 # ============ 配置 ============
 TOKEN = "8134791400:AAGP4mWwbiQbDH4HKbNBFQcUUZpfySrQR1c"
 PORT = 8080
 LOG_FILE = "/tmp/opencode_bot.log"
+LOG_LEVEL_NAME = os.environ.get("LOG_LEVEL", "info").lower()  # debug | info | warning | error，debug 才记录发送内容等载荷
+LOG_STDOUT = os.environ.get("LOG_STDOUT", "1") == "1"  # 日志同时输出到标准输出
+LOG_MAX_BYTES = 10 * 1024 * 1024  # 日志文件超过该大小就轮转
+LOG_ROTATE_SECONDS = 24 * 3600  # 日志文件最长使用时间，超过就轮转
+LOG_BACKUPS = 5  # 保留的旧日志文件数 (LOG_FILE.1 ... LOG_FILE.5)
 OPENCODE_MODEL = "opencode/minimax-m2.5-free"
 # OPENCODE_MODEL = "opencode/kimi-k2.5-free"    
+SERVER_MODE = os.environ.get("BOT_SERVER_MODE", "asyncio")  # asyncio | flask | polling
+TELEGRAM_API = os.environ.get("TELEGRAM_API", "https://api.telegram.org")
+STREAM_LIMIT = 16 * 1024 * 1024  # opencode 单行 JSON 事件的最大长度
+STREAM_CHUNK_SIZE = 64 * 1024  # 子进程管道每次读取的块大小，也是管道缓冲上限
+STDERR_TAIL_LINES = 200  # 每个任务保留的 stderr 行数 (环形缓冲)
+STDERR_LINE_LIMIT = 1000  # stderr 每行最多保留的字节数
+MESSAGE_FORMAT = os.environ.get("MESSAGE_FORMAT", "plain").lower()  # plain 去掉 Markdown 格式 | html | markdownv2 转成 Telegram 格式
+LIVE_PROGRESS = os.environ.get("LIVE_PROGRESS", "1") == "1"  # 一个任务一条进度消息，原地编辑
+LIVE_PROGRESS_INTERVAL = float(os.environ.get("LIVE_PROGRESS_INTERVAL", "3"))  # 进度消息最短编辑间隔 (秒)
+HTTP_MAX_BODY = 1024 * 1024  # webhook 请求体上限 (Telegram update 远小于此)
+HTTP_MAX_HEADERS = 100
+HTTP_READ_TIMEOUT = 10  # 读取请求头和请求体的超时 (秒)
+HTTP_IDLE_TIMEOUT = 60  # keep-alive 连接等待下一个请求的超时 (秒)
+OPENCODE_WARM_WORKERS = int(os.environ.get("OPENCODE_WARM_WORKERS", 0))  # 常驻 opencode serve 进程数，0 表示每个任务冷启动
+OPENCODE_WORKER_PORT = int(os.environ.get("OPENCODE_WORKER_PORT", 4096))  # 第一个常驻进程的端口，其余依次加一
+OPENCODE_WORKER_MAX_USES = int(os.environ.get("OPENCODE_WORKER_MAX_USES", 50))  # 常驻进程执行多少个任务后重启
+OPENCODE_HEALTH_PATH = os.environ.get("OPENCODE_HEALTH_PATH", "/config")  # 健康检查请求的路径
+OPENCODE_HEALTH_INTERVAL = 30  # 空闲常驻进程的健康检查间隔 (秒)
+OPENCODE_WORKER_START_TIMEOUT = 30  # 常驻进程启动后等待就绪的秒数
+SNAPSHOT_DIR = os.path.expanduser("~/.local/share/opencode/snapshot")  # opencode 保存文件快照的目录
+SNAPSHOT_MAX_BYTES = int(os.environ.get("SNAPSHOT_MAX_MB", 2048)) * 1024 * 1024  # 快照目录总大小超过它时从最旧的开始删除
+SNAPSHOT_MAX_AGE = int(os.environ.get("SNAPSHOT_MAX_AGE_HOURS", 72)) * 3600  # 超过这个时间没有改动的快照直接删除
+SNAPSHOT_GC_INTERVAL = 600  # 后台清理快照的间隔 (秒)，任务结束后也会触发一次
+POLL_TIMEOUT = 30  # getUpdates 长轮询等待秒数
+POLL_LIMIT = 100  # 每次 getUpdates 最多取的 update 数 (Bot API 上限)
+POLL_OFFSET_FILE = os.environ.get("POLL_OFFSET_FILE", "/tmp/opencode_bot.offset")  # polling 模式保存 offset 的文件
+UPDATE_DEDUP_SIZE = 10000  # 内存中记住的 update_id 数量
+UPDATE_DEDUP_TTL = 24 * 3600  # update_id 记住多久 (Telegram 最多保留未确认的 update 24 小时)
+UPDATE_DEDUP_DB = os.environ.get("UPDATE_DEDUP_DB", "")  # 非空时 update_id 同时存入该 SQLite 文件，重启后依然去重
+TRACE_FILE = os.environ.get("TRACE_FILE", "/tmp/opencode_bot_trace.jsonl")  # 任务时间线 (JSON lines) 写入的文件，空表示只保留在内存里
+TRACE_KEEP_JOBS = 200  # 内存中保留最近多少个任务的时间线 (供 /jobs/<id>/trace 查询)
+TRACE_MAX_EVENTS = 5000  # 每个任务最多记录的时间线事件数
+TRACE_TOOL_SAMPLES = 1000  # 每种工具保留最近多少次耗时用于计算分位数
 
 # 加载环境变量
 OPENCODE_ENV = {}
@@ -46,174 +99,1115 @@ def build_prompt(user_text):
 
 def build_prompt_with_memory(user_text, chat_id):
     """构建带记忆的 prompt"""
-    memory = CONVERSATION_MEMORY.get(chat_id, [])
+    memory = MEMORY_STORE.rounds(chat_id)
     
     if not memory:
         # 没有记忆，直接使用原始 prompt
         return build_prompt(user_text)
     
-    # 构建记忆上下文
-    memory_context = "\n\n".join([
-        f"上一轮任务: {m['task']}\n上一轮结果: {m['result']}"
-        for m in memory[-MEMORY_ROUNDS:]
-    ])
+    # 构建记忆上下文 (压缩到 MEMORY_TOKEN_BUDGET 以内)
+    memory_context = compact_memory(memory, MEMORY_TOKEN_BUDGET)
+    if not memory_context:
+        return build_prompt(user_text)
     
     prompt = f"{memory_context}\n\n当前任务: {user_text}，配置文件在 /Users/jiancao/env.txt"
     return prompt
 
+def estimate_tokens(text):
+    """粗略估算 token 数: 非 ASCII 字符 (中文等) 每个算 1 个，ASCII 每 4 个字符算 1 个"""
+    wide = len(text) - len(text.encode('ascii', 'ignore'))
+    return wide + (len(text) - wide + 3) // 4
+
+def shorten(text, limit):
+    """超过 limit 个字符时保留开头和结尾 (结论通常在最后)"""
+    text = text.strip()
+    if len(text) <= limit:
+        return text
+    tail = limit // 3
+    return f"{text[:limit - tail]}\n...\n{text[-tail:]}"
+
+def compact_round(m):
+    """一轮记忆从完整到最简的几种写法 [(文本, token 数), ...]，算好后缓存在这一轮的 dict 里"""
+    forms = m.get("compact")
+    if forms is None:
+        forms = []
+        for task_limit, result_limit in ((None, None), MEMORY_SHORT_LIMITS, MEMORY_BRIEF_LIMITS):
+            task = m['task'] if task_limit is None else shorten(m['task'], task_limit)
+            result = m['result'] if result_limit is None else shorten(m['result'], result_limit)
+            text = f"上一轮任务: {task}\n上一轮结果: {result}"
+            if not forms or len(text) < len(forms[-1][0]):
+                forms.append((text, estimate_tokens(text)))
+        m["compact"] = forms
+    return forms
+
+def compact_memory(memory, budget):
+    """从最近一轮往前，每轮选放得进剩余预算的最完整写法；放不下最简写法时更早的轮次全部丢弃"""
+    parts = []
+    for m in reversed(memory):
+        for text, tokens in compact_round(m):
+            if tokens <= budget:
+                parts.append(text)
+                budget -= tokens
+                break
+        else:
+            break
+    return "\n\n".join(reversed(parts))
+
 def save_to_memory(chat_id, task, result):
     """保存任务和结果到记忆"""
-    if chat_id not in CONVERSATION_MEMORY:
-        CONVERSATION_MEMORY[chat_id] = []
-    
-    CONVERSATION_MEMORY[chat_id].append({
-        "task": task,
-        "result": result
-    })
-    
-    # 保留最近的记忆轮数
-    if len(CONVERSATION_MEMORY[chat_id]) > MEMORY_ROUNDS:
-        CONVERSATION_MEMORY[chat_id] = CONVERSATION_MEMORY[chat_id][-MEMORY_ROUNDS:]
+    MEMORY_STORE.save(chat_id, task, result)
 
 # ============ 配置 ============
-MEMORY_ROUNDS = 0  # 记忆轮数
+MEMORY_ROUNDS = int(os.environ.get("MEMORY_ROUNDS", 0))  # 每个聊天记住的轮数，0 表示不带记忆
+MEMORY_DB = os.environ.get("MEMORY_DB", "/tmp/opencode_bot_memory.db")  # 记忆存放的 SQLite 文件，空表示只存在内存里 (重启丢失)
+MEMORY_CACHE_CHATS = 1000  # 内存中缓存记忆的聊天数
+MEMORY_CACHE_IDLE = 3600  # 聊天多久没有读写就从内存缓存中移除 (秒)
+MEMORY_TOKEN_BUDGET = int(os.environ.get("MEMORY_TOKEN_BUDGET", 2000))  # prompt 中记忆部分最多占用的 token 数 (估算)
+MEMORY_SHORT_LIMITS = (300, 1500)  # 放不下完整内容时，任务和结果各保留的字符数
+MEMORY_BRIEF_LIMITS = (100, 200)  # 更早的轮次或预算紧张时的最简写法
+OPENCODE_SESSION_TTL = int(os.environ.get("OPENCODE_SESSION_TTL", 2 * 3600))  # 聊天的 opencode 会话空闲多久后不再续用 (秒)，0 表示每个任务新开会话
+
+def default_max_workers():
+    """按 CPU 核数和内存估算能同时运行的 opencode 数量"""
+    workers = os.cpu_count() or 1
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        workers = min(workers, memory // (JOB_MEMORY_MB * 1024 * 1024))
+    except (ValueError, OSError, AttributeError):
+        pass
+    return max(1, workers)
+
+JOB_MEMORY_MB = 1024  # 估算每个 opencode 进程占用的内存
+PROCESS_STOP_TIMEOUT = 5  # 结束任务进程组时 SIGTERM 之后等待多少秒再 SIGKILL
+JOB_TIMEOUT = int(os.environ.get("JOB_TIMEOUT", 1800))  # 每个任务 (包括重试) 的总时间上限 (秒)
+JOB_IDLE_TIMEOUT = int(os.environ.get("JOB_IDLE_TIMEOUT", 300))  # opencode 这么多秒没有任何输出就视为卡住，结束并重试
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", 0)) or default_max_workers()  # 全局同时运行的任务数
+CHAT_QUEUE_LIMIT = int(os.environ.get("CHAT_QUEUE_LIMIT", 5))  # 每个聊天最多排队的任务数
+COALESCE_WINDOW = int(os.environ.get("COALESCE_WINDOW", 600))  # 同一聊天在这么多秒内重复发送的相同任务合并到已有任务，0 表示不合并
 
 # ============ Flask App ============
 app = Flask(__name__)
 
-# 运行状态
-RUNNING_TASKS = {}  # chat_id -> is_running
-CONVERSATION_MEMORY = {}  # chat_id -> [{"task": "...", "result": "..."}, ...]
+# ============ 事件循环 ============
+BOT_LOOP = None  # 主事件循环，所有协程都跑在这里
+BACKGROUND_TASKS = set()  # 后台协程的引用，避免任务被 GC
+HTTP_SERVER = None  # asyncio 模式下的 HTTP 服务
+
+def spawn(coro):
+    """在主事件循环上启动后台协程 (只能在循环线程内调用)"""
+    task = BOT_LOOP.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
 
 # ============ 日志 ============
-def log(msg):
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LOG_LEVEL = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}.get(LOG_LEVEL_NAME, INFO)
+
+class LogWriter:
+    """后台线程批量写日志: log() 只把一行放进队列，不在调用方打开文件
+
+    写线程一次取走队列里已有的全部行，合并成一次 write；文件超过 max_bytes
+    或使用超过 rotate_seconds 时轮转为 path.1 ... path.backups。
+    """
+
+    def __init__(self, path, max_bytes, rotate_seconds, backups, stdout=True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backups = backups
+        self.stdout = stdout
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.lock = Lock()
+        self.file = None
+        self.size = 0
+        self.opened_at = 0
+
+    def write(self, line):
+        if self.thread is None:
+            self._start()
+        self.queue.put(line)
+
+    def _start(self):
+        # 第一次写日志时才启动线程 (flask 模式下可能多个线程同时进来)
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name="log-writer", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            lines = [self.queue.get()]
+            while True:
+                try:
+                    lines.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in lines
+            text = "".join(line for line in lines if line is not None)
+            if text:
+                self._write(text)
+            if stop:
+                return
+
+    def _write(self, text):
+        try:
+            data = text.encode('utf-8')
+            if self.file is not None and (self.size + len(data) > self.max_bytes
+                                          or time.time() - self.opened_at > self.rotate_seconds):
+                self._rotate()
+            if self.file is None:
+                self._open()
+            self.file.write(data)
+            self.file.flush()
+            self.size += len(data)
+        except OSError as e:
+            sys.stderr.write(f"写日志失败: {e}\n")
+        if self.stdout:
+            try:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            except (OSError, ValueError):
+                self.stdout = False
+
+    def _open(self):
+        self.file = open(self.path, 'ab')
+        self.size = self.file.tell()
+        self.opened_at = time.time()
+
+    def _rotate(self):
+        self.file.close()
+        self.file = None
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def close(self, timeout=2):
+        """写完队列中剩余的日志后结束线程 (退出和 execv 之前调用)"""
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+        self.thread = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+LOG_WRITER = LogWriter(LOG_FILE, LOG_MAX_BYTES, LOG_ROTATE_SECONDS, LOG_BACKUPS, LOG_STDOUT)
+atexit.register(LOG_WRITER.close)
+
+def log(msg, level=INFO):
+    if level < LOG_LEVEL:
+        return
     timestamp = datetime.now().strftime("%H:%M:%S")
-    with open(LOG_FILE, 'a', encoding='utf-8') as f:
-        f.write(f"{timestamp} {msg}\n")
-    print(f"{timestamp} {msg}")
+    LOG_WRITER.write(f"{timestamp} {msg}\n")
 
+# ============ 指标 ============
+METRIC_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRIC_JOB_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800)
+METRIC_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+METRIC_TOOL_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
 
+# 名字 -> (类型, 说明, 直方图的桶)
+METRIC_DEFS = {
+    "opencode_bot_updates_total": ("counter", "收到的 Telegram update 数 (含重复)", None),
+    "opencode_bot_http_requests_total": ("counter", "HTTP 请求数 (asyncio 服务)", None),
+    "opencode_bot_http_request_seconds": ("histogram", "HTTP 请求处理耗时 (asyncio 服务)", METRIC_LATENCY_BUCKETS),
+    "opencode_bot_telegram_requests_total": ("counter", "Bot API 请求数，code 为 HTTP 状态码、timeout 或 error", None),
+    "opencode_bot_telegram_request_seconds": ("histogram", "Bot API 请求耗时 (含等待连接名额)", METRIC_LATENCY_BUCKETS),
+    "opencode_bot_telegram_rate_limited_total": ("counter", "收到带 retry_after 的 429 次数", None),
+    "opencode_bot_messages_sent_total": ("counter", "成功发出的消息和编辑数", None),
+    "opencode_bot_jobs_total": ("counter", "结束的任务数，按结果分", None),
+    "opencode_bot_job_duration_seconds": ("histogram", "任务总耗时 (含重试)", METRIC_JOB_BUCKETS),
+    "opencode_bot_job_first_event_seconds": ("histogram", "启动 opencode 到收到第一个事件的时间", METRIC_JOB_BUCKETS),
+    "opencode_bot_job_messages": ("histogram", "每个任务发出的消息和编辑数", METRIC_COUNT_BUCKETS),
+    "opencode_bot_stream_bytes_total": ("counter", "从 opencode stdout 读到的字节数", None),
+    "opencode_bot_tool_seconds": ("histogram", "工具调用耗时，按工具分", METRIC_TOOL_BUCKETS),
+}
 
-MAX_MESSAGE_LENGTH = 4000
+class Histogram:
+    """Prometheus 直方图: 每个桶单独计数，输出时再累加"""
+    __slots__ = ('bounds', 'counts', 'sum')
 
-def clean_text(text):
-    """清理文本，移除 markdown 格式"""
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最后一个是 +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+class Metrics:
+    """进程内指标，只在事件循环线程里更新 (单线程，不需要锁)，/metrics 输出为 Prometheus 文本格式
+
+    计数器和直方图按 (名字, 标签) 存放；运行中任务数、队列长度等状态在输出时直接读取。
+    标签是 ((键, 值), ...) 元组，调用方按固定顺序传入。
+    """
+
+    def __init__(self):
+        self.counters = {}  # (名字, 标签) -> 值
+        self.histograms = {}  # (名字, 标签) -> Histogram
+        self.job_messages = {}  # chat_id -> 当前任务已发出的消息数 (只记录有任务运行的聊天)
+
+    def inc(self, name, value=1, labels=()):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram(METRIC_DEFS[name][2])
+        histogram.observe(value)
+
+    def message_sent(self, chat_id, method):
+        self.inc("opencode_bot_messages_sent_total", 1, (("method", method),))
+        if chat_id in self.job_messages:
+            self.job_messages[chat_id] += 1
+
+    def render(self, gauges=()):
+        """输出文本格式; gauges 为 [(名字, 说明, 类型, [(标签, 值), ...]), ...]"""
+        samples = {}
+        for (name, labels), value in list(self.counters.items()):
+            samples.setdefault(name, []).append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), histogram in list(self.histograms.items()):
+            lines = samples.setdefault(name, [])
+            total = 0
+            for bound, count in zip(histogram.bounds + ("+Inf",), histogram.counts):
+                total += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {total}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum:.6f}")
+            lines.append(f"{name}_count{format_labels(labels)} {total}")
+        out = []
+        for name, (kind, help_text, _) in METRIC_DEFS.items():
+            if name in samples:
+                out += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"] + samples[name]
+        for name, help_text, kind, values in gauges:
+            out += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            out += [f"{name}{format_labels(labels)} {value}" for labels, value in values]
+        return "\n".join(out) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+METRICS = Metrics()
+
+# ============ 任务时间线 ============
+class JobTrace:
+    """一个任务的时间线: 进程启动、第一个事件、每个步骤、每次工具调用和每次发送
+
+    每个事件是一行 JSON，t 为距任务开始的秒数；同时写入 TRACE_FILE。
+    """
+
+    def __init__(self, store, job_id, chat_id):
+        self.store = store
+        self.job_id = job_id
+        self.chat_id = chat_id
+        self.start = time.monotonic()
+        self.lines = []  # 已序列化的事件
+        self.dropped = 0  # 超过 TRACE_MAX_EVENTS 后丢弃的事件数
+        self.tools = {}  # callID (没有时用工具名) -> (工具名, 开始时间)，尚未完成的工具调用
+
+    def add(self, event, **fields):
+        if len(self.lines) >= TRACE_MAX_EVENTS:
+            self.dropped += 1
+            return
+        record = {"job": self.job_id, "t": round(time.monotonic() - self.start, 4), "event": event}
+        record.update(fields)
+        line = json.dumps(record, ensure_ascii=False)
+        self.lines.append(line)
+        if self.store.writer is not None:
+            self.store.writer.write(line + "\n")
+
+    def spawned(self, attempt, acquire, spawn, warm):
+        """opencode 进程已启动: acquire 为等待常驻进程的秒数，spawn 为创建进程的秒数"""
+        self.tools.clear()  # 上一次尝试未完成的工具调用不再配对
+        self.add("spawn", attempt=attempt, acquire=round(acquire, 4), seconds=round(spawn, 4), warm=warm)
+
+    def stream_event(self, event):
+        """记录解析出的 opencode 事件中的步骤和工具调用"""
+        event_type = event.get('type', '')
+        if event_type == "step_start":
+            self.add("step_start")
+        elif event_type == "tool_use":
+            part = event.get('part') or {}
+            tool = part.get('tool', '')
+            state = part.get('state') or {}
+            status = state.get('status', '')
+            call = part.get('callID') or tool
+            now = time.monotonic()
+            if status in ("completed", "error"):
+                started = self.tools.pop(call, None)
+                seconds = tool_seconds(state)
+                if seconds is None and started is not None:
+                    seconds = now - started[1]
+                self.add("tool_end", tool=tool, call=call, status=status,
+                         seconds=None if seconds is None else round(seconds, 4))
+                if seconds is not None:
+                    self.store.tool_done(tool, seconds)
+            elif call not in self.tools:
+                self.tools[call] = (tool, now)
+                self.add("tool_start", tool=tool, call=call)
+
+    def text(self):
+        lines = self.lines
+        if self.dropped:
+            lines = lines + [json.dumps({"job": self.job_id, "event": "dropped", "count": self.dropped})]
+        return "\n".join(lines) + "\n"
+
+def tool_seconds(state):
+    """opencode 在工具完成事件的 state.time 里带有开始/结束时间 (毫秒)，有就用它"""
+    times = state.get('time')
+    if isinstance(times, dict):
+        start, end = times.get('start'), times.get('end')
+        if isinstance(start, (int, float)) and isinstance(end, (int, float)) and end >= start:
+            return (end - start) / 1000
+    return None
+
+class TraceStore:
+    """所有任务的时间线: 运行中的按聊天登记 (发送时据此归属)，结束的保留最近 keep 个；
+    另外按工具汇总最近的调用耗时，用于计算分位数。只在事件循环线程里使用。"""
+
+    def __init__(self, path, keep, samples):
+        self.writer = LogWriter(path, LOG_MAX_BYTES, LOG_ROTATE_SECONDS, LOG_BACKUPS, stdout=False) if path else None
+        self.keep = keep
+        self.samples = samples
+        self.traces = OrderedDict()  # job id -> JobTrace，包括运行中的
+        self.active = {}  # chat_id -> 正在运行的 JobTrace
+        self.tools = {}  # 工具名 -> deque[秒]
+        self.tool_calls = {}  # 工具名 -> 总调用次数
+
+    def start(self, job_id, chat_id):
+        trace = JobTrace(self, job_id, chat_id)
+        self.traces[job_id] = trace
+        self.active[chat_id] = trace
+        while len(self.traces) > self.keep:
+            self.traces.popitem(last=False)
+        trace.add("start", chat=chat_id, time=round(time.time(), 3))
+        return trace
+
+    def finish(self, trace, outcome):
+        trace.add("end", outcome=outcome, seconds=round(time.monotonic() - trace.start, 4))
+        if self.active.get(trace.chat_id) is trace:
+            del self.active[trace.chat_id]
+
+    def send(self, chat_id, method, wait, seconds, code):
+        """一次 Bot API 请求结束: wait 为排队等待的秒数，code 为状态码、timeout 或 error"""
+        trace = self.active.get(chat_id)
+        if trace is not None:
+            trace.add("send", method=method, wait=round(wait, 4), seconds=round(seconds, 4), code=code)
+
+    def tool_done(self, tool, seconds):
+        samples = self.tools.get(tool)
+        if samples is None:
+            samples = self.tools[tool] = deque(maxlen=self.samples)
+        samples.append(seconds)
+        self.tool_calls[tool] = self.tool_calls.get(tool, 0) + 1
+        METRICS.observe("opencode_bot_tool_seconds", seconds, (("tool", tool),))
+
+    def get(self, job_id):
+        return self.traces.get(job_id)
+
+    def tool_stats(self):
+        """{工具名: {"calls", "p50", "p90", "p99", "max"}}，分位数按最近 samples 次调用计算"""
+        stats = {}
+        for tool, samples in self.tools.items():
+            ordered = sorted(samples)
+            stats[tool] = {
+                "calls": self.tool_calls[tool],
+                "p50": round(percentile(ordered, 0.50), 4),
+                "p90": round(percentile(ordered, 0.90), 4),
+                "p99": round(percentile(ordered, 0.99), 4),
+                "max": round(ordered[-1], 4),
+            }
+        return stats
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] if ordered else 0.0
+
+TRACES = TraceStore(TRACE_FILE, TRACE_KEEP_JOBS, TRACE_TOOL_SAMPLES)
+atexit.register(TRACES.close)
+
+
+
+MAX_MESSAGE_LENGTH = 4000  # 按 UTF-16 码元计 (Telegram 的 4096 上限就是这么算的)，留一点余量
+
+# Markdown 词法: 一个预编译的正则，按出现顺序一次扫描全文。
+# 每个分支都以一个字面字符开头 (行首结构以前一个换行开头)，正则引擎可以直接跳到候选位置；
+# 代码块从它前面的换行开始匹配，所以总是先于行内代码被识别。
+MARKDOWN_TOKEN_RE = re.compile(r"""
+    \n(?P<fence>[ \t]*```(?P<fence_lang>[^\n`]*)\n(?P<fence_body>(?:[^\n]*\n)*?)(?:[ \t]*```[ \t]*(?=\n|\Z)|(?P<fence_tail>[^\n]*)\Z))
+  | \n(?P<heading>\#{1,6}[ \t]+(?P<heading_body>[^\n]*))
+  | \n(?P<bullet>(?P<bullet_indent>[ \t]*)[-*+][ \t]+)
+  | `(?P<code>[^`\n]+)`
+  | \[(?P<link>(?P<link_text>[^\]\n]+)\]\((?P<link_url>(?:[^()\s]|\([^()\s]*\))+)\))
+  | \*\*(?P<bold>[^*\n]+?)\*\*
+  | __(?<![\w_]__)(?P<bold_under>[^_\n]+?)__(?![\w_])
+  | ~~(?P<strike>[^~\n]+?)~~
+  | \*(?<![\w*]\*)(?P<italic>[^*\s](?:[^*\n]*?[^*\s])?)\*(?![\w*])
+  | _(?<![\w_]_)(?P<italic_under>[^_\s](?:[^_\n]*?[^_\s])?)_(?![\w_])
+""", re.VERBOSE)
+INLINE_MARKUP_RE = re.compile(r'[`\[*_~]')  # 格式内部的文字没有这些字符时不用再渲染
+
+MARKDOWNV2_ESCAPE_RE = re.compile(r'([_*\[\]()~`>#+\-=|{}.!\\])')
+MARKDOWNV2_CODE_ESCAPE_RE = re.compile(r'([`\\])')
+MARKDOWNV2_URL_ESCAPE_RE = re.compile(r'([)\\])')
+HTML_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'})
+
+MESSAGE_PARSE_MODES = {"html": "HTML", "markdownv2": "MarkdownV2"}
+
+def escape_text(text, mode):
+    """转义普通文本，使其在对应 parse_mode 下按原样显示"""
+    if mode == "html":
+        return text.translate(HTML_ESCAPE_TABLE)
+    if mode == "markdownv2":
+        return MARKDOWNV2_ESCAPE_RE.sub(r'\\\1', text)
+    return text
+
+def escape_code(text):
+    """MarkdownV2 代码里只需转义 ` 和 \\"""
+    return MARKDOWNV2_CODE_ESCAPE_RE.sub(r'\\\1', text)
+
+def render_markdown(text, mode="plain", nested=False):
+    """把 agent 输出的 Markdown 渲染成 Telegram 消息文本
+
+    mode: plain 去掉格式只留文字；html / markdownv2 转成 Telegram 对应的实体。
+    代码块和行内代码里的内容原样保留，不再做任何格式处理。
+    nested: 渲染格式内部的一段文字，没有行首结构。
+    """
     if not text:
         return text
-    import re
-    # 移除 **bold**, __italic__, `code`
-    text = re.sub(r'\*\*([^*]+)\*\*', r'\1', text)
-    text = re.sub(r'__([^_]+)__', r'\1', text)
-    text = re.sub(r'`([^`]+)`', r'\1', text)
-    text = re.sub(r'```[\s\S]*?```', '', text)
-    # 移除 markdown 链接 [text](url) -> text
-    text = re.sub(r'\[([^\]]+)\]\([^)]+\)', r'\1', text)
-    # 移除标题 ### Title -> Title
-    text = re.sub(r'^#{1,6}\s+', '', text, flags=re.MULTILINE)
-    # 移除列表符号 - 或 * 开头
-    text = re.sub(r'^[\-\*]\s+', '', text, flags=re.MULTILINE)
-    # 移除数字列表 1. 2. 开头
-    text = re.sub(r'^\d+\.\s+', '', text, flags=re.MULTILINE)
-    return text
+    if not nested:
+        # 前面补一个换行，第一行的行首结构也能匹配；输出的第一个字符一定是这个换行
+        text = "\n" + text
+    if mode == "plain":
+        # 纯文本模式下 token 之间的文字不用转义，整段交给 re.sub 在 C 里拼接
+        result = MARKDOWN_TOKEN_RE.sub(render_token, text)
+    else:
+        out = []
+        pos = 0
+        for match in MARKDOWN_TOKEN_RE.finditer(text):
+            start = match.start()
+            if start > pos:
+                out.append(escape_text(text[pos:start], mode))
+            out.append(render_token(match, mode))
+            pos = match.end()
+        if pos < len(text):
+            out.append(escape_text(text[pos:], mode))
+        result = "".join(out)
+    return result if nested else result[1:]
 
-def split_message(text):
-    """将长文本分割成多条消息"""
-    if len(text) <= MAX_MESSAGE_LENGTH:
-        return [text]
-    
-    messages = []
-    while len(text) > MAX_MESSAGE_LENGTH:
-        # 找到最后一个换行符位置，避免在单词中间截断
-        split_pos = text[:MAX_MESSAGE_LENGTH].rfind('\n')
-        if split_pos == -1:
-            split_pos = MAX_MESSAGE_LENGTH
-        
-        messages.append(text[:split_pos])
-        text = text[split_pos:]
-    
-    if text:
-        messages.append(text)
-    
-    return messages
+def render_nested(text, mode):
+    """渲染格式内部的一段文字，没有格式字符时只需转义"""
+    if INLINE_MARKUP_RE.search(text) is None:
+        return escape_text(text, mode)
+    return render_markdown(text, mode, nested=True)
+
+# 包住一段文字的格式: token 名 -> (HTML 标签, MarkdownV2 标记)
+MARKDOWN_WRAPPERS = {
+    "bold": ("b", "*"), "bold_under": ("b", "*"),
+    "strike": ("s", "~"),
+    "italic": ("i", "_"), "italic_under": ("i", "_"),
+}
+
+def render_token(match, mode="plain"):
+    """渲染一个 token；分支按 agent 输出中出现的频率排列"""
+    kind = match.lastgroup
+    wrapper = MARKDOWN_WRAPPERS.get(kind)
+    if wrapper is not None:
+        # 里面可以再嵌套格式
+        inner = render_nested(match.group(kind), mode)
+        if mode == "html":
+            return f"<{wrapper[0]}>{inner}</{wrapper[0]}>"
+        if mode == "markdownv2":
+            return f"{wrapper[1]}{inner}{wrapper[1]}"
+        return inner
+    if kind == "code":
+        body = match.group("code")
+        if mode == "html":
+            return f"<code>{escape_text(body, mode)}</code>"
+        if mode == "markdownv2":
+            return f"`{escape_code(body)}`"
+        return body
+    if kind == "bullet":
+        return "\n" + match.group("bullet_indent") + "• "
+    if kind == "link":
+        label = render_nested(match.group("link_text"), mode)
+        url = match.group("link_url")
+        if mode == "html":
+            return f'<a href="{escape_text(url, mode)}">{label}</a>'
+        if mode == "markdownv2":
+            url = MARKDOWNV2_URL_ESCAPE_RE.sub(r'\\\1', url)
+            return f"[{label}]({url})"
+        return label
+    if kind == "heading":
+        # 标题整行加粗，里面的格式去掉 (同类实体不能嵌套)
+        inner = escape_text(render_nested(match.group("heading_body"), "plain"), mode)
+        if mode == "html":
+            return f"\n<b>{inner}</b>"
+        if mode == "markdownv2":
+            return f"\n*{inner}*"
+        return "\n" + inner
+    # 代码块
+    body = match.group("fence_body") + (match.group("fence_tail") or "")
+    lang = match.group("fence_lang").strip()
+    if mode == "html":
+        attr = f' class="language-{escape_text(lang, mode)}"' if lang else ""
+        body = escape_text(body.rstrip('\n'), mode)
+        return f"\n<pre><code{attr}>{body}</code></pre>"
+    if mode == "markdownv2":
+        body = escape_code(body if body.endswith('\n') else body + '\n')
+        return f"\n```{lang}\n{body}```"
+    return "\n" + body.rstrip('\n')
+
+def clean_text(text):
+    """清理文本，移除 markdown 格式"""
+    return render_markdown(text, "plain")
+
+# 不能在它前面断开的字符: 零宽连接符、变体选择符、肤色修饰符、标签字符
+GRAPHEME_EXTEND_RE = re.compile('[\u200d\ufe00-\ufe0f\U0001f3fb-\U0001f3ff\U000e0020-\U000e007f\U000e0100-\U000e01ef]')
+SENTENCE_END_RE = re.compile(r'[.!?;。！？；…]+[)\]"\'”’）」』]*(?:[ \t]+|(?<=[。！？；…])(?=\S))')
+
+def utf16_len(text):
+    """Telegram 按 UTF-16 码元计算长度，BMP 之外的字符 (大部分 emoji) 占两个"""
+    return len(text.encode('utf-16-le')) // 2
+
+def is_regional_indicator(char):
+    return '\U0001f1e6' <= char <= '\U0001f1ff'
+
+def is_grapheme_boundary(text, i, start=0):
+    """text[i-1] 与 text[i] 之间能否断开 (Unicode 字素簇规则的近似，覆盖组合符号、emoji 序列和国旗)"""
+    if i <= start or i >= len(text):
+        return True
+    prev, cur = text[i - 1], text[i]
+    if prev == '\r' and cur == '\n':
+        return False
+    if prev == '\u200d' or GRAPHEME_EXTEND_RE.match(cur) or unicodedata.category(cur) in ('Mn', 'Mc', 'Me'):
+        return False
+    if is_regional_indicator(prev) and is_regional_indicator(cur):
+        # 国旗是两个 regional indicator 一组，前面有奇数个时不能断开
+        count = 0
+        j = i - 1
+        while j >= start and is_regional_indicator(text[j]):
+            count += 1
+            j -= 1
+        return count % 2 == 0
+    return True
+
+def split_message(text, limit=None):
+    """把长文本切成多条消息的生成器，每条不超过 limit 个 UTF-16 码元
+
+    一遍扫描，每条消息只看自己的窗口，不复制剩余部分。断点优先选段落、
+    其次换行、句末、空格 (都要落在窗口后半段)，找不到时硬切，但不会拆开一个字素簇。
+    """
+    limit = limit or MAX_MESSAGE_LENGTH
+    if len(text) <= limit // 2 or (len(text) <= limit and utf16_len(text) <= limit):
+        if text.strip():
+            yield text
+        return
+    start = 0
+    length = len(text)
+    while start < length:
+        end = min(length, start + limit)
+        # 每个字符占 1 或 2 个码元，每次少取超出量一半的字符，几轮就能落在上限内
+        excess = utf16_len(text[start:end]) - limit
+        while excess > 0:
+            end -= (excess + 1) // 2
+            excess = utf16_len(text[start:end]) - limit
+        if end < length:
+            end = find_split(text, start, end, start + (end - start) // 2)
+        chunk = text[start:end]
+        if chunk.strip():
+            yield chunk
+        start = end
+
+def find_split(text, start, end, floor):
+    """在 [floor, end] 里找最好的断点，返回下一条消息的起点"""
+    pos = text.rfind('\n\n', floor, end)
+    if pos != -1:
+        return pos + 2
+    pos = text.rfind('\n', floor, end)
+    if pos != -1:
+        return pos + 1
+    last = None
+    for last in SENTENCE_END_RE.finditer(text, floor, end):
+        pass
+    if last is not None:
+        return last.end()
+    pos = text.rfind(' ', floor, end)
+    if pos != -1:
+        return pos + 1
+    # 硬切: 退到字素簇边界；整个窗口是一个簇时只能在 end 处切开
+    cut = end
+    while cut > start + 1 and not is_grapheme_boundary(text, cut, start):
+        cut -= 1
+    return cut if cut > start + 1 else end
 
 # ============ Telegram API ============
-def send_message(chat_id, text, retry=3):
-    # 清理文本
-    text = clean_text(text)
-    
-    # 分割成长消息
-    messages = split_message(text)
-    
-    for msg in messages:
-        for attempt in range(retry):
-            try:
-                url = f"https://api.telegram.org/bot{TOKEN}/sendMessage"
-                data = {
-                    "chat_id": chat_id,
-                    "text": msg
-                }
-                
-                json_data = json.dumps(data)
-                log(f"发送数据: {json_data[:200]}")
-                
-                req = urllib.request.Request(
-                    url,
-                    data=json_data.encode('utf-8'),
-                    headers={'Content-Type': 'application/json'}
-                )
-                
-                with urllib.request.urlopen(req, timeout=15) as response:
-                    result = response.read().decode('utf-8')
-                    log(f"发送结果: {result[:200]}")
-                
-                time.sleep(0.3)
+TELEGRAM_MAX_CONNECTIONS = 32  # 每个主机的最大并发连接数
+TELEGRAM_MAX_IDLE = 8  # 每个主机保留的空闲 keep-alive 连接数
+TELEGRAM_IDLE_TIMEOUT = 30  # 空闲连接超过该秒数不再复用
+
+class TelegramHTTPError(Exception):
+    """Telegram 返回非 2xx 状态码"""
+    def __init__(self, code, body):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+        self.body = body
+
+class ConnectionClosedError(ConnectionError):
+    """连接在收到任何响应之前就被对端关闭"""
+
+class TLSSessionContext(ssl.SSLContext):
+    """新连接自动复用同一主机上一次的 TLS 会话，省掉完整握手"""
+    def __new__(cls):
+        ctx = super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+        ctx.sessions = {}  # server_hostname -> ssl.SSLSession
+        ctx.load_default_certs()
+        return ctx
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    def remember(self, writer, hostname):
+        """握手完成后记下会话 (TLS 1.3 的 ticket 在首个响应之后才可用)"""
+        ssl_object = writer.get_extra_info('ssl_object')
+        if ssl_object is not None and ssl_object.session is not None:
+            self.sessions[hostname] = ssl_object.session
+
+async def read_http_response(reader, status_line=None):
+    """读取一个 HTTP/1.1 响应，返回 (状态码, headers, body)"""
+    if status_line is None:
+        status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionClosedError("连接已关闭")
+    code = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
                 break
-                    
-            except urllib.error.HTTPError as e:
-                error_body = e.read().decode('utf-8') if e.fp else str(e)
-                log(f"HTTP错误 {e.code}: {error_body[:300]}")
-                if attempt < retry - 1:
-                    time.sleep(2)
-                else:
-                    return None
-            except Exception as e:
-                log(f"发送消息失败 (尝试 {attempt+1}/{retry}): {e}")
-                if attempt < retry - 1:
-                    time.sleep(2)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+    return code, headers, body
+
+class TelegramClient:
+    """Bot API 客户端: 按主机维护持久 HTTPS 连接池，所有请求共用"""
+
+    def __init__(self, base_url):
+        self.base = urllib.parse.urlsplit(base_url)
+        self.ssl_context = TLSSessionContext() if self.base.scheme == 'https' else None
+        self.idle = {}  # (host, port) -> [(reader, writer, last_used), ...]
+        self.limits = {}  # (host, port) -> asyncio.Semaphore
+
+    def _key(self):
+        port = self.base.port or (443 if self.ssl_context else 80)
+        return self.base.hostname, port
+
+    async def _connect(self, key):
+        host, port = key
+        reader, writer = await asyncio.open_connection(host, port, ssl=self.ssl_context)
+        return reader, writer
+
+    def _checkout(self, key):
+        """取出一个仍然可用的空闲连接，没有则返回 None"""
+        pool = self.idle.get(key)
+        now = time.monotonic()
+        while pool:
+            reader, writer, last_used = pool.pop()
+            if now - last_used < TELEGRAM_IDLE_TIMEOUT and not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        return None
+
+    def _checkin(self, key, reader, writer):
+        pool = self.idle.setdefault(key, [])
+        if len(pool) < TELEGRAM_MAX_IDLE:
+            pool.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+    async def _exchange(self, key, payload):
+        """发送请求；复用的空闲连接在收到状态行前就被关闭时，换新连接重发一次"""
+        conn = self._checkout(key)
+        if conn is not None:
+            try:
+                return await self._roundtrip(key, conn, payload, reused=True)
+            except ConnectionClosedError:
+                # 服务端已关闭空闲连接，请求没有被处理，重发是安全的
+                pass
+        return await self._roundtrip(key, await self._connect(key), payload)
+
+    async def _roundtrip(self, key, conn, payload, reused=False):
+        """在一条连接上完成一次请求/响应，成功后把连接放回池中"""
+        reader, writer = conn
+        try:
+            try:
+                writer.write(payload)
+                await writer.drain()
+                status_line = await reader.readline()
+            except OSError as e:
+                # 复用的连接在状态行之前被重置 (NAT 超时、LB RST 等)，视为已关闭
+                if reused:
+                    raise ConnectionClosedError(str(e)) from e
+                raise
+            code, headers, body = await read_http_response(reader, status_line)
+        except BaseException:
+            writer.close()
+            raise
+        self._finish(key, reader, writer, headers)
+        return code, body
+
+    def _finish(self, key, reader, writer, headers):
+        if self.ssl_context is not None:
+            self.ssl_context.remember(writer, key[0])
+        framed = 'content-length' in headers or headers.get('transfer-encoding', '').lower() == 'chunked'
+        if framed and headers.get('connection', '').lower() != 'close':
+            self._checkin(key, reader, writer)
+        else:
+            writer.close()
+
+    def close(self):
+        """关闭所有空闲连接"""
+        for pool in self.idle.values():
+            for _, writer, _ in pool:
+                writer.close()
+        self.idle.clear()
+
+    async def request(self, method, data, timeout=15):
+        """调用 Bot API 方法，返回响应文本；非 2xx 抛出 TelegramHTTPError"""
+        key = self._key()
+        path = f"{self.base.path.rstrip('/')}/bot{TOKEN}/{method}"
+        body = json.dumps(data).encode('utf-8')
+        payload = (
+            f"POST {path} HTTP/1.1\r\n"
+            f"Host: {key[0]}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        ).encode('latin-1') + body
+
+        limit = self.limits.get(key)
+        if limit is None:
+            limit = self.limits[key] = asyncio.Semaphore(TELEGRAM_MAX_CONNECTIONS)
+
+        async def limited():
+            # 等待连接名额也计入超时
+            async with limit:
+                return await self._exchange(key, payload)
+
+        start = time.monotonic()
+        status = "error"
+        try:
+            code, raw = await asyncio.wait_for(limited(), timeout)
+            status = code
+        except asyncio.TimeoutError:
+            status = "timeout"
+            raise
+        finally:
+            METRICS.inc("opencode_bot_telegram_requests_total", 1, (("method", method), ("code", status)))
+            METRICS.observe("opencode_bot_telegram_request_seconds", time.monotonic() - start, (("method", method),))
+        text = raw.decode('utf-8', errors='replace')
+        if not 200 <= code < 300:
+            raise TelegramHTTPError(code, text)
+        return text
+
+TELEGRAM_CLIENT = TelegramClient(TELEGRAM_API)
+
+async def telegram_api(method, data, timeout=15):
+    """所有 Bot API 调用的统一入口，走共享连接池"""
+    return await TELEGRAM_CLIENT.request(method, data, timeout)
+
+# ============ 发送调度 ============
+GLOBAL_SEND_RATE = 30  # 全局每秒消息数 (Telegram 限制约 30/s)
+CHAT_SEND_RATE = 1  # 私聊每秒消息数
+GROUP_SEND_RATE = 20 / 60  # 群聊每秒消息数 (约 20 条/分钟)
+CHAT_SEND_BURST = 3  # 单个聊天允许的突发条数
+SEND_BACKOFF = 1  # 非 429 错误的初始退避秒数，之后翻倍
+TYPING_INTERVAL = 4.5  # "正在输入" 心跳间隔 (Telegram 显示约 5 秒)
+
+class TokenBucket:
+    """令牌桶: reserve() 预约一个令牌并返回需要等待的秒数"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+def parse_retry_after(body):
+    """从 429 响应体里取出 parameters.retry_after (秒)"""
+    try:
+        return float(json.loads(body)['parameters']['retry_after'])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+class OutboundItem:
+    __slots__ = ('method', 'data', 'timeout', 'retry', 'limited', 'future', 'attempt', 'fallback', 'submitted')
+
+    def __init__(self, method, data, timeout, retry, limited, future, fallback=None):
+        self.method = method
+        self.data = data
+        self.fallback = fallback  # 400 (例如实体解析失败) 时改发的请求参数
+        self.timeout = timeout
+        self.retry = retry
+        self.limited = limited
+        self.future = future
+        self.attempt = 0
+        self.submitted = time.monotonic()  # 排队的时间 (时间线里的等待时长)
+
+class OutboundScheduler:
+    """所有发往 Telegram 的请求都经过这里
+
+    每个聊天一个 FIFO 队列和一个发送协程 (保证同一聊天内的顺序)，不同聊天并行发送；
+    消息类请求先过聊天令牌桶，再过全局令牌桶；429 按 retry_after 暂停该聊天。
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(GLOBAL_SEND_RATE, GLOBAL_SEND_RATE)
+        self.chat_buckets = {}  # chat_id -> TokenBucket
+        self.queues = {}  # chat_id -> deque[OutboundItem]，只保留有待发请求的聊天
+        self.paused_until = {}  # chat_id -> monotonic 时间
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # 负数 chat_id 是群组/频道
+            rate = GROUP_SEND_RATE if isinstance(chat_id, int) and chat_id < 0 else CHAT_SEND_RATE
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, CHAT_SEND_BURST)
+        return bucket
+
+    def submit(self, chat_id, method, data, timeout=15, retry=3, limited=True, fallback=None):
+        """排队一个请求，返回 future (结果为响应文本)"""
+        future = BOT_LOOP.create_future()
+        item = OutboundItem(method, data, timeout, retry, limited, future, fallback)
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = deque([item])
+            spawn(self._drain(chat_id, queue))
+        else:
+            queue.append(item)
+        return future
+
+    async def _wait_turn(self, chat_id, limited):
+        paused = self.paused_until.get(chat_id)
+        if paused is not None:
+            delay = paused - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.paused_until.pop(chat_id, None)
+        if limited:
+            delay = self._chat_bucket(chat_id).reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            delay = self.global_bucket.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def _drain(self, chat_id, queue):
+        """依次发送该聊天的请求，队列空了就退出"""
+        try:
+            while queue:
+                item = queue[0]
+                if item.future.done():
+                    queue.popleft()
+                    continue
+                await self._wait_turn(chat_id, item.limited)
+                start = time.monotonic()
+                try:
+                    result = await telegram_api(item.method, item.data, timeout=item.timeout)
+                except TelegramHTTPError as e:
+                    TRACES.send(chat_id, item.method, start - item.submitted, time.monotonic() - start, e.code)
+                    log(f"HTTP错误 {e.code}: {e.body[:300]}", WARNING)
+                    retry_after = parse_retry_after(e.body) if e.code == 429 else None
+                    if retry_after is not None:
+                        # 429 不计入重试次数，严格按 retry_after 暂停该聊天后重发
+                        METRICS.inc("opencode_bot_telegram_rate_limited_total")
+                        self.paused_until[chat_id] = time.monotonic() + retry_after
+                        continue
+                    if e.code == 400 and item.fallback is not None:
+                        # parse_mode 下的实体解析失败，改发纯文本
+                        item.data, item.fallback = item.fallback, None
+                        continue
+                    if 400 <= e.code < 500 or not self._backoff(item):
+                        queue.popleft()
+                        item.future.set_exception(e)
+                    else:
+                        await asyncio.sleep(SEND_BACKOFF * 2 ** (item.attempt - 1))
+                except Exception as e:
+                    code = "timeout" if isinstance(e, asyncio.TimeoutError) else "error"
+                    TRACES.send(chat_id, item.method, start - item.submitted, time.monotonic() - start, code)
+                    log(f"发送失败 (尝试 {item.attempt + 1}/{item.retry}): {e}", WARNING)
+                    if not self._backoff(item):
+                        queue.popleft()
+                        item.future.set_exception(e)
+                    else:
+                        await asyncio.sleep(SEND_BACKOFF * 2 ** (item.attempt - 1))
                 else:
-                    return None
+                    TRACES.send(chat_id, item.method, start - item.submitted, time.monotonic() - start, 200)
+                    queue.popleft()
+                    if item.method in ("sendMessage", "editMessageText"):
+                        METRICS.message_sent(chat_id, item.method)
+                    if not item.future.done():
+                        item.future.set_result(result)
+        finally:
+            if self.queues.get(chat_id) is queue:
+                del self.queues[chat_id]
+            for item in queue:
+                if not item.future.done():
+                    item.future.cancel()
+
+    def _backoff(self, item):
+        """记一次失败，还能重试返回 True"""
+        item.attempt += 1
+        return item.attempt < item.retry
+
+    def pending(self):
+        """待发送的请求总数"""
+        return sum(len(q) for q in self.queues.values())
+
+OUTBOX = OutboundScheduler()
+
+def build_messages(chat_id, text):
+    """按 MESSAGE_FORMAT 把文本分割、渲染成要发送的 [(data, fallback), ...]
+
+    plain 模式直接去掉格式；html / markdownv2 模式先按原文分割再逐段渲染，
+    fallback 是同一段的纯文本，Telegram 拒绝解析实体时改发它。
+    """
+    parse_mode = MESSAGE_PARSE_MODES.get(MESSAGE_FORMAT)
+    if parse_mode is None:
+        return [({"chat_id": chat_id, "text": msg}, None) for msg in split_message(clean_text(text))]
+    messages = []
+    for chunk in split_message(text):
+        data = {"chat_id": chat_id, "text": render_markdown(chunk, MESSAGE_FORMAT), "parse_mode": parse_mode}
+        messages.append((data, {"chat_id": chat_id, "text": clean_text(chunk)}))
+    return messages
+
+async def send_message(chat_id, text, retry=3):
+    for data, fallback in build_messages(chat_id, text):
+        if LOG_LEVEL <= DEBUG:
+            log(f"发送数据: {json.dumps(data)[:200]}", DEBUG)
+        try:
+            result = await OUTBOX.submit(chat_id, "sendMessage", data, timeout=15, retry=retry, fallback=fallback)
+        except Exception as e:
+            log(f"发送消息失败: {e}", ERROR)
+            return None
+        log(f"发送结果: {result[:200]}", DEBUG)
     
     return True
 
-def send_typing(chat_id):
-    """发送 typing 状态"""
+def post_message(chat_id, text, retry=3):
+    """把消息放进发送队列后立即返回，不等待发送结果 (webhook 快速应答用)"""
+    for data, fallback in build_messages(chat_id, text):
+        future = OUTBOX.submit(chat_id, "sendMessage", data, timeout=15, retry=retry, fallback=fallback)
+        future.add_done_callback(log_send_failure)
+
+def log_send_failure(future):
+    """post_message 的结果没有人等待，失败在这里记日志"""
+    if not future.cancelled() and future.exception() is not None:
+        log(f"发送消息失败: {future.exception()}", ERROR)
+
+async def send_typing(chat_id):
+    """发送 typing 状态 (不占消息令牌，但遵守该聊天的 429 暂停)"""
     try:
-        url = f"https://api.telegram.org/bot{TOKEN}/sendChatAction"
         data = {"chat_id": chat_id, "action": "typing"}
-        req = urllib.request.Request(
-            url,
-            data=json.dumps(data).encode('utf-8'),
-            headers={'Content-Type': 'application/json'}
-        )
-        urllib.request.urlopen(req, timeout=5)
-    except:
+        await OUTBOX.submit(chat_id, "sendChatAction", data, timeout=5, retry=1, limited=False)
+    except Exception:
         pass
 
+class TypingHeartbeat:
+    """每个聊天一个 "正在输入" 心跳
+
+    只要该聊天还有任务在运行，就每 TYPING_INTERVAL 秒发一次 sendChatAction
+    (Telegram 的显示时长约 5 秒)。心跳在独立协程里发送，不阻塞事件读取。
+    """
+
+    def __init__(self):
+        self.active = {}  # chat_id -> 正在运行的任务数
+        self.tasks = {}  # chat_id -> 心跳协程
+
+    def start(self, chat_id):
+        self.active[chat_id] = self.active.get(chat_id, 0) + 1
+        if chat_id not in self.tasks:
+            self.tasks[chat_id] = spawn(self._beat(chat_id))
+
+    def stop(self, chat_id):
+        count = self.active.get(chat_id, 0) - 1
+        if count > 0:
+            self.active[chat_id] = count
+            return
+        self.active.pop(chat_id, None)
+        task = self.tasks.pop(chat_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def _beat(self, chat_id):
+        while True:
+            await send_typing(chat_id)
+            await asyncio.sleep(TYPING_INTERVAL)
+
+TYPING = TypingHeartbeat()
+
 # ============ OpenCode 执行 ============
-def send_update(chat_id, event_type, content, buffer, force_send=False):
-    """实时发送更新到 Telegram"""
+EVENT_EMOJI = {
+    "thinking": "💭",
+    "reasoning": "💭",
+    "text": "📝",
+    "tool": "🔧",
+    "info": "▶️",
+    "error": "❌",
+    "wait": "⏳"
+}
+
+async def send_update(chat_id, event_type, content, buffer, force_send=False, progress=None):
+    """实时发送更新到 Telegram (live progress 模式下改为更新进度消息)"""
     if not content:
         return buffer
     
-    emoji_map = {
-        "thinking": "💭",
-        "reasoning": "💭",
-        "text": "📝",
-        "tool": "🔧",
-        "info": "▶️",
-        "error": "❌"
-    }
-    emoji = emoji_map.get(event_type, "📝")
+    if progress is not None:
+        progress.append(event_type, content)
+        return buffer
+    
+    emoji = EVENT_EMOJI.get(event_type, "📝")
     
     # 累积内容
     if event_type in buffer:
@@ -225,268 +1219,1190 @@ def send_update(chat_id, event_type, content, buffer, force_send=False):
     
     # 内容太长时分段发送
     if len(current) > 1000 or force_send:
-        send_message(chat_id, f"{emoji} {current[:1000]}")
+        await send_message(chat_id, f"{emoji} {current[:1000]}")
         buffer[event_type] = current[1000:] if len(current) > 1000 else ""
     elif force_send and current:
-        send_message(chat_id, f"{emoji} {current}")
+        await send_message(chat_id, f"{emoji} {current}")
         buffer[event_type] = ""
     
     return buffer
 
-def run_opencode(prompt, chat_id, original_prompt=None, max_retries=2):
+class LiveProgress:
+    """一个任务一条进度消息
+
+    事件内容追加到当前消息，最多每 LIVE_PROGRESS_INTERVAL 秒用 editMessageText 原地更新一次；
+    当前消息写满 MAX_MESSAGE_LENGTH 后定稿，后续内容另起一条新消息。
+    """
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.message_id = None  # 当前进度消息的 id，还没发出时为 None
+        self.text = ""  # 当前消息应显示的内容
+        self.sent_text = ""  # 当前消息最近一次发出的内容
+        self.frozen = []  # 已写满、等待定稿的内容
+        self.last_type = None
+        self.last_flush = 0.0
+        self.flush_task = None
+        self.lock = asyncio.Lock()
+
+    def append(self, event_type, content):
+        content = clean_text(content)
+        if not content:
+            return
+        if event_type == self.last_type and event_type in ("text", "thinking"):
+            # 同类型的流式文本接在后面
+            piece = content
+        else:
+            emoji = EVENT_EMOJI.get(event_type, "📝")
+            line = content if content.startswith(emoji) else f"{emoji} {content}"
+            piece = f"\n{line}" if self.text else line
+        self.last_type = event_type
+        self.text += piece
+        if len(self.text) > MAX_MESSAGE_LENGTH // 2 and utf16_len(self.text) > MAX_MESSAGE_LENGTH:
+            chunks = list(split_message(self.text))
+            self.frozen.extend(chunks[:-1])
+            self.text = chunks[-1]
+        self._schedule()
+
+    def _schedule(self):
+        if self.flush_task is None:
+            delay = max(0.0, self.last_flush + LIVE_PROGRESS_INTERVAL - time.monotonic())
+            self.flush_task = spawn(self._flush_later(delay))
+
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        self.flush_task = None
+        await self.flush()
+
+    async def _send(self, text):
+        """发一条新消息，返回 message_id"""
+        result = await OUTBOX.submit(self.chat_id, "sendMessage", {"chat_id": self.chat_id, "text": text})
+        return json.loads(result)["result"]["message_id"]
+
+    async def _edit(self, message_id, text):
+        await OUTBOX.submit(self.chat_id, "editMessageText", {
+            "chat_id": self.chat_id,
+            "message_id": message_id,
+            "text": text
+        })
+
+    async def flush(self):
+        async with self.lock:
+            self.last_flush = time.monotonic()
+            try:
+                while self.frozen:
+                    text = self.frozen.pop(0)
+                    if self.message_id is None:
+                        await self._send(text)
+                    elif text != self.sent_text:
+                        await self._edit(self.message_id, text)
+                    # 定稿后后续内容另起一条
+                    self.message_id = None
+                    self.sent_text = ""
+                text = self.text
+                if not text.strip() or text == self.sent_text:
+                    return
+                if self.message_id is None:
+                    self.message_id = await self._send(text)
+                else:
+                    await self._edit(self.message_id, text)
+                self.sent_text = text
+            except Exception as e:
+                log(f"更新进度消息失败: {e}", WARNING)
+
+    async def close(self):
+        """任务结束: 取消等待中的更新，立即发出最终内容"""
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+
+def signal_group(pgid, sig):
+    """给进程组发信号，进程组已经没有进程时返回 False"""
+    try:
+        os.killpg(pgid, sig)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # macOS 上只剩僵尸进程的进程组会返回 EPERM
+        return False
+
+def group_alive(pgid):
+    """进程组里还有没退出的进程
+
+    孙进程退出后由 init 回收；容器里的 init 不一定回收，僵尸进程依然算在组里，
+    所以有 /proc 时只看非僵尸的成员。
+    """
+    if not signal_group(pgid, 0):
+        return False
+    if not os.path.isdir('/proc'):
+        return True
+    for entry in os.scandir('/proc'):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry.name}/stat', 'rb') as f:
+                fields = f.read().rpartition(b')')[2].split()
+        except OSError:
+            continue
+        # ")" 之后依次是 state ppid pgrp ...
+        if len(fields) > 2 and int(fields[2]) == pgid and fields[0] != b'Z':
+            return True
+    return False
+
+async def stop_process(process, timeout=None):
+    """结束本任务启动的整个进程组并回收子进程
+
+    子进程用 start_new_session 启动，进程组 id 就是它的 pid。先发 SIGTERM，
+    timeout 秒后组内还有进程 (包括 opencode 启动的 MCP、LSP 等孙进程) 再发 SIGKILL。
+    只影响这个任务自己的进程，不会碰到其他聊天正在运行的任务。
+    """
+    if process is None:
+        return
+    if timeout is None:
+        timeout = PROCESS_STOP_TIMEOUT
+    pgid = process.pid
+    if signal_group(pgid, signal.SIGTERM):
+        deadline = time.monotonic() + timeout
+        try:
+            await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        # 组里的其他进程不是我们的子进程，不能 wait，只能探测是否还在
+        while group_alive(pgid) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if group_alive(pgid):
+            log(f"进程组 {pgid} 在 {timeout} 秒内未退出，发送 SIGKILL", WARNING)
+            signal_group(pgid, signal.SIGKILL)
+    await process.wait()
+
+class LineSplitter:
+    """增量切行: feed() 返回已完整的行，不完整的尾部留到下一块数据
+
+    只在新数据块里出现换行时才切分，每个字节只拷贝常数次；
+    超过 STREAM_LIMIT 的单行直接丢弃，避免无限占用内存。
+    """
+
+    def __init__(self, max_line=None):
+        self.max_line = max_line or STREAM_LIMIT
+        self.pending = bytearray()
+        self.discarding = False
+
+    def feed(self, chunk):
+        if b'\n' not in chunk:
+            if not self.discarding:
+                self.pending += chunk
+                if len(self.pending) > self.max_line:
+                    log(f"丢弃超长输出行 (>{self.max_line} 字节)")
+                    self.pending.clear()
+                    self.discarding = True
+            return []
+        self.pending += chunk
+        lines = self.pending.split(b'\n')
+        self.pending = bytearray(lines.pop())
+        if self.discarding:
+            # 第一段是被丢弃的超长行的结尾
+            lines = lines[1:]
+            self.discarding = False
+        return [line for line in lines if line.strip()]
+
+    def finish(self):
+        """输出结束时返回最后一行 (没有换行结尾的情况)"""
+        rest = bytes(self.pending)
+        self.pending.clear()
+        return [rest] if rest.strip() and not self.discarding else []
+
+async def drain_stderr(stream, tail):
+    """持续读取 stderr 到有界的环形缓冲 (只保留最后 STDERR_TAIL_LINES 行)，防止管道写满"""
+    splitter = LineSplitter(max_line=STREAM_CHUNK_SIZE)
+    while True:
+        chunk = await stream.read(STREAM_CHUNK_SIZE)
+        lines = splitter.feed(chunk) if chunk else splitter.finish()
+        for line in lines:
+            tail.append(line[:STDERR_LINE_LIMIT].decode('utf-8', errors='replace'))
+        if not chunk:
+            break
+
+async def finish_stderr(task):
+    """等 stderr 读完；子进程的子进程可能还握着管道，最多等 1 秒"""
+    if task is None:
+        return
+    done, _ = await asyncio.wait([task], timeout=1)
+    if not done:
+        task.cancel()
+
+class RunResult:
+    """边读 opencode 输出边累积本次运行的结果，不再事后重新读取和解析
+
+    - 每个步骤 (step_start 到 step_finish) 记录文本片段、工具调用和结束原因
+    - 同一个 part id 的文本再次出现时覆盖旧内容，不会重复
+    - 最终回答是最后一个有文本输出的步骤的文本；没有 JSON 文本时退回非 JSON 输出行
+    - 记下事件里的 sessionID，下一个任务用它续用会话
+    """
+
+    def __init__(self):
+        self.steps = [self._new_step()]
+        self.tool_counts = {}  # 工具名 -> 调用次数
+        self.tool_errors = 0
+        self.plain_lines = deque(maxlen=STDERR_TAIL_LINES)  # 非 JSON 输出行 (只保留最后一段)
+        self.bytes = 0
+        self.session_id = None
+
+    def _new_step(self):
+        return {"texts": {}, "tools": 0, "reason": None}
+
+    def feed(self, event, size=0):
+        """处理一个 JSON 事件，size 为这一行的字节数 (只用于统计)"""
+        self.bytes += size
+        event_type = event.get('type', '')
+        part = event.get('part') or {}
+        if self.session_id is None:
+            self.session_id = event.get('sessionID') or part.get('sessionID')
+        step = self.steps[-1]
+        if event_type == 'step_start':
+            if step["texts"] or step["tools"] or step["reason"]:
+                self.steps.append(self._new_step())
+        elif event_type == 'step_finish':
+            step["reason"] = part.get('reason') or 'finish'
+        elif event_type == 'text' or part.get('type') == 'text':
+            text = part.get('text', '')
+            if text:
+                key = part.get('id') or len(step["texts"])
+                step["texts"][key] = text
+        elif event_type == 'tool_use':
+            tool = part.get('tool', '')
+            status = (part.get('state') or {}).get('status', '')
+            if tool and status in ('completed', 'error'):
+                step["tools"] += 1
+                self.tool_counts[tool] = self.tool_counts.get(tool, 0) + 1
+                if status == 'error':
+                    self.tool_errors += 1
+
+    def feed_plain(self, line):
+        """非 JSON 的输出行"""
+        self.bytes += len(line)
+        text = line.strip() if isinstance(line, str) else bytes(line).decode('utf-8', errors='replace').strip()
+        if text and not text.startswith('{'):
+            self.plain_lines.append(text)
+
+    def final_text(self):
+        for step in reversed(self.steps):
+            if step["texts"]:
+                return ''.join(step["texts"].values()).strip()
+        return '\n'.join(self.plain_lines).strip()
+
+    def summary(self):
+        """例如 "3 个步骤，5 次工具调用 (bash×3, read×2)"，没有内容时返回空字符串"""
+        steps = sum(1 for step in self.steps if step["texts"] or step["tools"] or step["reason"])
+        parts = []
+        if steps > 1:
+            parts.append(f"{steps} 个步骤")
+        if self.tool_counts:
+            tools = sorted(self.tool_counts.items(), key=lambda item: -item[1])
+            detail = ", ".join(f"{name}×{count}" for name, count in tools[:5])
+            failed = f"，{self.tool_errors} 次失败" if self.tool_errors else ""
+            parts.append(f"{sum(self.tool_counts.values())} 次工具调用 ({detail}){failed}")
+        return "，".join(parts)
+
+async def handle_stream_event(chat_id, event, content_buffer, state):
+    """处理一个 opencode JSON 事件，返回新的内容缓冲"""
+    event_type = event.get('type', '')
+    part = event.get('part', {})
+    part_type = part.get('type', '')
+    
+    # 处理不同类型的事件
+    # thinking/reasoning
+    if part_type in ['thinking', 'reasoning']:
+        thinking = part.get('text', '')
+        if thinking:
+            content_buffer = await send_update(chat_id, "thinking", thinking, content_buffer, progress=state["progress"])
+    
+    # text output
+    elif event_type == "text" or part_type == "text":
+        text = part.get('text', '')
+        if text:
+            content_buffer = await send_update(chat_id, "text", text, content_buffer, progress=state["progress"])
+    
+    # tool use
+    elif event_type == "tool_use":
+        tool_name = part.get('tool', '')
+        if tool_name:
+            tool_state = part.get('state', {})
+            status = tool_state.get('status', '')
+            
+            if status == "completed":
+                if not state["first_tool_completed"]:
+                    # 第一个工具完成，跳过显示内容（通常是读取配置）
+                    state["first_tool_completed"] = True
+                    content_buffer = await send_update(chat_id, "tool", f"🔧 {tool_name} 完成", content_buffer, force_send=True, progress=state["progress"])
+                else:
+                    # 其他工具调用显示内容
+                    result = tool_state.get('output', '')[:500] if tool_state.get('output') else ''
+                    content_buffer = await send_update(chat_id, "tool", f"🔧 {tool_name} 完成\n{result}", content_buffer, force_send=True, progress=state["progress"])
+            else:
+                content_buffer = await send_update(chat_id, "tool", f"🔧 调用 {tool_name}...", content_buffer, force_send=True, progress=state["progress"])
+    
+    # step start
+    elif event_type == "step_start":
+        content_buffer = await send_update(chat_id, "info", "▶️ 开始新步骤", content_buffer, force_send=True, progress=state["progress"])
+    
+    # error
+    elif event_type == "error":
+        error = part.get('error', '')
+        if not error:
+            error = event.get('error', {})
+        if error:
+            content_buffer = await send_update(chat_id, "error", str(error)[:500], content_buffer, force_send=True, progress=state["progress"])
+    
+    return content_buffer
+
+# ============ OpenCode 常驻进程池 ============
+class OpencodeWorker:
+    """一个常驻的 `opencode serve` 进程，任务用 `opencode run --attach` 连上去执行"""
+
+    def __init__(self, port):
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.process = None
+        self.state = "down"  # down | starting | idle | busy
+        self.uses = 0
+
+async def http_status(port, path, timeout=2):
+    """向本机端口发一个 GET，只读状态行；连不上或超时返回 None"""
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nConnection: close\r\n\r\n".encode())
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        return int(status_line.split()[1])
+    except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+        return None
+    finally:
+        if writer is not None:
+            writer.close()
+
+class WarmPool:
+    """常驻 opencode 进程池，省掉每个任务加载配置、provider、MCP 的冷启动
+
+    任务开始时借出一个空闲且健康的进程，结束后归还；执行满 OPENCODE_WORKER_MAX_USES
+    个任务或任务失败的进程会被重启。没有空闲进程时任务退回冷启动。
+    """
+
+    def __init__(self, size, base_port):
+        self.workers = [OpencodeWorker(base_port + i) for i in range(size)]
+        self.health_task = None
+
+    def start(self):
+        for worker in self.workers:
+            worker.state = "starting"
+            spawn(self._launch(worker))
+        if self.workers:
+            self.health_task = spawn(self._health_loop())
+
+    async def healthy(self, worker):
+        if worker.process is None or worker.process.returncode is not None:
+            return False
+        return await http_status(worker.port, OPENCODE_HEALTH_PATH) == 200
+
+    async def _launch(self, worker):
+        env = os.environ.copy()
+        env.update(OPENCODE_ENV)
+        try:
+            worker.process = await asyncio.create_subprocess_exec(
+                "opencode", "serve", "--hostname", "127.0.0.1", "--port", str(worker.port),
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+                env=env,
+                start_new_session=True
+            )
+        except OSError as e:
+            log(f"常驻 opencode 启动失败 (端口 {worker.port}): {e}")
+            worker.state = "down"
+            return
+        deadline = time.monotonic() + OPENCODE_WORKER_START_TIMEOUT
+        while time.monotonic() < deadline and worker.process.returncode is None:
+            if await self.healthy(worker):
+                worker.uses = 0
+                worker.state = "idle"
+                log(f"常驻 opencode 就绪: {worker.url} (pid {worker.process.pid})")
+                return
+            await asyncio.sleep(0.2)
+        log(f"常驻 opencode 未能就绪 (端口 {worker.port})")
+        await stop_process(worker.process)
+        worker.state = "down"
+
+    async def _recycle(self, worker):
+        """结束旧进程并在同一端口重新启动"""
+        if worker.process is not None:
+            await stop_process(worker.process)
+        await self._launch(worker)
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(OPENCODE_HEALTH_INTERVAL)
+            for worker in self.workers:
+                if worker.state == "idle" and not await self.healthy(worker):
+                    log(f"常驻 opencode 健康检查失败，重启: {worker.url}")
+                    worker.state = "starting"
+                    spawn(self._recycle(worker))
+                elif worker.state == "down":
+                    worker.state = "starting"
+                    spawn(self._launch(worker))
+
+    async def acquire(self):
+        """借出一个空闲且健康的进程，没有则返回 None (任务冷启动)"""
+        for worker in self.workers:
+            if worker.state != "idle":
+                continue
+            worker.state = "busy"
+            if await self.healthy(worker):
+                return worker
+            log(f"常驻 opencode 不可用，重启: {worker.url}")
+            worker.state = "starting"
+            spawn(self._recycle(worker))
+        return None
+
+    def release(self, worker, ok):
+        if worker is None:
+            return
+        worker.uses += 1
+        if ok and worker.uses < OPENCODE_WORKER_MAX_USES:
+            worker.state = "idle"
+            return
+        log(f"重启常驻 opencode: {worker.url} (已执行 {worker.uses} 个任务)")
+        worker.state = "starting"
+        spawn(self._recycle(worker))
+
+    def kill_all(self):
+        """退出或重启 bot 前结束所有常驻进程 (同步，可在 atexit 中调用)"""
+        for worker in self.workers:
+            if worker.process is not None and worker.process.returncode is None:
+                signal_group(worker.process.pid, signal.SIGKILL)
+
+WARM_POOL = WarmPool(OPENCODE_WARM_WORKERS, OPENCODE_WORKER_PORT)
+atexit.register(WARM_POOL.kill_all)
+
+# ============ 快照清理 ============
+class SnapshotGC:
+    """后台清理 opencode 快照目录，按总大小和存放时间删除，不在任务里同步清理
+
+    快照目录下每个子目录是一个项目的快照仓库，运行中的任务会不断写入。任务开始时登记，
+    结束时注销；任何运行中的任务开始之后改动过的子目录都视为正在使用，不会删除。
+    扫描和删除是阻塞的磁盘操作，放在线程池里执行，不占用事件循环。
+    """
+
+    def __init__(self, path, max_bytes, max_age, interval):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.interval = interval
+        self.live = {}  # 任务标识 -> 开始时间
+        self.next_token = 1
+        self.wakeup = None
+        self.task = None
+        self.freed = 0  # 累计释放的字节数
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = spawn(self._loop())
+
+    def job_started(self):
+        token = self.next_token
+        self.next_token += 1
+        self.live[token] = time.time()
+        return token
+
+    def job_finished(self, token):
+        self.live.pop(token, None)
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.collect()
+
+    async def collect(self):
+        """清理一次，返回 (删除的目录数, 释放的字节数)"""
+        # 运行中最早的任务开始之后改动过的目录不删 (留 60 秒余量应对时钟和 mtime 精度)
+        protected_since = min(self.live.values()) - 60 if self.live else None
+        try:
+            deleted, freed, total = await asyncio.get_running_loop().run_in_executor(
+                None, self._collect, protected_since)
+        except Exception as e:
+            log(f"清理快照失败: {e}", WARNING)
+            return 0, 0
+        if deleted:
+            self.freed += freed
+            log(f"已清理 {deleted} 个快照，释放 {freed / 1024 / 1024:.1f} MB，剩余 {total / 1024 / 1024:.1f} MB")
+        return deleted, freed
+
+    def _collect(self, protected_since):
+        """在线程池中执行: 先删过期的，再从最旧的开始删到总大小不超过预算"""
+        entries = []
+        try:
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        size, mtime = tree_usage(entry.path)
+                        entries.append((mtime, size, entry.path))
+        except FileNotFoundError:
+            return 0, 0, 0
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        deleted = freed = 0
+        for mtime, size, path in entries:
+            if protected_since is not None and mtime >= protected_since:
+                continue
+            if mtime >= now - self.max_age and total <= self.max_bytes:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            deleted += 1
+            freed += size
+            total -= size
+        return deleted, freed, total
+
+def tree_usage(path):
+    """目录下所有文件的总大小和最近的修改时间 (os.scandir 递归，不跟随符号链接)"""
+    size = 0
+    mtime = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    mtime = max(mtime, stat.st_mtime)
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        size += stat.st_size
+        except OSError:
+            continue
+    return size, mtime
+
+SNAPSHOT_GC = SnapshotGC(SNAPSHOT_DIR, SNAPSHOT_MAX_BYTES, SNAPSHOT_MAX_AGE, SNAPSHOT_GC_INTERVAL)
+
+def build_opencode_cmd(prompt, worker=None, session_id=None, fork=False):
+    """拼出 opencode run 的参数列表 (直接 exec，不经过 shell)；有常驻进程时通过 --attach 连接它，
+    有会话时续用 (或分叉) 该会话"""
+    cmd = ["opencode", "run"]
+    if worker is not None:
+        cmd += ["--attach", worker.url]
+    if session_id:
+        cmd += ["--session", session_id]
+        if fork:
+            cmd.append("--fork")
+    return cmd + ["--model", OPENCODE_MODEL, "--format", "json", "--", prompt]
+
+class JobTimeout(Exception):
+    """任务超过时间上限，或 opencode 长时间没有输出"""
+
+    def __init__(self, message, retry):
+        super().__init__(message)
+        self.retry = retry  # 没有输出时可以重试；超过总时间上限不再重试
+
+async def run_opencode(prompt, chat_id, original_prompt=None, max_retries=2, session_id=None, fork=False, job_id=None):
     if original_prompt is None:
         original_prompt = prompt
+    if job_id is None:
+        job_id = Job.next_id()
     
-    attempt = 0
-    last_error = None
+    # 总时间上限对整个任务计算，重试不会重新计时
+    job_start = time.monotonic()
+    deadline = job_start + JOB_TIMEOUT
+    outcome = "error"  # 指标里的任务结果: ok | error | timeout | cancelled
+    METRICS.job_messages[chat_id] = 0
+    trace = TRACES.start(job_id, chat_id)
     
-    while attempt <= max_retries:
-        if attempt > 0:
-            log(f"第 {attempt} 次重试: {prompt[:50]}...")
-            send_message(chat_id, f"🔄 第 {attempt} 次重试...")
-            send_typing(chat_id)
-            time.sleep(2)
-        else:
-            log(f"开始执行: {prompt[:50]}...")
-            # 显示任务描述
-            display_prompt = original_prompt[:100] + "..." if len(original_prompt) > 100 else original_prompt
-            send_message(chat_id, f"🔄 正在执行: {display_prompt}")
-            send_typing(chat_id)
+    # 任务运行期间该聊天持续显示 "正在输入"；登记为运行中，快照清理不会删除它正在用的快照
+    TYPING.start(chat_id)
+    snapshot_token = SNAPSHOT_GC.job_started()
+    try:
+        attempt = 0
+        last_error = None
+    
+        while attempt <= max_retries:
+            if attempt > 0:
+                log(f"第 {attempt} 次重试: {prompt[:50]}...")
+                await send_message(chat_id, f"🔄 第 {attempt} 次重试...")
+                await asyncio.sleep(2)
+                if session_id:
+                    # 会话可能已失效或留下了半个回合，重试改为新会话，上下文退回记忆文本
+                    MEMORY_STORE.drop_session(chat_id)
+                    session_id, fork = None, False
+                    prompt = build_prompt_with_memory(original_prompt, chat_id)
+            else:
+                log(f"开始执行: {prompt[:50]}...")
+                # 显示任务描述
+                display_prompt = original_prompt[:100] + "..." if len(original_prompt) > 100 else original_prompt
+                await send_message(chat_id, f"🔄 正在执行: {display_prompt}")
         
-        import shlex
-        safe_prompt = shlex.quote(prompt)
-        cmd = f'opencode run --model {OPENCODE_MODEL} --format json -- {safe_prompt}'
-        log(f"CMD: {cmd}")
+            acquire_start = time.monotonic()
+            worker = await WARM_POOL.acquire()
+            cmd = build_opencode_cmd(prompt, worker, session_id, fork)
+            log(f"CMD: {shlex.join(cmd)}", DEBUG)
         
-        try:
-            env = os.environ.copy()
-            env.update(OPENCODE_ENV)
+            process = None
+            stderr_task = None
+            progress = None
+            try:
+                env = os.environ.copy()
+                env.update(OPENCODE_ENV)
             
-            # 使用 Popen 实现流式输出
-            process = subprocess.Popen(
-                cmd,
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                env=env
-            )
+                # stdout / stderr 都由事件循环 (epoll) 同时以大块读取，不再轮询；
+                # 每个任务一个独立的进程组，结束时只清理自己的进程
+                spawn_start = time.monotonic()
+                process = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    env=env,
+                    limit=STREAM_CHUNK_SIZE,
+                    start_new_session=True
+                )
+                stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+                stderr_task = spawn(drain_stderr(process.stderr, stderr_tail))
+                process_start = time.monotonic()
+                trace.spawned(attempt, spawn_start - acquire_start, process_start - spawn_start, worker is not None)
+                first_event = True
             
-            # 内容缓冲
-            content_buffer = {}
-            last_update_time = time.time()
-            update_interval = 60  # 每 60 秒发送一次保底更新
-            first_tool_completed = False  # 跟踪第一个工具调用完成
+                # 内容缓冲
+                content_buffer = {}
+                last_update_time = time.time()
+                last_output = time.monotonic()  # 最近一次收到 opencode 输出的时间 (看门狗)
+                update_interval = 60  # 每 60 秒发送一次保底更新
+                progress = LiveProgress(chat_id) if LIVE_PROGRESS else None
+                stream_state = {
+                    "first_tool_completed": False,  # 跟踪第一个工具调用完成
+                    "progress": progress
+                }
+                splitter = LineSplitter()
+                result = RunResult()
             
-            # 流式读取输出
-            while True:
-                # 检查进程是否结束
-                if process.poll() is not None:
-                    # 处理剩余内容
-                    for event_type, content in content_buffer.items():
-                        if content:
-                            if event_type == "thinking":
-                                send_message(chat_id, f"💭 {content}")
-                            elif event_type == "text":
-                                send_message(chat_id, f"📝 {content}")
-                            elif event_type == "tool":
-                                send_message(chat_id, f"🔧 {content}")
-                            elif event_type == "error":
-                                send_message(chat_id, f"❌ {content}")
-                    break
-                
-                # 实时读取输出
-                line = None
-                if process.stdout:
-                    line = process.stdout.readline()
-                if line:
+                # 流式读取输出: 等待下一块数据、保底更新、看门狗或总时间上限到期，空闲时不占用 CPU
+                while True:
+                    now = time.monotonic()
+                    timeout = max(0, min(update_interval - (time.time() - last_update_time),
+                                         last_output + JOB_IDLE_TIMEOUT - now,
+                                         deadline - now))
                     try:
-                        event = json.loads(line.strip())
-                        event_type = event.get('type', '')
-                        part = event.get('part', {})
-                        part_type = part.get('type', '')
-                        
-                        # 处理不同类型的事件
-                        # thinking/reasoning
-                        if part_type in ['thinking', 'reasoning']:
-                            thinking = part.get('text', '')
-                            if thinking:
-                                content_buffer = send_update(chat_id, "thinking", thinking, content_buffer)
-                        
-                        # text output
-                        elif event_type == "text" or part_type == "text":
-                            text = part.get('text', '')
-                            if text:
-                                content_buffer = send_update(chat_id, "text", text, content_buffer)
-                        
-                        # tool use
-                        elif event_type == "tool_use":
-                            tool_name = part.get('tool', '')
-                            if tool_name:
-                                state = part.get('state', {})
-                                status = state.get('status', '')
-                                
-                                if status == "completed":
-                                    if not first_tool_completed:
-                                        # 第一个工具完成，跳过显示内容（通常是读取配置）
-                                        first_tool_completed = True
-                                        content_buffer = send_update(chat_id, "tool", f"🔧 {tool_name} 完成", content_buffer, force_send=True)
-                                    else:
-                                        # 其他工具调用显示内容
-                                        result = state.get('output', '')[:500] if state.get('output') else ''
-                                        content_buffer = send_update(chat_id, "tool", f"🔧 {tool_name} 完成\n{result}", content_buffer, force_send=True)
-                                else:
-                                    content_buffer = send_update(chat_id, "tool", f"🔧 调用 {tool_name}...", content_buffer, force_send=True)
-                        
-                        # step start
-                        elif event_type == "step_start":
-                            content_buffer = send_update(chat_id, "info", "▶️ 开始新步骤", content_buffer, force_send=True)
-                        
-                        # error
-                        elif event_type == "error":
-                            error = part.get('error', '')
-                            if not error:
-                                error = event.get('error', {})
-                            if error:
-                                content_buffer = send_update(chat_id, "error", str(error)[:500], content_buffer, force_send=True)
-                        
-                        send_typing(chat_id)
+                        chunk = await asyncio.wait_for(process.stdout.read(STREAM_CHUNK_SIZE), timeout)
+                    except asyncio.TimeoutError:
+                        chunk = None
                     
-                    except json.JSONDecodeError:
-                        pass
+                    now = time.monotonic()
+                    if chunk is not None:
+                        last_output = now
+                        METRICS.inc("opencode_bot_stream_bytes_total", len(chunk))
+                    elif now >= deadline:
+                        raise JobTimeout(f"超过 {JOB_TIMEOUT // 60} 分钟的时间上限", retry=False)
+                    elif now - last_output >= JOB_IDLE_TIMEOUT:
+                        raise JobTimeout(f"{JOB_IDLE_TIMEOUT} 秒没有任何输出", retry=True)
+                
+                    # 每个完整的行 (一个 JSON 事件) 到达后立即处理
+                    if chunk:
+                        lines = splitter.feed(chunk)
+                    elif chunk == b'':
+                        lines = splitter.finish()
+                    else:
+                        lines = ()
+                    for line in lines:
+                        try:
+                            event = json.loads(line)
+                        except ValueError:
+                            result.feed_plain(line)
+                            continue
+                        if isinstance(event, dict):
+                            if first_event:
+                                first_event = False
+                                METRICS.observe("opencode_bot_job_first_event_seconds", time.monotonic() - process_start)
+                                trace.add("first_event", seconds=round(time.monotonic() - process_start, 4))
+                            result.feed(event, len(line))
+                            trace.stream_event(event)
+                            content_buffer = await handle_stream_event(chat_id, event, content_buffer, stream_state)
                 
-                # 定期发送保底更新
-                current_time = time.time()
-                if current_time - last_update_time > update_interval:
-                    elapsed_minutes = (attempt * 1800 + int(current_time - last_update_time)) // 60
+                    # stdout 关闭，进程输出结束
+                    if chunk == b'':
+                        # 处理剩余内容
+                        for event_type, content in content_buffer.items():
+                            if content:
+                                if event_type == "thinking":
+                                    await send_message(chat_id, f"💭 {content}")
+                                elif event_type == "text":
+                                    await send_message(chat_id, f"📝 {content}")
+                                elif event_type == "tool":
+                                    await send_message(chat_id, f"🔧 {content}")
+                                elif event_type == "error":
+                                    await send_message(chat_id, f"❌ {content}")
+                        break
+                
+                    # 定期发送保底更新
+                    current_time = time.time()
+                    if current_time - last_update_time > update_interval:
+                        elapsed_minutes = int(time.monotonic() - job_start) // 60
                     
-                    # 发送当前缓冲的内容
-                    for event_type, content in content_buffer.items():
-                        if content:
-                            emoji_map = {"thinking": "💭", "text": "📝", "tool": "🔧", "info": "▶️", "error": "❌"}
-                            emoji = emoji_map.get(event_type, "📝")
-                            send_message(chat_id, f"{emoji} {content[:500]}")
+                        # 发送当前缓冲的内容
+                        for event_type, content in content_buffer.items():
+                            if content:
+                                emoji = EVENT_EMOJI.get(event_type, "📝")
+                                await send_message(chat_id, f"{emoji} {content[:500]}")
                     
-                    content_buffer = {}
-                    send_message(chat_id, f"⏳ 仍在运行中... ({elapsed_minutes} 分钟)")
-                    send_typing(chat_id)
-                    last_update_time = current_time
-                
-                time.sleep(0.05)
+                        content_buffer = {}
+                        if progress is not None:
+                            progress.append("wait", f"仍在运行中... ({elapsed_minutes} 分钟)")
+                        else:
+                            await send_message(chat_id, f"⏳ 仍在运行中... ({elapsed_minutes} 分钟)")
+                        last_update_time = current_time
             
-            # 等待进程完全结束
-            process.wait()
+                # 进度消息定稿
+                if progress is not None:
+                    await progress.close()
             
-            # 清理残留进程
-            subprocess.run("pkill -f 'opencode.*run --format'", shell=True, capture_output=True)
+                # 等待进程完全结束
+                await process.wait()
+                await finish_stderr(stderr_task)
+                trace.add("exit", code=process.returncode)
+                if process.returncode:
+                    log(f"opencode 退出码 {process.returncode}，stderr 末尾:\n" + "\n".join(list(stderr_tail)[-20:]))
             
-            full_output = process.stdout.read() if process.stdout else ""
-            output_lines = full_output.split('\n') if full_output else []
-            log(f"输出长度: {len(full_output)}")
+                # 清理本任务进程组里残留的进程 (opencode 启动的 MCP、LSP 等)
+                await stop_process(process)
             
-            # 解析输出
-            final_text = parse_opencode_output(output_lines)
-            log(f"解析结果: {len(final_text)}")
+                # 结果已在读取输出时累积好
+                final_text = result.final_text()
+                summary = result.summary()
+                log(f"输出长度: {result.bytes}，最终回答长度: {len(final_text)}", DEBUG)
             
-            # 发送完成消息 (内容已在实时流中发送，简短提示即可)
-            if final_text and len(final_text) > 100:
-                send_message(chat_id, f"✅ 执行完成\n\n{final_text[:500]}...")
-            elif final_text:
-                send_message(chat_id, f"✅ 执行完成\n\n{final_text}")
-            else:
-                send_message(chat_id, "✅ 执行完成")
+                # 发送完成消息 (内容已在实时流中发送，简短提示即可)
+                title = f"✅ 执行完成 ({summary})" if summary else "✅ 执行完成"
+                if final_text and len(final_text) > 500:
+                    await send_message(chat_id, f"{title}\n\n{final_text[:500]}...")
+                elif final_text:
+                    await send_message(chat_id, f"{title}\n\n{final_text}")
+                else:
+                    await send_message(chat_id, title)
             
-            # 保存到记忆
-            save_to_memory(chat_id, original_prompt, final_text if final_text else "")
+                # 保存到记忆，记下会话供下一个任务续用
+                save_to_memory(chat_id, original_prompt, final_text if final_text else "")
+                if OPENCODE_SESSION_TTL > 0 and result.session_id:
+                    MEMORY_STORE.set_session(chat_id, result.session_id)
             
-            log(f"执行完成")
-            break
+                log(f"执行完成")
+                outcome = "ok"
+                break
             
-        except subprocess.TimeoutExpired:
-            log(f"执行超时 (尝试 {attempt + 1}/{max_retries + 1})")
-            last_error = "执行超时"
-            # 清理残留进程
-            subprocess.run("pkill -f 'opencode.*run --format'", shell=True, capture_output=True)
-            attempt += 1
-            if attempt > max_retries:
-                send_message(chat_id, "❌ 执行超时，已重试多次")
-        except Exception as e:
-            log(f"执行错误: {e}")
-            last_error = str(e)
-            # 清理残留进程
-            subprocess.run("pkill -f 'opencode.*run --format'", shell=True, capture_output=True)
-            attempt += 1
-            if attempt > max_retries:
-                send_message(chat_id, f"❌ 错误:\n\n{last_error}")
-            else:
-                time.sleep(2)
-    
-    # 清理快照目录
-    try:
-        snapshot_dir = os.path.expanduser("~/.local/share/opencode/snapshot")
-        if os.path.exists(snapshot_dir):
-            for item in os.listdir(snapshot_dir):
-                item_path = os.path.join(snapshot_dir, item)
-                if os.path.isdir(item_path):
-                    subprocess.run(["rm", "-rf", item_path], capture_output=True)
-            log("已清理快照目录")
-    except Exception as e:
-        log(f"清理快照失败: {e}")
+            except JobTimeout as e:
+                log(f"执行超时 (尝试 {attempt + 1}/{max_retries + 1}): {e}", WARNING)
+                last_error = str(e)
+                if progress is not None:
+                    await progress.close()
+                # 结束本任务的进程组，释放占用的名额
+                await stop_process(process)
+                await finish_stderr(stderr_task)
+                attempt += 1
+                if not e.retry or attempt > max_retries or time.monotonic() >= deadline:
+                    await send_message(chat_id, f"❌ 执行超时 ({last_error})，已结束任务")
+                    outcome = "timeout"
+                    break
+            except asyncio.CancelledError:
+                # /cancel: 结束本任务的进程组后继续向上传递取消
+                log(f"任务已取消: {prompt[:50]}...")
+                outcome = "cancelled"
+                if progress is not None:
+                    await progress.close()
+                await stop_process(process)
+                await finish_stderr(stderr_task)
+                raise
+            except Exception as e:
+                log(f"执行错误: {e}", ERROR)
+                last_error = str(e)
+                if progress is not None:
+                    await progress.close()
+                # 结束本次启动的整个进程组
+                await stop_process(process)
+                await finish_stderr(stderr_task)
+                attempt += 1
+                if attempt > max_retries:
+                    await send_message(chat_id, f"❌ 错误:\n\n{last_error}")
+                else:
+                    await asyncio.sleep(2)
+            finally:
+                # 常驻进程归还进程池，失败的会被重启
+                WARM_POOL.release(worker, ok=process is not None and process.returncode == 0)
     
-    RUNNING_TASKS[chat_id] = False
+    finally:
+        TYPING.stop(chat_id)
+        SNAPSHOT_GC.job_finished(snapshot_token)
+        labels = (("outcome", outcome),)
+        METRICS.inc("opencode_bot_jobs_total", 1, labels)
+        METRICS.observe("opencode_bot_job_duration_seconds", time.monotonic() - job_start, labels)
+        METRICS.observe("opencode_bot_job_messages", METRICS.job_messages.pop(chat_id, 0))
+        TRACES.finish(trace, outcome)
 
-def parse_opencode_output(output_lines):
-    try:
-        texts = []
-        for line in output_lines:
-            if not line:
-                continue
-            line_str = line.strip() if isinstance(line, str) else str(line).strip()
-            if not line_str:
-                continue
+# ============ 任务调度 ============
+TASK_SPACE_RE = re.compile(r'\s+')
+
+def task_key(chat_id, text):
+    """任务的指纹: 规范化后的文本 (NFKC、忽略大小写、合并空白) 加上该聊天当前的记忆和会话状态"""
+    normalized = TASK_SPACE_RE.sub(' ', unicodedata.normalize('NFKC', text)).strip().casefold()
+    state = MEMORY_STORE.state(chat_id)
+    return hashlib.sha1(f"{chat_id}\0{state}\0{normalized}".encode('utf-8')).digest()
+
+class Job:
+    """一次用户任务"""
+    _next_id = 1
+
+    def __init__(self, chat_id, text):
+        self.id = Job.next_id()
+        self.chat_id = chat_id
+        self.text = text
+        self.created = time.time()
+        self.key = task_key(chat_id, text)
+        self.last_submit = self.created  # 最近一次收到相同任务的时间
+        self.duplicates = 0  # 合并进来的重复请求数
+        self.task = None  # 运行时的 asyncio 任务，/cancel 时取消它
+
+    @staticmethod
+    def next_id():
+        """任务编号 (/jobs/<id>/trace 用它查询时间线)；直接调用 run_opencode 时也从这里取"""
+        job_id = Job._next_id
+        Job._next_id += 1
+        return job_id
+
+class JobScheduler:
+    """任务调度: 每个聊天一个有界 FIFO 队列，同一聊天的任务依次执行；
+    全局最多 MAX_WORKERS 个任务同时运行，等待的聊天按先来先服务获得空位"""
+
+    def __init__(self):
+        self.queues = {}  # chat_id -> deque[Job]，等待中的任务
+        self.running = {}  # chat_id -> 正在运行的 Job
+        self.ready = deque()  # 有任务在等待空位的聊天 (先来先服务)
+        self.coalesced = 0  # 合并到已有任务的重复请求数
+
+    def coalesce(self, chat_id, text):
+        """COALESCE_WINDOW 内已有相同任务在运行或排队时，合并到该任务并返回它；否则返回 None"""
+        if COALESCE_WINDOW <= 0:
+            return None
+        running = self.running.get(chat_id)
+        queued = self.queues.get(chat_id, ())
+        if running is None and not queued:
+            return None
+        key = task_key(chat_id, text)
+        now = time.time()
+        for job in (running, *queued):
+            if job is not None and job.key == key and now - job.last_submit <= COALESCE_WINDOW:
+                job.last_submit = now
+                job.duplicates += 1
+                self.coalesced += 1
+                return job
+        return None
+
+    def submit(self, chat_id, text):
+        """加入队列；返回前面还有几个任务 (0 表示马上开始)，队列已满返回 None"""
+        queue = self.queues.setdefault(chat_id, deque())
+        if len(queue) >= CHAT_QUEUE_LIMIT:
+            return None
+        queue.append(Job(chat_id, text))
+        if chat_id not in self.running and chat_id not in self.ready:
+            self.ready.append(chat_id)
+        self._dispatch()
+        return self.position(chat_id, len(queue) - 1)
+
+    def position(self, chat_id, index):
+        """队列中第 index 个任务前面还有几个任务"""
+        if chat_id not in self.queues or index >= len(self.queues[chat_id]):
+            return 0
+        ahead = index + (1 if chat_id in self.running else 0)
+        if chat_id in self.ready:
+            # 全局没有空位: 等一个运行中的任务结束，且排在前面的聊天先拿到空位
+            ahead += self.ready.index(chat_id) + 1
+        return ahead
+
+    def _dispatch(self):
+        while self.ready and len(self.running) < MAX_WORKERS:
+            chat_id = self.ready.popleft()
+            job = self.queues[chat_id].popleft()
+            if not self.queues[chat_id]:
+                del self.queues[chat_id]
+            self.running[chat_id] = job
+            job.task = spawn(self._run(job))
+
+    async def _run(self, job):
+        try:
+            # 开始执行时才构建 prompt，这样能带上排在前面的任务的记忆；
+            # 续用会话时上下文已在会话里，不再重复发送记忆文本
+            job.key = task_key(job.chat_id, job.text)  # 排队期间记忆可能已更新，按开始时的状态匹配重复请求
+            session_id, fork = MEMORY_STORE.session(job.chat_id, OPENCODE_SESSION_TTL)
+            if session_id:
+                prompt = build_prompt(job.text)
+            else:
+                prompt = build_prompt_with_memory(job.text, job.chat_id)
+            await run_opencode(prompt, job.chat_id, job.text, session_id=session_id, fork=fork, job_id=job.id)
+        except Exception as e:
+            log(f"任务 {job.id} 异常: {e}")
+        finally:
+            del self.running[job.chat_id]
+            if job.chat_id in self.queues:
+                self.ready.append(job.chat_id)
+            self._dispatch()
+
+    def cancel(self, chat_id):
+        """取消该聊天正在运行的任务 (进程组由 run_opencode 结束)；没有运行中的任务返回 None"""
+        job = self.running.get(chat_id)
+        if job is None or job.task is None or job.task.done():
+            return None
+        job.task.cancel()
+        return job
+
+    def queued(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def status_text(self, chat_id):
+        """/status 的回复内容"""
+        lines = []
+        if chat_id in self.running:
+            job = self.running[chat_id]
+            lines.append(f"⏳ 任务 #{job.id} 运行中 ({int(time.time() - job.created)} 秒): {job.text[:50]}")
+            if job.duplicates:
+                lines.append(f"🔁 合并了 {job.duplicates} 次重复发送")
+        else:
+            lines.append("✅ 空闲")
+        waiting = len(self.queues.get(chat_id, ()))
+        if waiting:
+            lines.append(f"📥 本聊天排队: {waiting}/{CHAT_QUEUE_LIMIT}")
+        lines.append(f"🖥️ 全局: 运行 {len(self.running)}/{MAX_WORKERS}，排队 {self.queued()}，等待空位的聊天 {len(self.ready)}")
+        return "\n".join(lines)
+
+SCHEDULER = JobScheduler()
+
+# ============ 对话记忆 ============
+class MemoryStore:
+    """每个聊天最近 rounds 轮任务和结果以及续用的 opencode 会话，存在 SQLite 里，重启后依然可用
+
+    每个聊天在表中最多 rounds 行，按 seq % rounds 覆盖写入同一个槽位 (环形缓冲)，
+    读取只走 (chat_id, slot) 主键。最近用过的聊天缓存在内存里 (OrderedDict 按最近
+    使用排序)，超过 cache_size 个或空闲超过 idle 秒就移出内存，下次用到时再从数据库读。
+    """
+
+    def __init__(self, rounds, db_path, cache_size, idle):
+        self.size = max(0, rounds)
+        self.cache_size = cache_size
+        self.idle = idle
+        # chat_id -> {"seq": 最后一轮的序号, "rounds": deque, "session": (会话 id, 最近使用时间) 或 None,
+        #             "fork": 下一个任务是否分叉会话, "used": 最近使用时间}
+        self.cache = OrderedDict()
+        self.db = None
+        try:
+            self.db = sqlite3.connect(db_path or ":memory:", isolation_level=None, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS memory ("
+                "chat_id INTEGER NOT NULL, slot INTEGER NOT NULL, seq INTEGER NOT NULL, "
+                "task TEXT NOT NULL, result TEXT NOT NULL, PRIMARY KEY (chat_id, slot)) WITHOUT ROWID")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "chat_id INTEGER PRIMARY KEY, session_id TEXT NOT NULL, used REAL NOT NULL)")
+        except sqlite3.Error as e:
+            log(f"记忆数据库不可用，只保存在内存中: {e}", ERROR)
+            self.db = None
+
+    def rounds(self, chat_id):
+        """按时间顺序返回 [{"task": ..., "result": ...}, ...]"""
+        if self.size == 0:
+            return []
+        return list(self._entry(chat_id)["rounds"])
+
+    def save(self, chat_id, task, result):
+        if self.size == 0:
+            return
+        entry = self._entry(chat_id)
+        entry["seq"] += 1
+        entry["rounds"].append({"task": task, "result": result})
+        if self.db is not None:
             try:
-                event = json.loads(line_str)
-                event_type = event.get('type', '')
-                part = event.get('part', {})
-                part_type = part.get('type', '')
-                
-                # text output
-                if event_type == 'text' or part_type == 'text':
-                    text = part.get('text', '')
-                    if text:
-                        texts.append(text)
-                
-                # step_finish - get final text if available
-                elif event_type == 'step_finish':
-                    # Check if there's any final content
-                    reason = part.get('reason', '')
-                    if reason == 'stop':
-                        # This is the final step, could contain summary
-                        pass
-            except (json.JSONDecodeError, TypeError):
-                if line_str and not line_str.startswith('{'):
-                    texts.append(line_str)
-        
-        result = ''.join(texts)
-        
-        # 如果没有 JSON 输出，尝试使用原始行
-        if not result.strip():
-            result = '\n'.join([l for l in output_lines if l and l.strip() and not l.strip().startswith('{')])
-        
-        return result.strip()
-        
-    except Exception as e:
-        log(f"解析输出错误: {e}")
-        return '\n'.join(str(o) for o in output_lines)
+                self.db.execute(
+                    "INSERT OR REPLACE INTO memory (chat_id, slot, seq, task, result) VALUES (?, ?, ?, ?, ?)",
+                    (chat_id, entry["seq"] % self.size, entry["seq"], task, result))
+            except sqlite3.Error as e:
+                log(f"写入记忆失败: {e}", ERROR)
 
-# ============ Webhook 路由 ============
-@app.route('/webhook', methods=['POST'])
-def webhook():
+    def clear(self, chat_id):
+        """清除记忆，会话里的上下文也一起丢弃"""
+        self.cache.pop(chat_id, None)
+        if self.db is not None:
+            try:
+                self.db.execute("DELETE FROM memory WHERE chat_id = ?", (chat_id,))
+                self.db.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+            except sqlite3.Error as e:
+                log(f"清除记忆失败: {e}", ERROR)
+
+    def state(self, chat_id):
+        """记忆和会话的版本 (最后一轮的序号、会话 id)，记忆或会话变化后随之改变"""
+        entry = self._entry(chat_id)
+        return entry["seq"], entry["session"] and entry["session"][0]
+
+    def session(self, chat_id, ttl):
+        """续用的会话: 返回 (会话 id, 是否分叉)；没有会话或空闲超过 ttl 秒返回 (None, False)"""
+        entry = self._entry(chat_id)
+        if entry["session"] is None or entry["session"][1] < time.time() - ttl:
+            return None, False
+        return entry["session"][0], entry["fork"]
+
+    def set_session(self, chat_id, session_id):
+        entry = self._entry(chat_id)
+        entry["session"] = (session_id, time.time())
+        entry["fork"] = False
+        self._execute("INSERT OR REPLACE INTO sessions (chat_id, session_id, used) VALUES (?, ?, ?)",
+                      (chat_id, session_id, entry["session"][1]))
+
+    def fork_session(self, chat_id):
+        """下一个任务从当前会话分叉出新会话，原会话保持不变；没有会话返回 False"""
+        entry = self._entry(chat_id)
+        if entry["session"] is None:
+            return False
+        entry["fork"] = True
+        return True
+
+    def drop_session(self, chat_id):
+        entry = self._entry(chat_id)
+        entry["session"] = None
+        entry["fork"] = False
+        self._execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+
+    def _execute(self, sql, args):
+        if self.db is None:
+            return
+        try:
+            self.db.execute(sql, args)
+        except sqlite3.Error as e:
+            log(f"写入会话失败: {e}", ERROR)
+
+    def _entry(self, chat_id):
+        now = time.time()
+        entry = self.cache.get(chat_id)
+        if entry is None:
+            entry = self._load(chat_id)
+            self.cache[chat_id] = entry
+        entry["used"] = now
+        self.cache.move_to_end(chat_id)
+        # 淘汰空闲和超出数量的聊天 (头部是最久没用的)
+        while len(self.cache) > self.cache_size or next(iter(self.cache.values()))["used"] < now - self.idle:
+            self.cache.popitem(last=False)
+        return entry
+
+    def _load(self, chat_id):
+        rows = []
+        if self.db is not None:
+            try:
+                rows = self.db.execute(
+                    "SELECT seq, task, result FROM memory WHERE chat_id = ? ORDER BY seq DESC LIMIT ?",
+                    (chat_id, self.size)).fetchall() if self.size else []
+                session = self.db.execute(
+                    "SELECT session_id, used FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+            except sqlite3.Error as e:
+                log(f"读取记忆失败: {e}", ERROR)
+                session = None
+        else:
+            session = None
+        rounds = deque(({"task": task, "result": result} for _, task, result in reversed(rows)), maxlen=self.size)
+        return {"seq": rows[0][0] if rows else 0, "rounds": rounds, "session": session, "fork": False, "used": 0}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+MEMORY_STORE = MemoryStore(MEMORY_ROUNDS, MEMORY_DB, MEMORY_CACHE_CHATS, MEMORY_CACHE_IDLE)
+atexit.register(MEMORY_STORE.close)
+
+# ============ update 去重 ============
+class UpdateDeduplicator:
+    """记住最近处理过的 update_id，Telegram 重发的 update 不再分发
+
+    内存里是有界的 LRU (OrderedDict 按最近一次收到的时间排序，超过 ttl 的从头部淘汰)；
+    指定 db_path 时同时写入 SQLite，重启后依然能识别重发。
+    """
+
+    def __init__(self, size, ttl, db_path=None):
+        self.size = size
+        self.ttl = ttl
+        self.recent = OrderedDict()  # update_id -> 最近一次收到的时间
+        self.duplicates = 0  # 丢弃的重复 update 数
+        self.db = None
+        self.inserts = 0
+        if db_path:
+            self.db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS seen_updates (update_id INTEGER PRIMARY KEY, seen REAL NOT NULL)")
+
+    def seen(self, update_id):
+        """记下 update_id，之前收到过返回 True"""
+        if update_id is None:
+            return False
+        now = time.time()
+        while self.recent:
+            oldest = next(iter(self.recent.values()))
+            if oldest >= now - self.ttl:
+                break
+            self.recent.popitem(last=False)
+
+        duplicate = update_id in self.recent
+        if not duplicate and self.db is not None:
+            duplicate = not self._insert(update_id, now)
+        self.recent[update_id] = now
+        self.recent.move_to_end(update_id)
+        if len(self.recent) > self.size:
+            self.recent.popitem(last=False)
+        if duplicate:
+            self.duplicates += 1
+        return duplicate
+
+    def _insert(self, update_id, now):
+        """写入 SQLite，已存在返回 False；数据库出错时按新 update 处理"""
+        try:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO seen_updates (update_id, seen) VALUES (?, ?)", (update_id, now))
+            self.inserts += 1
+            if self.inserts % 1000 == 0:
+                self.db.execute("DELETE FROM seen_updates WHERE seen < ?", (now - self.ttl,))
+            return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            log(f"update 去重数据库错误: {e}")
+            return True
+
+UPDATE_DEDUP = UpdateDeduplicator(UPDATE_DEDUP_SIZE, UPDATE_DEDUP_TTL, UPDATE_DEDUP_DB or None)
+
+# ============ 更新分发 ============
+MENTION_PREFIX_RE = re.compile(r'^@\S+\s+')
+
+def handle_update(update):
+    """处理一条 Telegram update (在主事件循环上执行)
+
+    只解析和入队: 回复交给发送队列，任务交给调度器，不等待任何网络请求。
+    """
     try:
-        update = request.get_json()
-        
         if not update:
-            return Response(status=200)
+            return
+        METRICS.inc("opencode_bot_updates_total")
+        
+        # Telegram 在 webhook 超时后会重发同一个 update
+        if UPDATE_DEDUP.seen(update.get('update_id')):
+            log(f"忽略重复的 update: {update.get('update_id')}")
+            return
         
         if 'message' in update:
             msg = update['message']
@@ -494,85 +2410,169 @@ def webhook():
             text = msg.get('text', '')
             
             # 去除 @bot_username 前缀
-            import re
-            text = re.sub(r'^@\S+\s+', '', text)
+            text = MENTION_PREFIX_RE.sub('', text)
             
             log(f"收到消息: {text[:30]}... (chat_id: {chat_id})")
             
             # 处理命令
             if text == '/start':
-                send_message(chat_id, 
+                post_message(chat_id, 
                     "欢迎使用 OpenCode Bot!\n\n"
                     "发送任何任务，我会使用 OpenCode 来执行。\n"
                     "配置文件: /Users/jiancao/env.txt")
                 
             elif text == '/help':
-                send_message(chat_id,
+                post_message(chat_id,
                     "可用命令:\n"
                     "/start - 欢迎\n"
                     "/help - 帮助\n"
                     "/status - 运行状态\n"
                     "/memory - 查看记忆\n"
                     "/clearmemory - 清除记忆\n"
+                    "/cancel - 取消正在运行的任务\n"
+                    "/newsession - 开始新的 opencode 会话\n"
+                    "/fork - 下一个任务从当前会话分叉\n"
                     "/reset - 重启 bot")
                 
             elif text == '/status':
-                if RUNNING_TASKS.get(chat_id):
-                    send_message(chat_id, "⏳ 任务运行中...")
-                else:
-                    send_message(chat_id, "✅ 空闲")
+                post_message(chat_id, SCHEDULER.status_text(chat_id))
                     
             elif text == '/memory':
-                memory = CONVERSATION_MEMORY.get(chat_id, [])
+                memory = MEMORY_STORE.rounds(chat_id)
                 if not memory:
-                    send_message(chat_id, "暂无记忆")
+                    post_message(chat_id, "暂无记忆")
                 else:
                     msg = "📋 记忆内容:\n\n"
                     for i, m in enumerate(memory):
                         msg += f"第 {i+1} 轮:\n任务: {m['task'][:100]}...\n结果: {m['result'][:200]}...\n\n"
-                    send_message(chat_id, msg)
+                    post_message(chat_id, msg)
             
             elif text == '/clearmemory':
-                CONVERSATION_MEMORY[chat_id] = []
-                send_message(chat_id, "🗑️ 记忆已清除")
+                MEMORY_STORE.clear(chat_id)
+                post_message(chat_id, "🗑️ 记忆已清除")
+            
+            elif text == '/cancel':
+                job = SCHEDULER.cancel(chat_id)
+                if job is None:
+                    post_message(chat_id, "当前没有运行中的任务")
+                else:
+                    waiting = len(SCHEDULER.queues.get(chat_id, ()))
+                    queued = f"，队列中还有 {waiting} 个任务" if waiting else ""
+                    post_message(chat_id, f"🛑 已取消: {job.text[:50]}{queued}")
+            
+            elif text == '/newsession':
+                MEMORY_STORE.drop_session(chat_id)
+                post_message(chat_id, "🆕 下一个任务将开始新的 opencode 会话")
+            
+            elif text == '/fork':
+                if MEMORY_STORE.fork_session(chat_id):
+                    post_message(chat_id, "🌿 下一个任务将从当前会话分叉，原会话保持不变")
+                else:
+                    post_message(chat_id, "当前没有可分叉的会话")
                 
             elif text == '/reset':
-                send_message(chat_id, "🔄 正在重启 bot...")
-                def restart_bot():
-                    func = request.environ.get('werkzeug.server.shutdown')
-                    if func:
-                        func()
-                    time.sleep(2)
-                    subprocess.Popen(
-                        ["python3", "/Users/jiancao/telegram_opencode_bot.py"],
-                        stdout=open("/tmp/opencode_bot.log", "a"),
-                        stderr=subprocess.STDOUT
-                    )
-                    time.sleep(1)
-                    exit(0)
-                Thread(target=restart_bot).start()
+                post_message(chat_id, "🔄 正在重启 bot...")
+                spawn(restart_bot())
                     
             elif text.startswith('/'):
-                send_message(chat_id, f"未知命令: {text}")
+                post_message(chat_id, f"未知命令: {text}")
                 
             else:
                 # 忽略空消息
                 if not text or not text.strip():
-                    return Response(status=200)
+                    return
                 
-                if RUNNING_TASKS.get(chat_id):
-                    send_message(chat_id, "⏳ 已有任务在运行，请稍等...")
-                else:
-                    # 使用带记忆的 prompt
-                    prompt = build_prompt_with_memory(text, chat_id)
-                    full_prompt = prompt
-                    
-                    RUNNING_TASKS[chat_id] = True
-                    Thread(target=run_opencode, args=(full_prompt, chat_id, text)).start()
+                # 重复发送的相同任务合并到运行中或排队中的那个，输出只有一份
+                job = SCHEDULER.coalesce(chat_id, text)
+                if job is not None:
+                    if job is SCHEDULER.running.get(chat_id):
+                        post_message(chat_id, "🔁 相同的任务正在执行，结果会继续发在这里")
+                    else:
+                        post_message(chat_id, "🔁 相同的任务已在队列中，不会重复执行")
+                    return
+                
+                position = SCHEDULER.submit(chat_id, text)
+                if position is None:
+                    post_message(chat_id, f"⛔ 队列已满 (每个聊天最多排队 {CHAT_QUEUE_LIMIT} 个任务)，请稍后再试")
+                elif position > 0:
+                    post_message(chat_id, f"📥 已加入队列，前面还有 {position} 个任务")
                     
     except Exception as e:
-        log(f"处理错误: {e}")
+        log(f"处理错误: {e}", ERROR)
+
+# ============ getUpdates 长轮询 ============
+def load_poll_offset():
+    """读取上次确认到的 offset，没有则从 0 开始"""
+    try:
+        with open(POLL_OFFSET_FILE, 'r', encoding='utf-8') as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+def save_poll_offset(offset):
+    """先写临时文件再替换，进程中途退出也不会留下半个数字"""
+    tmp = POLL_OFFSET_FILE + ".tmp"
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(str(offset))
+        os.replace(tmp, POLL_OFFSET_FILE)
+    except OSError as e:
+        log(f"保存 offset 失败: {e}", WARNING)
+
+async def poll_updates():
+    """polling 模式: 长轮询 getUpdates，每批最多 POLL_LIMIT 个 update，交给和 webhook 相同的 handle_update"""
+    offset = load_poll_offset()
+    log(f"开始长轮询 getUpdates (offset {offset})")
+    try:
+        # 设置了 webhook 时 getUpdates 会返回 409
+        await telegram_api("deleteWebhook", {}, timeout=15)
+    except Exception as e:
+        log(f"删除 webhook 失败: {e}", WARNING)
     
+    delay = 1
+    while True:
+        data = {"offset": offset, "limit": POLL_LIMIT, "timeout": POLL_TIMEOUT, "allowed_updates": ["message"]}
+        try:
+            result = await telegram_api("getUpdates", data, timeout=POLL_TIMEOUT + 10)
+            updates = json.loads(result).get('result', [])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log(f"getUpdates 失败: {e}，{delay} 秒后重试")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+            continue
+        delay = 1
+        if not updates:
+            continue
+        for update in updates:
+            handle_update(update)
+            offset = max(offset, update.get('update_id', 0) + 1)
+        # 下一次 getUpdates 带上 offset 即向 Telegram 确认这一批
+        save_poll_offset(offset)
+        log(f"getUpdates 收到 {len(updates)} 个 update，offset {offset}")
+
+async def restart_bot():
+    """重启 bot: 关闭 HTTP 服务后用新进程替换当前进程"""
+    if HTTP_SERVER is not None:
+        HTTP_SERVER.close()
+    await asyncio.sleep(2)
+    # execv 不会执行 atexit，先结束常驻进程释放端口
+    WARM_POOL.kill_all()
+    MEMORY_STORE.close()
+    TRACES.close()
+    LOG_WRITER.close()
+    sys.stdout.flush()
+    os.execv(sys.executable, [sys.executable, os.path.abspath(__file__)])
+
+# ============ Webhook 路由 ============
+app.config['MAX_CONTENT_LENGTH'] = HTTP_MAX_BODY  # 超过上限 Flask 直接返回 413
+
+@app.route('/webhook', methods=['POST'])
+def webhook():
+    update = request.get_json(silent=True)
+    # 交给事件循环处理后立即返回 200，不等待回复发出
+    BOT_LOOP.call_soon_threadsafe(handle_update, update)
     return Response(status=200)
 
 @app.route('/health', methods=['GET'])
@@ -580,11 +2580,235 @@ def health():
     """健康检查"""
     return jsonify({"status": "ok"})
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus 指标 (在事件循环线程里生成，读到一致的状态)"""
+    status, content_type, payload = asyncio.run_coroutine_threadsafe(metrics_async(None), BOT_LOOP).result(5)
+    return Response(payload, status=status, content_type=content_type)
+
+@app.route('/jobs/<int:job_id>/trace', methods=['GET'])
+def job_trace(job_id):
+    """任务时间线"""
+    status, content_type, payload = asyncio.run_coroutine_threadsafe(job_trace_async(None, str(job_id)), BOT_LOOP).result(5)
+    return Response(payload, status=status, content_type=content_type)
+
+@app.route('/jobs/tools', methods=['GET'])
+def job_tools():
+    """各工具调用耗时的分位数"""
+    status, content_type, payload = asyncio.run_coroutine_threadsafe(job_tools_async(None), BOT_LOOP).result(5)
+    return Response(payload, status=status, content_type=content_type)
+
+# ============ asyncio HTTP 服务 ============
+async def webhook_async(body):
+    try:
+        update = json.loads(body) if body else None
+    except ValueError:
+        update = None
+    # 先回复 200，update 在下一轮事件循环中分发
+    BOT_LOOP.call_soon(handle_update, update)
+    return 200, "text/plain", b""
+
+async def health_async(body):
+    """健康检查"""
+    return 200, "application/json", json.dumps({"status": "ok"}).encode('utf-8')
+
+def metric_gauges():
+    """输出时读取的状态量"""
+    pool_states = {"idle": 0, "busy": 0, "starting": 0, "down": 0}
+    for worker in WARM_POOL.workers:
+        pool_states[worker.state] = pool_states.get(worker.state, 0) + 1
+    return [
+        ("opencode_bot_jobs_running", "运行中的任务数", "gauge", [((), len(SCHEDULER.running))]),
+        ("opencode_bot_jobs_queued", "排队中的任务数", "gauge", [((), SCHEDULER.queued())]),
+        ("opencode_bot_chats_waiting", "有任务在等待空位的聊天数", "gauge", [((), len(SCHEDULER.ready))]),
+        ("opencode_bot_max_workers", "全局同时运行的任务上限", "gauge", [((), MAX_WORKERS)]),
+        ("opencode_bot_jobs_coalesced_total", "合并到已有任务的重复请求数", "counter", [((), SCHEDULER.coalesced)]),
+        ("opencode_bot_updates_duplicate_total", "丢弃的重复 update 数", "counter", [((), UPDATE_DEDUP.duplicates)]),
+        ("opencode_bot_outbox_pending", "发送队列中待发的 Bot API 请求数", "gauge", [((), OUTBOX.pending())]),
+        ("opencode_bot_warm_workers", "常驻 opencode 进程数，按状态分", "gauge",
+         [((("state", state),), count) for state, count in pool_states.items()]),
+        ("opencode_bot_memory_cached_chats", "内存中缓存记忆的聊天数", "gauge", [((), len(MEMORY_STORE.cache))]),
+        ("opencode_bot_snapshot_freed_bytes_total", "快照清理释放的字节数", "counter", [((), SNAPSHOT_GC.freed)]),
+    ]
+
+async def metrics_async(body):
+    """Prometheus 指标"""
+    return 200, "text/plain; version=0.0.4; charset=utf-8", METRICS.render(metric_gauges()).encode('utf-8')
+
+async def job_trace_async(body, job_id):
+    """任务时间线，每行一个 JSON 事件 (运行中的任务返回到目前为止的部分)"""
+    trace = TRACES.get(int(job_id))
+    if trace is None:
+        return 404, "text/plain", b"Not Found"
+    return 200, "application/x-ndjson; charset=utf-8", trace.text().encode('utf-8')
+
+async def job_tools_async(body):
+    """各工具调用耗时的分位数 (秒)"""
+    return 200, "application/json", json.dumps(TRACES.tool_stats(), ensure_ascii=False).encode('utf-8')
+
+HTTP_ROUTES = {
+    ("POST", "/webhook"): webhook_async,
+    ("GET", "/health"): health_async,
+    ("GET", "/metrics"): metrics_async,
+    ("GET", "/jobs/tools"): job_tools_async,
+}
+
+# 带参数的路径: (方法, 路径正则, 处理函数, 指标里的路径标签)，正则的分组作为额外参数传给处理函数
+HTTP_PATTERN_ROUTES = [
+    ("GET", re.compile(r'/jobs/(\d+)/trace'), job_trace_async, "/jobs/<id>/trace"),
+]
+
+def match_route(method, path):
+    """返回 (处理函数, 额外参数, 指标标签)；没有匹配的路由时处理函数为 None"""
+    handler = HTTP_ROUTES.get((method, path))
+    if handler is not None:
+        return handler, (), path
+    for route_method, pattern, handler, label in HTTP_PATTERN_ROUTES:
+        if route_method == method:
+            match = pattern.fullmatch(path)
+            if match:
+                return handler, match.groups(), label
+    return None, (), "other"  # 未知路径不作为标签，避免标签无限增长
+
+HTTP_REASONS = {
+    200: "OK", 400: "Bad Request", 404: "Not Found", 408: "Request Timeout",
+    413: "Payload Too Large", 500: "Internal Server Error",
+}
+
+class HTTPRequestError(Exception):
+    """请求不合法，回复对应状态码后关闭连接"""
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+async def read_http_request(reader):
+    """读取一个 HTTP/1.1 请求，返回 (method, path, headers, body)；连接关闭返回 None"""
+    request_line = await asyncio.wait_for(reader.readline(), HTTP_IDLE_TIMEOUT)
+    if not request_line:
+        return None
+    parts = request_line.decode('latin-1').split()
+    if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+        raise HTTPRequestError(400)
+    method, target, _ = parts
+    
+    async def read_rest():
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= HTTP_MAX_HEADERS:
+                raise HTTPRequestError(400)
+            key, sep, value = line.decode('latin-1').partition(':')
+            if not sep:
+                raise HTTPRequestError(400)
+            headers[key.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HTTPRequestError(400)
+        if length < 0:
+            raise HTTPRequestError(400)
+        if length > HTTP_MAX_BODY:
+            raise HTTPRequestError(413)
+        body = await reader.readexactly(length) if length else b''
+        return headers, body
+    
+    try:
+        headers, body = await asyncio.wait_for(read_rest(), HTTP_READ_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPRequestError(408)
+    return method, target.split('?', 1)[0], headers, body
+
+def write_http_response(writer, status, content_type, payload, keep_alive):
+    writer.write((
+        f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'OK')}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(payload)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    ).encode('latin-1') + payload)
+
+async def handle_http(reader, writer):
+    """极简 HTTP/1.1 服务端 (支持 keep-alive)，按 HTTP_ROUTES / HTTP_PATTERN_ROUTES 分发"""
+    try:
+        while True:
+            try:
+                parsed = await read_http_request(reader)
+            except HTTPRequestError as e:
+                write_http_response(writer, e.status, "text/plain", HTTP_REASONS[e.status].encode('latin-1'), False)
+                await writer.drain()
+                break
+            except ValueError:
+                # 单行超过 StreamReader 上限
+                write_http_response(writer, 400, "text/plain", b"Bad Request", False)
+                await writer.drain()
+                break
+            if parsed is None:
+                break
+            method, path, headers, body = parsed
+            
+            start = time.monotonic()
+            handler, args, path = match_route(method, path)
+            if handler is None:
+                status, content_type, payload = 404, "text/plain", b"Not Found"
+            else:
+                try:
+                    status, content_type, payload = await handler(body, *args)
+                except Exception as e:
+                    log(f"HTTP 处理错误: {e}")
+                    status, content_type, payload = 500, "text/plain", b"Internal Server Error"
+            METRICS.inc("opencode_bot_http_requests_total", 1, (("path", path), ("code", status)))
+            METRICS.observe("opencode_bot_http_request_seconds", time.monotonic() - start, (("path", path),))
+            
+            keep_alive = headers.get('connection', '').lower() != 'close'
+            write_http_response(writer, status, content_type, payload, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+        pass
+    finally:
+        writer.close()
+
+async def serve_asyncio():
+    """asyncio / polling 模式: HTTP 服务、长轮询与所有任务共用一个事件循环"""
+    global BOT_LOOP, HTTP_SERVER
+    BOT_LOOP = asyncio.get_running_loop()
+    install_child_watcher(BOT_LOOP)
+    WARM_POOL.start()
+    SNAPSHOT_GC.start()
+    if SERVER_MODE == "polling":
+        spawn(poll_updates())
+    HTTP_SERVER = await asyncio.start_server(handle_http, '0.0.0.0', PORT)
+    try:
+        await HTTP_SERVER.serve_forever()
+    except asyncio.CancelledError:
+        pass
+
+def install_child_watcher(loop):
+    """Python 3.12 之前默认每个子进程占一个等待线程；有 pidfd 时改由事件循环监听退出"""
+    if sys.version_info >= (3, 12) or not hasattr(os, 'pidfd_open'):
+        return
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except OSError:
+        return
+    watcher = asyncio.PidfdChildWatcher()
+    asyncio.set_child_watcher(watcher)
+    watcher.attach_loop(loop)
+
+def start_loop_thread():
+    """flask 模式: 在后台线程运行主事件循环"""
+    loop = asyncio.new_event_loop()
+    install_child_watcher(loop)
+    Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
 # ============ 主程序 ============
 if __name__ == "__main__":
     log("=" * 50)
     log("OpenCode Telegram Bot 启动")
-    log(f"监听端口: {PORT}")
+    log(f"监听端口: {PORT} (模式: {SERVER_MODE})")
     log("=" * 50)
     
     # 设置信号处理
@@ -595,5 +2819,11 @@ if __name__ == "__main__":
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
     
-    # 启动 Flask
-    app.run(host='0.0.0.0', port=PORT, debug=False, threaded=True)
+    if SERVER_MODE == "flask":
+        # 启动 Flask，任务在后台事件循环中执行
+        BOT_LOOP = start_loop_thread()
+        BOT_LOOP.call_soon_threadsafe(WARM_POOL.start)
+        BOT_LOOP.call_soon_threadsafe(SNAPSHOT_GC.start)
+        app.run(host='0.0.0.0', port=PORT, debug=False, threaded=True)
+    else:
+        asyncio.run(serve_asyncio())